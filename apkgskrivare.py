@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import queue
+import shutil
+import sqlite3
+import zipfile
+import itertools
+import tempfile
+import threading
+
+"""
+Strömmande .apkg-skrivare.
+
+Bilderna skrivs in i zip-filen i en egen tråd medan sidorna fortfarande
+renderas/maskas, i stället för i ett svep efter att allt är klart. Kvar
+på slutet blir bara samlingen (collection.anki2) och mediaförteckningen.
+
+Redan komprimerade format (png, jpeg, webp …) lagras okomprimerade –
+deflate ger nästan inget på dem. Resten (samlingen, json) deflateras i
+skrivartråden, parallellt med huvudtråden (zlib släpper GIL:en).
+
+Paketet skrivs till <sökväg>.tmp och byts in först när finish() är klar,
+så ett avbrutet bygge lämnar inte en trasig .apkg efter sig. Alla
+zip-poster får samma tid (timestamp), så samma indata ger samma fil.
+
+    with ApkgWriter("tentor.apkg", timestamp) as writer:
+        writer.add_media("media/ab12….png")   # så fort bilden finns
+        ...
+        writer.finish(decks)
+"""
+
+# Ändelser som redan är komprimerade och lagras som de är
+STORED_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp", ".gif", ".avif", ".mp3", ".ogg", ".mp4", ".webm"}
+QUEUE_DEPTH = 64          # bilder som får vänta på skrivartråden innan add_media blockerar
+COPY_CHUNK = 1024 * 1024
+
+def compress_type(name):
+    ext = os.path.splitext(name)[1].lower()
+    return zipfile.ZIP_STORED if ext in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+
+class ApkgWriter:
+    """Ett .apkg som byggs medan bilderna blir klara.
+
+    add_media() köar en fil (en gång per filnamn – media namnges efter
+    innehållet), finish() skriver samlingen och byter in paketet. Namn i
+    skip (bilder som redan finns i Anki, t.ex. vid --delta) hoppas över.
+    Utan finish() tas den ofärdiga filen bort när with-blocket lämnas.
+    """
+
+    def __init__(self, path, timestamp=None, skip=()):
+        self.path = path
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.date_time = max(time.gmtime(self.timestamp)[:6], (1980, 1, 1, 0, 0, 0))
+        self.skip = set(skip)
+        self.media = []    # sökvägar i zip-ordning (posten heter indexet)
+        self._names = set()
+        self._tmp = path + ".tmp"
+        self._zip = zipfile.ZipFile(self._tmp, "w")
+        self._queue = queue.Queue(QUEUE_DEPTH)
+        self._error = None
+        self._done = False
+        self._thread = threading.Thread(target=self._run, name="apkg", daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add_media(self, path):
+        name = os.path.basename(path)
+        if name in self._names or name in self.skip:
+            return
+        if self._error is not None:
+            raise self._error
+        self._names.add(name)
+        self._queue.put((str(len(self.media)), path, compress_type(name)))
+        self.media.append(path)
+
+    def finish(self, decks, timestamp=None):
+        """Skriv samlingen och mediaförteckningen och byt in paketet. Returnerar sökvägen."""
+        import genanki
+        timestamp = self.timestamp if timestamp is None else timestamp
+        fd, db_path = tempfile.mkstemp(suffix=".anki2")
+        os.close(fd)
+        try:
+            # Samlingen byggs medan skrivartråden fortfarande skriver de sista bilderna
+            conn = sqlite3.connect(db_path)
+            pkg = genanki.Package(decks)
+            pkg.write_to_db(conn.cursor(), timestamp, itertools.count(int(timestamp * 1000)))
+            conn.commit()
+            conn.close()
+            media_json = json.dumps({str(i): os.path.basename(p) for i, p in enumerate(self.media)})
+            self._queue.put(("collection.anki2", db_path, zipfile.ZIP_DEFLATED))
+            self._queue.put(("media", media_json.encode("utf-8"), zipfile.ZIP_DEFLATED))
+            self._stop()
+            if self._error is not None:
+                raise self._error
+            self._zip.close()
+            os.replace(self._tmp, self.path)
+            self._done = True
+        finally:
+            os.remove(db_path)
+            if not self._done:
+                self.close()
+        return self.path
+
+    def close(self):
+        """Avbryt ett ofärdigt paket (gör inget efter finish())."""
+        if self._done:
+            return
+        self._done = True
+        self._stop()
+        self._zip.close()
+        if os.path.exists(self._tmp):
+            os.remove(self._tmp)
+
+    def _stop(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is not None:
+                continue  # töm kön så att add_media inte blockerar
+            try:
+                self._write(*item)
+            except Exception as e:
+                self._error = e
+
+    def _write(self, entry, src, kind):
+        info = zipfile.ZipInfo(entry, self.date_time)
+        info.compress_type = kind
+        if isinstance(src, bytes):
+            self._zip.writestr(info, src)
+            return
+        large = os.path.getsize(src) > zipfile.ZIP64_LIMIT
+        with open(src, "rb") as f, self._zip.open(info, "w", force_zip64=large) as out:
+            shutil.copyfileobj(f, out, COPY_CHUNK)
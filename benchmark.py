@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+import os
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import contextlib
+import fitz  # PyMuPDF
+import maska_ratt_svar as maska
+from mediakodning import FORMATS, encode_image, extension
+from korrapport import peak_rss_mb
+
+"""
+Benchmark för maskning och deckbygge på syntetiska tentor (ingen riktig PDF behövs).
+
+Genererar en tenta med och utan facit (försättssidor, frågor med radioknappar,
+gröna bockar) och tidtar varje steg:
+  rasterize      -> maska.rasterize_page (sidflödets steg 1, inkl. PDF-strukturen)
+  rasterize_mem  -> maska.iter_pdf_pages (direkt till minnet)
+  mask_<mode>    -> maska.mask_page per sida för varje valt läge
+  encode         -> mediakodning.encode_image för de maskade sidorna
+  pipeline       -> maska.iter_processed_pages (rasterisera+maska+koda överlappande)
+  pdf            -> maska.append_image_page per kodad sida + save (som run_stream)
+  apkg           -> maska.build_apkg_from_images
+
+Per steg rapporteras tid (bästa av --repeat), CPU-tid, sidor/s och toppminne
+(tracemalloc, inkl. numpy-buffertar). Processens topp-RSS skrivs ut på slutet.
+
+Exempel:
+  python3 benchmark.py --pages 40 --dpi 220 --save bench_baseline.json
+  python3 benchmark.py --pages 40 --dpi 220 --compare bench_baseline.json
+"""
+
+DEFAULT_MODES = ("column", "green", "replicate", "diff")
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Benchmark för maskning och deckbygge.")
+    ap.add_argument("--pages", type=int, default=20, help="Antal frågesidor (default: 20)")
+    ap.add_argument("--cover", type=int, default=2, help="Försättssidor som hoppas över (default: 2)")
+    ap.add_argument("--questions", type=int, default=2, help="Frågor per sida (default: 2)")
+    ap.add_argument("--options", type=int, default=5, help="Svarsalternativ per fråga (default: 5)")
+    ap.add_argument("--dpi", type=int, default=220)
+    ap.add_argument("--modes", default=",".join(DEFAULT_MODES),
+                    help="Maskningslägen att mäta, kommaseparerade")
+    ap.add_argument("--format", choices=FORMATS, default="png", dest="media_format",
+                    help="Bildformat för encode-steget")
+    ap.add_argument("--repeat", type=int, default=3, help="Körningar per steg; bästa tiden räknas")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--no-tracemalloc", action="store_true", dest="no_tracemalloc",
+                    help="Mät inte toppminne per steg (tracemalloc kostar lite tid)")
+    ap.add_argument("--save", default=None, help="Spara resultatet som baslinje (JSON)")
+    ap.add_argument("--compare", default=None, help="Jämför mot sparad baslinje (JSON)")
+    ap.add_argument("--tolerance", type=float, default=0.20,
+                    help="Tillåten försämring mot baslinjen innan steget räknas som regression (default: 0.20)")
+    ap.add_argument("--keep", default=None, help="Behåll genererade filer i denna mapp")
+    return ap.parse_args()
+
+# ====== Syntetiska tentor ======
+def make_exam_pdf(path, pages=20, facit=True, cover=2, questions=2, options=5, seed=1):
+    """Skriv en syntetisk tenta: försättssidor + frågor med radioknappar.
+
+    Med facit=True ritas en grön bock över rätt alternativ. Samma seed ger
+    samma rätta svar, så en facit- och en utan-PDF bildar ett par (för mode=diff).
+    """
+    rnd = random.Random(seed)
+    doc = fitz.open()
+    for p in range(cover):
+        page = doc.new_page(width=595, height=842)
+        page.insert_text((72, 100), f"Tentamen Basvetenskap – försättssida {p + 1}", fontsize=18)
+        page.insert_text((72, 140), "Instruktioner: läs varje fråga noga.", fontsize=11)
+    step = 26
+    block = 30 + options * step + 40
+    for p in range(pages):
+        page = doc.new_page(width=595, height=842)
+        y = 90
+        for q in range(questions):
+            if y + block > 800:
+                break
+            page.insert_text((60, y), f"Fråga {p * questions + q + 1}. Vilket alternativ är korrekt?", fontsize=12)
+            y += 30
+            answer = rnd.randrange(options)
+            for o in range(options):
+                page.draw_circle((80, y - 4), 4.5, color=(0, 0, 0), width=0.8)
+                page.insert_text((95, y), f"Alternativ {chr(65 + o)}: påstående om ämnet", fontsize=11)
+                if facit and o == answer:
+                    page.draw_polyline([(74, y - 5), (79, y), (88, y - 12)], color=(0, 0.7, 0.1), width=2.5)
+                y += step
+            y += 40
+    doc.save(path)
+    doc.close()
+    return path
+
+# ====== Mätning ======
+class Bench:
+    def __init__(self, repeat=3, trace_memory=True):
+        self.repeat = max(1, repeat)
+        self.trace_memory = trace_memory
+        self.stages = {}
+
+    def run(self, name, fn, pages):
+        """Kör fn() repeat gånger och spara bästa tiden. Returnerar sista resultatet."""
+        best_wall = best_cpu = None
+        peak = 0
+        result = None
+        for _ in range(self.repeat):
+            if self.trace_memory:
+                tracemalloc.start()
+            t0, c0 = time.perf_counter(), time.process_time()
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = fn()
+            wall, cpu = time.perf_counter() - t0, time.process_time() - c0
+            if self.trace_memory:
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+            if best_wall is None or wall < best_wall:
+                best_wall, best_cpu = wall, cpu
+        self.stages[name] = {
+            "seconds": round(best_wall, 4),
+            "cpu_seconds": round(best_cpu, 4),
+            "pages": pages,
+            "pages_per_s": round(pages / best_wall, 2) if best_wall else None,
+            "peak_mb": round(peak / 1e6, 1) if self.trace_memory else None,
+        }
+        s = self.stages[name]
+        mem = f"  topp {s['peak_mb']:7.1f} MB" if s["peak_mb"] is not None else ""
+        print(f"  {name:16s} {s['seconds'] * 1000:9.1f} ms  {s['pages_per_s']:8.2f} sidor/s{mem}")
+        return result
+
+def mask_args(pdf_path, out_dir, mode, dpi, skip, utan_path):
+    """Maskningsargument med skriptets egna defaults."""
+    argv = [pdf_path, out_dir, "--mode", mode, "--dpi", str(dpi), "--skip-pages", str(skip)]
+    if mode == "diff":
+        argv += ["--utan", utan_path]
+    return maska.parse_args(argv)
+
+def rasterize_pages(args):
+    """Sidflödets rasterisering (rasterize_page) för alla sidor efter --skip-pages."""
+    n = 0
+    with fitz.open(args.pdf_path) as doc:
+        for i in range(args.skip_pages, doc.page_count):
+            rp = maska.rasterize_page(doc[i], args)
+            maska.PAGE_BUFFERS.give(rp.bgr, rp.utan_bgr)
+            n += 1
+    return n
+
+def assemble_pdf(encoded, sizes, out_pdf, dpi):
+    """Bygg den maskade PDF:en av kodade sidor, som run_stream gör."""
+    pdf = fitz.open()
+    try:
+        for data, (w, h) in zip(encoded, sizes):
+            maska.append_image_page(pdf, data, w, h, dpi)
+        pdf.save(out_pdf, deflate=True)
+    finally:
+        pdf.close()
+
+def run_benchmark(args, work_dir):
+    facit_pdf = make_exam_pdf(os.path.join(work_dir, "facit.pdf"), args.pages, True,
+                              args.cover, args.questions, args.options, args.seed)
+    utan_pdf = make_exam_pdf(os.path.join(work_dir, "utan.pdf"), args.pages, False,
+                             args.cover, args.questions, args.options, args.seed)
+    img_dir = os.path.join(work_dir, "img")
+    os.makedirs(img_dir, exist_ok=True)
+    n = args.pages
+    bench = Bench(args.repeat, not args.no_tracemalloc)
+    print(f"⏱️ {n} sidor à {args.dpi} DPI, bästa av {bench.repeat}")
+
+    rargs = mask_args(facit_pdf, img_dir, "replicate", args.dpi, args.cover, utan_pdf)
+    bench.run("rasterize", lambda: rasterize_pages(rargs), n)
+    pages = bench.run("rasterize_mem", lambda: [img for _, img in
+                                                maska.iter_pdf_pages(facit_pdf, args.dpi, args.cover)], n)
+
+    masked = None
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+    for mode in modes:
+        margs = mask_args(facit_pdf, img_dir, mode, args.dpi, args.cover, utan_pdf)
+        utan = ([img for _, img in maska.iter_pdf_pages(utan_pdf, args.dpi, args.cover)]
+                if mode == "diff" else [None] * len(pages))
+        out = bench.run(f"mask_{mode}", lambda: [maska.mask_page(img, margs, u)
+                                                 for img, u in zip(pages, utan)], n)
+        if masked is None or mode == "replicate":
+            masked = out
+        del utan
+
+    fmt = args.media_format
+    encoded = bench.run("encode", lambda: [encode_image(img, fmt) for img in masked], n)
+    # Maskade sidor bredvid originalen (page_NNN.png) som i skriptets vanliga flöde
+    for num, data in zip(range(args.cover + 1, args.cover + n + 1), encoded):
+        maska.write_bytes(os.path.join(img_dir, f"page_{num:03d}_masked{extension(fmt)}"), data)
+    for num, img in zip(range(args.cover + 1, args.cover + n + 1), pages):  # original för build_apkg_from_images
+        maska.write_bytes(os.path.join(img_dir, f"page_{num:03d}{extension(fmt)}"), encode_image(img, fmt))
+
+    # Hela kedjan rasterisera → maska → koda med överlappande steg (sidflode), som i --stream
+    pargs = mask_args(facit_pdf, img_dir, "replicate", args.dpi, args.cover, utan_pdf)
+    pargs.media_format = fmt
+    bench.run("pipeline", lambda: sum(1 for _ in maska.iter_processed_pages(pargs, maska.page_indices(pargs))), n)
+
+    # PDF:en får samma bytes som i run_stream (webp kodas om till jpeg, utanför mätningen)
+    pdf_pages = encoded if fmt in maska.PDF_EMBEDDABLE else [encode_image(img, "jpeg") for img in masked]
+    sizes = [(img.shape[1], img.shape[0]) for img in masked]
+    bench.run("pdf", lambda: assemble_pdf(pdf_pages, sizes, os.path.join(work_dir, "tenta_maskad.pdf"), args.dpi), n)
+    bench.run("apkg", lambda: maska.build_apkg_from_images(img_dir, os.path.join(work_dir, "bench.apkg")), n)
+
+    total = sum(s["seconds"] for s in bench.stages.values())
+    rss = peak_rss_mb()
+    print(f"📊 Totalt {total:.2f} s" + (f", topp-RSS {rss:.0f} MB" if rss is not None else ""))
+    return {
+        "config": {
+            "pages": args.pages, "cover": args.cover, "questions": args.questions,
+            "options": args.options, "dpi": args.dpi, "modes": modes,
+            "format": fmt, "seed": args.seed,
+        },
+        "env": {
+            "python": platform.python_version(), "platform": platform.platform(),
+            "cpus": os.cpu_count(), "pymupdf": fitz.VersionBind,
+            "opencv": maska.cv2.__version__, "numpy": maska.np.__version__,
+        },
+        "stages": bench.stages,
+        "total_seconds": round(total, 4),
+        "peak_rss_mb": round(rss, 1) if rss is not None else None,
+    }
+
+def compare(result, baseline, tolerance):
+    """Skriv ut skillnad per steg mot baslinjen. Returnerar antal regressioner."""
+    if baseline.get("config") != result["config"]:
+        print("⚠️ Baslinjen kördes med annan konfiguration – jämförelsen är ungefärlig")
+        print(f"   baslinje: {baseline.get('config')}")
+    if baseline.get("env", {}).get("platform") != result["env"]["platform"]:
+        print("⚠️ Baslinjen kördes på en annan maskin/plattform")
+    regressions = 0
+    print(f"🔍 Jämförelse mot baslinje (tolerans {tolerance:.0%}):")
+    for name, stage in result["stages"].items():
+        base = baseline.get("stages", {}).get(name)
+        if not base or not base.get("seconds"):
+            print(f"  {name:16s} (saknas i baslinjen)")
+            continue
+        ratio = stage["seconds"] / base["seconds"]
+        if ratio > 1 + tolerance:
+            mark = "❌ långsammare"
+            regressions += 1
+        elif ratio < 1 - tolerance:
+            mark = "✅ snabbare"
+        else:
+            mark = "≈"
+        print(f"  {name:16s} {base['seconds'] * 1000:9.1f} ms -> {stage['seconds'] * 1000:9.1f} ms"
+              f"  ({ratio:5.2f}x) {mark}")
+    return regressions
+
+def main():
+    args = parse_args()
+    if args.keep:
+        os.makedirs(args.keep, exist_ok=True)
+        result = run_benchmark(args, args.keep)
+    else:
+        with tempfile.TemporaryDirectory(prefix="anki-occlude-bench-") as work_dir:
+            result = run_benchmark(args, work_dir)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+        print(f"💾 Baslinje sparad: {args.save}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(result, baseline, args.tolerance)
+        if regressions:
+            print(f"❌ {regressions} steg långsammare än baslinjen")
+            sys.exit(1)
+        print("✅ Inga regressioner")
+
+if __name__ == "__main__":
+    main()
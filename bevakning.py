@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+import os
+import time
+import argparse
+import korrapport
+from parning import find_exam_pdfs, is_facit, match_pairs
+
+"""
+Bevakningsläge: en varm process som bygger om decket när nya tentor dyker upp.
+
+    python bevakning.py deck --root kurser/               # skap_anki_deck.py
+    python bevakning.py maska kurser/ out/ --build-apkg   # maska_ratt_svar.py (batch)
+
+Övriga flaggor går vidare till respektive script. Mapparna pollas var
+--interval sekund (samma sökning som find_exam_pdfs, inga extra beroenden).
+En fil räknas som klar när storlek och mtime legat still i --settle sekunder
+och den slutar med %%EOF, så halvskrivna kopior hoppas över tills de är
+färdiga. Paren räknas om när filer tillkommer, ändras eller tas bort, men
+bara nya eller ändrade tentor bearbetas; processpoolen, importerna och
+renderingscachen är varma mellan omgångarna, så ett nytt par syns i
+.apkg-filen efter några sekunder. --report/--profile gäller varje
+ombyggnad för sig; filen skrivs om med den senaste.
+"""
+
+POLL_INTERVAL = 2.0   # sekunder mellan genomsökningarna
+SETTLE_SECONDS = 2.0  # så länge en fil måste vara oförändrad innan den bearbetas
+
+def pdf_complete(path):
+    """Filen slutar med en PDF-trailer (%%EOF bland de sista byten)."""
+    try:
+        with open(path, "rb") as f:
+            f.seek(max(0, os.path.getsize(path) - 1024))
+            return b"%%EOF" in f.read()
+    except OSError:
+        return False
+
+class FolderWatch:
+    """Pollar en mapp efter PDF:er och rapporterar färdigskrivna filer som ändrats."""
+
+    def __init__(self, root, settle=SETTLE_SECONDS):
+        self.root = root
+        self.settle = settle
+        self.ready = {}    # sökväg -> (storlek, mtime) för filer som lämnats ut
+        self._seen = {}    # sökväg -> ((storlek, mtime), första gången den sågs så)
+
+    def poll(self, now=None):
+        """(nya/ändrade färdiga filer, borttagna filer) sedan förra anropet."""
+        now = time.monotonic() if now is None else now
+        stamps = {}
+        for path in find_exam_pdfs(self.root):
+            try:
+                st = os.stat(path)
+            except OSError:  # borttagen mellan sökningen och stat
+                continue
+            stamps[path] = (st.st_size, st.st_mtime_ns)
+        changed = []
+        for path, stamp in stamps.items():
+            if self.ready.get(path) == stamp:
+                continue
+            seen_stamp, since = self._seen.get(path, (None, now))
+            if seen_stamp != stamp:
+                self._seen[path] = (stamp, now)  # ny eller fortfarande under skrivning
+                continue
+            if now - since >= self.settle and pdf_complete(path):
+                self.ready[path] = stamp
+                del self._seen[path]
+                changed.append(path)
+        removed = [p for p in self.ready if p not in stamps]
+        for path in removed:
+            del self.ready[path]
+        for path in [p for p in self._seen if p not in stamps]:
+            del self._seen[path]
+        return sorted(changed), removed
+
+class DeckTarget:
+    """skap_anki_deck: para alla klara filer och bygg om decket när paren ändrats.
+
+    Oförändrade par hämtas ur renderingscachen, så bara det nya paret renderas.
+    """
+
+    def __init__(self, argv):
+        import skap_anki_deck
+        self.script = skap_anki_deck
+        self.args = skap_anki_deck.parse_args(argv)
+        self.root = self.args.root
+        workers = self.args.workers or os.cpu_count() or 1
+        self.pool = skap_anki_deck.make_pool(workers) if workers > 1 else None
+        self.pairs = []
+
+    def update(self, files, changed, removed):
+        facit = [p for p in files if is_facit(p)]
+        utan = [p for p in files if not is_facit(p)]
+        with korrapport.stage("pair"):
+            pairs = [(u, f) for u, f, _ in match_pairs(utan, facit)]
+        touched = set(changed) | set(removed)
+        if pairs == self.pairs and not any(p in touched for pair in pairs for p in pair):
+            return False
+        for u, f in sorted(set(pairs) - set(self.pairs)):
+            print(f"✅ Nytt par: {u} ↔ {f}")
+        self.pairs = pairs
+        self.script.build_deck(self.args, pairs, self.pool)
+        return True
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+class MaskTarget:
+    """maska_ratt_svar i batchläge: maska bara nya/ändrade facit och bygg om det samlade paketet."""
+
+    def __init__(self, argv):
+        import maska_ratt_svar
+        self.script = maska_ratt_svar
+        self.args = maska_ratt_svar.parse_args(argv)
+        self.root = self.args.pdf_path
+        if not os.path.isdir(self.root):
+            raise SystemExit(f"❌ Bevakningsläget kräver en mapp, inte {self.root}")
+        use_pool = self.args.workers > 1 and not self.args.vector
+        self.pool = maska_ratt_svar.make_pool(self.args) if use_pool else None
+        self.exams = {}  # facit -> (namn, tenta utan facit, bildmapp)
+
+    def update(self, files, changed, removed):
+        m = self.script
+        facit = [p for p in files if is_facit(p)] or files
+        others = [p for p in files if p not in facit]
+        utan_for = m.pair_utan(self.args, facit, others)
+        names = m.exam_names(facit)
+        touched = set(changed) | set(removed)
+        dirty = False
+        for pdf in [p for p in self.exams if p not in names]:
+            del self.exams[pdf]
+            dirty = True
+        for pdf, name in names.items():
+            utan = utan_for.get(pdf)
+            known = self.exams.get(pdf)
+            if known and known[:2] == (name, utan) and pdf not in touched and utan not in touched:
+                continue
+            img_dir = m.mask_exam(self.args, pdf, utan, name, self.pool)
+            if img_dir is None:
+                self.exams.pop(pdf, None)
+            else:
+                self.exams[pdf] = (name, utan, img_dir)
+            dirty = True
+        if dirty and self.args.build_apkg and self.exams:
+            exams = [(name, img_dir) for name, _, img_dir in self.exams.values()]
+            m.build_batch_apkg(exams, m.batch_apkg_path(self.args), split_questions=self.args.split_questions,
+                               dpi=self.args.dpi, question_gap=self.args.question_gap, delta=self.args.delta)
+        return dirty
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+TARGETS = {"deck": DeckTarget, "maska": MaskTarget}
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description="Bevaka mappar och bygg om decket när tentor tillkommer.",
+                                 epilog="Övriga flaggor går vidare till skap_anki_deck.py (deck) "
+                                        "eller maska_ratt_svar.py (maska).")
+    ap.add_argument("target", choices=sorted(TARGETS), help="deck = skap_anki_deck.py, maska = maska_ratt_svar.py")
+    ap.add_argument("--interval", type=float, default=POLL_INTERVAL, help="Sekunder mellan genomsökningarna")
+    ap.add_argument("--settle", type=float, default=SETTLE_SECONDS,
+                    help="Sekunder en fil ska vara oförändrad innan den bearbetas")
+    ap.add_argument("--once", action="store_true",
+                    help="Bearbeta det som finns och avsluta (utan att vänta på --settle)")
+    return ap.parse_known_args(argv)
+
+def rebuild(target, files, changed, removed):
+    """target.update under en egen körrapport, som scriptens main() gör för en körning."""
+    args = target.args
+    report, profiler = korrapport.start(args.report, args.profile, args.report_memory,
+                                        script=target.script.__name__, args=vars(args), watch=True)
+    try:
+        return target.update(files, changed, removed)
+    finally:
+        korrapport.finish(report, args.report, profiler, args.profile)
+
+def watch(target, interval=POLL_INTERVAL, settle=SETTLE_SECONDS, once=False):
+    folder = FolderWatch(target.root, 0 if once else settle)
+    print(f"👀 Bevakar {target.root} (var {interval:g} s, Ctrl+C avslutar)")
+    while True:
+        t0 = time.perf_counter()
+        changed, removed = folder.poll()
+        if once:  # två genomsökningar i rad: allt som inte ändrats däremellan är klart
+            changed, removed = folder.poll()
+        if changed or removed:
+            for path in changed:
+                print(f"📥 {path}")
+            for path in removed:
+                print(f"🗑️ {path}")
+            if rebuild(target, sorted(folder.ready), changed, removed):
+                print(f"⚡ Uppdaterat på {time.perf_counter() - t0:.1f} s")
+        if once:
+            return
+        time.sleep(interval)
+
+def main():
+    args, rest = parse_args()
+    target = TARGETS[args.target](rest)
+    try:
+        watch(target, args.interval, args.settle, args.once)
+    except KeyboardInterrupt:
+        print("\n👋 Avslutar bevakningen")
+    finally:
+        target.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import os
+import json
+import hashlib
+import apkgskrivare
+
+"""
+Byggmanifest för .apkg: vilka noter (GUID -> innehållshash) och vilka
+mediafiler som fanns med i förra bygget.
+
+Korten har stabila GUID:n (tenta, sida, fråga) och bilderna namnges efter
+sitt innehåll, så en jämförelse med manifestet visar exakt vad som ändrats.
+Med --delta skrivs ett paket med bara nya/ändrade noter och bilder som
+inte fanns förra gången. Anki matchar noterna på GUID vid importen och
+uppdaterar dem, så oförändrade kort och bilder behöver inte synkas om.
+
+Manifestet sparas bredvid det fullständiga paketet och skrivs om efter
+varje bygge (fullt eller delta) – importera därför varje deltapaket.
+
+open_writer() öppnar paketet innan noterna finns, så att bilderna kan
+strömmas in medan de produceras; plan() avgör sedan vilka noter som skrivs.
+"""
+
+MANIFEST_VERSION = 1
+
+def manifest_path(apkg_path):
+    """tentor.apkg -> tentor.manifest.json"""
+    return os.path.splitext(apkg_path)[0] + ".manifest.json"
+
+def delta_path(apkg_path):
+    """tentor.apkg -> tentor_delta.apkg"""
+    base, ext = os.path.splitext(apkg_path)
+    return f"{base}_delta{ext or '.apkg'}"
+
+def note_digest(note):
+    """Hash av det som importen uppdaterar: modell, fält och taggar."""
+    h = hashlib.blake2b(digest_size=8)
+    for part in (str(note.model.model_id), *note.fields, *sorted(note.tags)):
+        h.update(part.encode("utf-8"))
+        h.update(b"\x1f")
+    return h.hexdigest()
+
+def build(decks, media_files):
+    return {
+        "version": MANIFEST_VERSION,
+        "notes": {note.guid: note_digest(note) for deck in decks for note in deck.notes},
+        "media": sorted({os.path.basename(p) for p in media_files}),
+    }
+
+def load(path):
+    """Förra byggets manifest, eller None om det saknas eller inte går att läsa."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return manifest if manifest.get("version") == MANIFEST_VERSION else None
+
+def save(path, manifest):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1, ensure_ascii=False)
+    os.replace(tmp, path)
+
+def delta(decks, media_files, previous):
+    """Bara det som ändrats sedan previous: (decks, media, antal borttagna noter).
+
+    Decken kopieras med samma id och namn men bara nya/ändrade noter; tomma
+    deck tas bort. Bilder som fanns förra gången är redan i Anki och hoppas
+    över (namnet är innehållet). Utan tidigare manifest blir allt nytt.
+    """
+    import genanki
+    old_notes = previous["notes"] if previous else {}
+    old_media = set(previous["media"]) if previous else set()
+    changed, current = [], set()
+    for deck in decks:
+        notes = [n for n in deck.notes if old_notes.get(n.guid) != note_digest(n)]
+        current.update(n.guid for n in deck.notes)
+        if notes:
+            d = genanki.Deck(deck.deck_id, deck.name)
+            d.notes = notes
+            changed.append(d)
+    media = [p for p in media_files if os.path.basename(p) not in old_media]
+    removed = len(set(old_notes) - current)
+    return changed, media, removed
+
+def plan(decks, media_files, apkg_path, use_delta=False):
+    """Vad som ska skrivas: (decks, media, sökväg, nytt manifest).
+
+    Utan use_delta är det hela paketet; med use_delta jämförs mot manifestet
+    bredvid apkg_path och ett deltapaket planeras. Spara manifestet med
+    save(manifest_path(apkg_path), manifest) när paketet skrivits.
+    """
+    manifest = build(decks, media_files)
+    if not use_delta:
+        return decks, media_files, apkg_path, manifest
+    previous = load(manifest_path(apkg_path))
+    if previous is None:
+        print(f"ℹ️ Inget tidigare manifest ({manifest_path(apkg_path)}) – deltapaketet innehåller allt")
+    decks, media, removed = delta(decks, media_files, previous)
+    n_notes = sum(len(d.notes) for d in decks)
+    print(f"🔁 Delta: {n_notes} nya/ändrade kort av {len(manifest['notes'])}, "
+          f"{len(media)} nya bilder av {len(manifest['media'])}")
+    if removed:
+        print(f"⚠️ {removed} kort finns inte längre i bygget men ligger kvar i Anki (ta bort dem där)")
+    return decks, media, delta_path(apkg_path), manifest
+
+def open_writer(apkg_path, use_delta=False, timestamp=None):
+    """ApkgWriter för bygget: hela paketet, eller med use_delta deltapaketet.
+
+    I deltaläget hoppar skrivaren över bilder som fanns i förra manifestet,
+    samma urval som delta() gör.
+    """
+    if not use_delta:
+        return apkgskrivare.ApkgWriter(apkg_path, timestamp)
+    previous = load(manifest_path(apkg_path))
+    skip = previous["media"] if previous else ()
+    return apkgskrivare.ApkgWriter(delta_path(apkg_path), timestamp, skip=skip)
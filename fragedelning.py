@@ -0,0 +1,54 @@
+import numpy as np
+
+"""
+Delar upp en tentasida i frågor så att varje fråga kan bli ett eget kort.
+
+Frågorna hittas på vita mellanrum: rader utan bläck (utanför sidmarginalerna)
+som är högre än min_gap_pt skiljer två frågor åt. Mellanrummen mellan
+svarsalternativ och mellan rubrik och alternativ är mindre än så. För korta
+band (lösa rubriker, sidnummer) slås ihop med grannen.
+
+Alla mått anges i punkter (1/72 tum) och räknas om med bildens DPI, så samma
+inställning fungerar oavsett renderingsupplösning.
+"""
+
+QUESTION_GAP_PT = 24     # vitt mellanrum som skiljer två frågor åt
+MIN_QUESTION_PT = 40     # kortare band slås ihop med grannen
+QUESTION_PAD_PT = 6      # marginal runt varje utklippt fråga
+INK_THRESHOLD = 200      # gråvärde under detta räknas som bläck
+MARGIN_PERC = 4          # ignorera sidans vänster-/högerkant (hålslag, sidnummer i kanten)
+
+def find_question_bands(gray, dpi, min_gap_pt=QUESTION_GAP_PT, min_height_pt=MIN_QUESTION_PT,
+                        pad_pt=QUESTION_PAD_PT, ink_threshold=INK_THRESHOLD, margin_perc=MARGIN_PERC):
+    """Returnera (y1, y2) i pixlar för varje fråga på sidan, uppifrån och ned.
+
+    gray är sidan i gråskala (eller BGR/RGB, då används minsta kanalen).
+    En sida utan tydliga mellanrum ger ett enda band (hela innehållet).
+    """
+    if gray.ndim == 3:
+        gray = gray.min(axis=2)
+    H, W = gray.shape[:2]
+    px = dpi / 72.0
+    m = int(W * margin_perc / 100)
+    ink = np.flatnonzero((gray[:, m:W - m] < ink_threshold).any(axis=1))
+    if not ink.size:
+        return []
+
+    # Sammanhängande bläckblock, delade där mellanrummet är minst min_gap
+    gaps = np.flatnonzero(np.diff(ink) > min_gap_pt * px)
+    starts = np.concatenate(([ink[0]], ink[gaps + 1]))
+    ends = np.concatenate((ink[gaps], [ink[-1]])) + 1
+
+    min_height = min_height_pt * px
+    bands = []
+    for y1, y2 in zip(starts.tolist(), ends.tolist()):
+        if bands and bands[-1][1] - bands[-1][0] < min_height:
+            bands[-1] = (bands[-1][0], y2)  # kort band (t.ex. rubrik) hör till nästa
+        else:
+            bands.append((y1, y2))
+    if len(bands) > 1 and bands[-1][1] - bands[-1][0] < min_height:
+        last = bands.pop()  # kort sista band (sidfot) hör till föregående
+        bands[-1] = (bands[-1][0], last[1])
+
+    pad = int(round(pad_pt * px))
+    return [(max(0, y1 - pad), min(H, y2 + pad)) for y1, y2 in bands]
@@ -0,0 +1,237 @@
+import os
+import csv
+import sys
+import json
+import time
+import pstats
+import cProfile
+import platform
+import threading
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+"""
+Körrapport: tid, CPU-tid och minne per steg och sida, plus utfall per sida.
+
+Koden mäter med korrapport.stage("rasterize") och noterar utfall med
+korrapport.event("no_tick"). Båda går till den aktiva rapporten, som är
+avstängd (no-op) tills ett script aktiverar en med --report. Per sida samlas
+rader i en egen delrapport (capture) som följer med sidans resultat tillbaka
+från arbetsprocesserna och läggs in i huvudrapporten. Delrapporten är aktiv
+per tråd (use), så sidor i olika steg av sidflode.pipeline blandas inte ihop.
+
+Per steg mäts väggtid, CPU-tid (hela processen, alltså även andra trådars
+arbete när steg överlappar) och processens topp-RSS.
+Med trace_memory mäts även toppen av allokerat minne inom steget
+(tracemalloc, inkl. numpy-buffertar) – det kostar tid och är därför valfritt.
+
+Rapporten skrivs som JSON (allt, plus sammanfattning per steg) eller CSV
+(en rad per steg/händelse) beroende på filändelsen.
+"""
+
+def peak_rss_mb():
+    """Processens topp-RSS i MB (ru_maxrss är KB på Linux, byte på macOS)."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+class RunReport:
+    """Samlar stegmätningar och händelser för en körning (eller en sida)."""
+
+    def __init__(self, enabled=True, trace_memory=False, page=None):
+        self.enabled = enabled
+        self.trace_memory = trace_memory
+        self.page = page
+        self.stages = []
+        self.events = []
+        self.meta = {}
+        self._peaks = []  # tracemalloc-toppar för pågående (nästlade) steg
+        self._t0 = time.perf_counter()
+
+    def child(self, page=None):
+        """Tom rapport med samma inställningar, för en sida."""
+        return RunReport(self.enabled, self.trace_memory, page)
+
+    @contextmanager
+    def stage(self, name, page=None, **info):
+        if not self.enabled:
+            yield
+            return
+        tracing = self.trace_memory and tracemalloc.is_tracing()
+        if tracing:
+            # Nästlade steg: yttre stegets topp hittills sparas innan toppen nollställs
+            current, peak = tracemalloc.get_traced_memory()
+            if self._peaks:
+                self._peaks[-1][1] = max(self._peaks[-1][1], peak)
+            self._peaks.append([current, 0])
+            tracemalloc.reset_peak()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            row = {
+                "stage": name,
+                "page": self.page if page is None else page,
+                "wall_ms": round((time.perf_counter() - wall) * 1000, 2),
+                "cpu_ms": round((time.process_time() - cpu) * 1000, 2),
+                "rss_mb": round(peak_rss_mb() or 0, 1),
+            }
+            if tracing:
+                start, inner = self._peaks.pop()
+                peak = max(tracemalloc.get_traced_memory()[1], inner)
+                row["alloc_peak_mb"] = round(max(0, peak - start) / 1e6, 2)
+                if self._peaks:
+                    self._peaks[-1][1] = max(self._peaks[-1][1], peak)
+            row.update(info)
+            self.stages.append(row)
+
+    def event(self, kind, page=None, **info):
+        """Utfall, t.ex. no_tick, few_circles, pdf_marks, fallback."""
+        if self.enabled:
+            self.events.append({"event": kind, "page": self.page if page is None else page, **info})
+
+    def rows(self):
+        """Allt som samlats, i en form som kan skickas mellan processer."""
+        return {"stages": self.stages, "events": self.events}
+
+    def extend(self, rows):
+        if rows:
+            self.stages.extend(rows["stages"])
+            self.events.extend(rows["events"])
+
+    def summary(self):
+        """Per steg: antal, total/medel/max väggtid, CPU-tid och långsammaste sidan."""
+        out = {}
+        for row in self.stages:
+            s = out.setdefault(row["stage"], {"count": 0, "wall_ms": 0.0, "cpu_ms": 0.0,
+                                              "max_ms": 0.0, "slowest_page": None})
+            s["count"] += 1
+            s["wall_ms"] += row["wall_ms"]
+            s["cpu_ms"] += row["cpu_ms"]
+            if row["wall_ms"] >= s["max_ms"]:
+                s["max_ms"], s["slowest_page"] = row["wall_ms"], row["page"]
+            if "alloc_peak_mb" in row:
+                s["alloc_peak_mb"] = max(s.get("alloc_peak_mb", 0), row["alloc_peak_mb"])
+        for s in out.values():
+            s["mean_ms"] = round(s["wall_ms"] / s["count"], 2)
+            s["wall_ms"], s["cpu_ms"] = round(s["wall_ms"], 2), round(s["cpu_ms"], 2)
+        return out
+
+    def event_counts(self):
+        counts = {}
+        for e in self.events:
+            counts[e["event"]] = counts.get(e["event"], 0) + 1
+        return counts
+
+    def print_summary(self):
+        if not self.enabled or not (self.stages or self.events):
+            return
+        print("⏱️ Steg (total / per gång / långsammast):")
+        for name, s in self.summary().items():
+            slowest = f" (sida {s['slowest_page']})" if s["slowest_page"] is not None else ""
+            mem = f", topp {s['alloc_peak_mb']:.0f} MB" if "alloc_peak_mb" in s else ""
+            print(f"  {name:<14} {s['count']:4d} × {s['mean_ms']:8.1f} ms = {s['wall_ms'] / 1000:7.2f} s, "
+                  f"max {s['max_ms']:.0f} ms{slowest}{mem}")
+        counts = self.event_counts()
+        if counts:
+            print("📊 Utfall: " + ", ".join(f"{k} {v}" for k, v in sorted(counts.items())))
+
+    def write(self, path):
+        """JSON (allt + sammanfattning) eller CSV (en rad per steg/händelse)."""
+        if path.lower().endswith(".csv"):
+            fields = ["type", "name", "page", "wall_ms", "cpu_ms", "rss_mb", "alloc_peak_mb", "detail"]
+            with open(path, "w", newline="", encoding="utf-8") as f:
+                writer = csv.DictWriter(f, fieldnames=fields)
+                writer.writeheader()
+                base = {"stage", "page", "wall_ms", "cpu_ms", "rss_mb", "alloc_peak_mb"}
+                for row in self.stages:
+                    extra = {k: v for k, v in row.items() if k not in base}
+                    writer.writerow({"type": "stage", "name": row["stage"], "detail": json.dumps(extra) if extra else "",
+                                     **{k: row.get(k) for k in fields if k in base}})
+                for e in self.events:
+                    extra = {k: v for k, v in e.items() if k not in ("event", "page")}
+                    writer.writerow({"type": "event", "name": e["event"], "page": e["page"],
+                                     "detail": json.dumps(extra) if extra else ""})
+            return
+        data = {
+            "meta": {**self.meta, "python": platform.python_version(), "platform": platform.platform(),
+                     "cpus": os.cpu_count(), "total_s": round(time.perf_counter() - self._t0, 3),
+                     "peak_rss_mb": round(peak_rss_mb() or 0, 1)},
+            "summary": self.summary(),
+            "event_counts": self.event_counts(),
+            "stages": self.stages,
+            "events": self.events,
+        }
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2, ensure_ascii=False, default=str)
+
+# Processens rapport (avstängd tills ett script aktiverar en) och trådens delrapport
+_root = RunReport(enabled=False)
+_local = threading.local()
+
+def active():
+    return getattr(_local, "report", None) or _root
+
+def activate(report):
+    """Gör report till processens rapport. Används även som initializer i processpooler."""
+    global _root
+    _root = report
+    if report.enabled and report.trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    return report
+
+def stage(name, page=None, **info):
+    """Mät ett steg i den aktiva rapporten (no-op när rapporten är avstängd)."""
+    report = active()
+    return report.stage(name, page, **info) if report.enabled else nullcontext()
+
+def event(kind, page=None, **info):
+    active().event(kind, page, **info)
+
+@contextmanager
+def use(report):
+    """Gör report aktiv i den här tråden (t.ex. en sidas delrapport i ett pipelinesteg)."""
+    parent = getattr(_local, "report", None)
+    _local.report = report
+    try:
+        yield report
+    finally:
+        _local.report = parent
+
+def capture(page=None):
+    """Samla steg och händelser för en sida i en egen delrapport.
+
+    Delrapportens rows() skickas med sidans resultat (även från en
+    arbetsprocess) och läggs in i huvudrapporten med extend.
+    """
+    return use(active().child(page))
+
+def start(path=None, profile=None, trace_memory=False, **meta):
+    """Aktivera en rapport för hela körningen om path eller profile är satt.
+
+    Returnerar (rapport, profiler). Avsluta med finish.
+    """
+    report = activate(RunReport(enabled=bool(path or profile), trace_memory=trace_memory))
+    report.meta.update(meta)
+    profiler = None
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    return report, profiler
+
+def finish(report, path=None, profiler=None, profile=None):
+    """Skriv ut sammanfattningen och spara rapport/profil."""
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(profile)
+        print(f"🔬 Profil: {profile} (huvudprocessen; visa med python -m pstats {profile})")
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(15)
+    report.print_summary()
+    if path:
+        report.write(path)
+        print(f"📝 Körrapport: {path}")
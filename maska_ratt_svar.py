@@ -1,30 +1,78 @@
 import os
+import re
 import sys
+import glob
+import math
+import hashlib
+import time
+import struct
 import argparse
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 import cv2
 import numpy as np
 import fitz  # PyMuPDF
-from PIL import Image
+from mediakodning import FORMATS, EncodeStats, encode_image, extension, image_size
+from renderingscache import RenderCache, DEFAULT_CACHE_DIR, DEFAULT_MAX_MB, DEFAULT_MAX_AGE_DAYS
+from fragedelning import QUESTION_GAP_PT, find_question_bands
+from pdfmarkeringar import find_pdf_marks
+from parning import find_exam_pdfs, is_facit, match_pairs
+import korrapport
+import byggmanifest
+import sidlayout
+import sidbuffertar
+from sidflode import pipeline
 
 """
 Maskar PDF-sidor och exporterar PNG + ny PDF.
 Lägen:
   - mode=column  -> ritar en smal vertikal svart stapel vid svarsalternativen
   - mode=green   -> (som innan) hittar grönt och täcker
+  - mode=diff    -> jämför med tentan utan facit (--utan) och täcker allt facit lägger till;
+                    kräver ingen HSV- eller kolumntrimning per tenta
 
 Exempel:
   python3 maska_ratt_svar.py "Rest Tentamen - Basvetenskap 3 - VT2022.pdf" out/ \
     --skip-pages 4 --mode column --col-x-perc 82 --col-width 28 --col-top-perc 18 --col-bot-perc 68
+
+  --stream rasteriserar och maskar i minnet utan att gå via PNG på disk.
+  --workers N sprider rasterisering+maskning över N processer (sidordningen behålls).
+  Maskade sidor cachas (se renderingscache.py); --no-cache maskar om allt.
+  --media-format/--media-quality/--budget-mb styr kodningen (se mediakodning.py).
+  --vector maskar originalsidorna direkt (text behålls, liten PDF, ingen rasterisering).
+  Med en mapp eller glob som pdf_path maskas alla tentor i en körning (batchläge):
+  en undermapp per tenta i out_dir, försättssidor hittas per fil och --build-apkg
+  ger ett samlat .apkg med en underlek per tenta.
+  Detektionen körs i --analysis-dpi (default 110); maskerna skalas upp och ritas i --dpi.
+  Digitala PDF:er läses i första hand ur PDF-strukturen (--detect auto, se pdfmarkeringar.py).
+  I replicate-läget letas radioknappar i ett band kring bocken (--circle-detector auto);
+  HoughCircles över hela sidan används bara som reserv.
 """
 
-def parse_args():
+DEFAULT_APKG = "bv3_maskad.apkg"
+DEFAULT_BATCH_APKG = "maskade_tentor.apkg"
+MAX_AUTO_SKIP = 10  # längst in --skip-pages auto letar efter första facitsidan
+
+def _skip_pages_arg(value):
+    if value == "auto":
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("ange ett antal sidor eller 'auto'")
+
+def parse_args(argv=None):
     ap = argparse.ArgumentParser()
-    ap.add_argument("pdf_path", help="Path to input PDF")
+    ap.add_argument("pdf_path", help="Path to input PDF, or a directory/glob for batch mode")
     ap.add_argument("out_dir", help="Output dir")
     ap.add_argument("--dpi", type=int, default=220, help="Rasterization DPI (default: 220)")
-    ap.add_argument("--skip-pages", type=int, default=0, help="Hoppa över första N sidor")
-    ap.add_argument("--mode", choices=["column","green","replicate"], default="replicate",
-                    help="column = vertikal stapel, green = maska grönt, replicate = hitta bock och replikerar svarta boxar på alla alternativ")
+    ap.add_argument("--skip-pages", type=_skip_pages_arg, default=None, dest="skip_pages",
+                    help="Hoppa över första N sidor, eller 'auto' = sidorna före första facitmarkeringen "
+                         "(default 0, i batchläge auto)")
+    ap.add_argument("--mode", choices=["column","green","replicate","diff"], default="replicate",
+                    help="column = vertikal stapel, green = maska grönt, replicate = hitta bock och replikerar svarta boxar på alla alternativ, "
+                         "diff = maska det facit lägger till jämfört med --utan")
 
     # Kolumnmaskning (procent av bildmått)
     ap.add_argument("--col-x-perc", type=float, default=82.0, help="X-position i procent av bredd (0–100)")
@@ -41,7 +89,24 @@ def parse_args():
     ap.add_argument("--th-low", type=int, default=20, help="Canny low threshold")
     ap.add_argument("--th-high", type=int, default=80, help="Canny high threshold")
     ap.add_argument("--line-thickness", type=int, default=12, help="Mask thickness for Hough lines")
+    ap.add_argument("--detect", choices=["auto","pdf","pixel"], default="auto",
+                    help="auto = läs bock/knappar ur PDF-strukturen (vektorer, text, annotationer) och analysera "
+                         "pixlar bara för sidor där det inte går (skannade); pdf/pixel = bara det ena")
+    ap.add_argument("--roi-scale", type=float, default=0.25, dest="roi_scale",
+                    help="Skala för grov grön-sökning innan full upplösning i kandidatregioner (1 = hela sidan i full upplösning)")
     
+    # Diff mot tentan utan facit (mode=diff)
+    ap.add_argument("--utan", default=None, help="PDF utan facit (samma tenta) för mode=diff")
+    ap.add_argument("--diff-thresh", type=int, default=60, dest="diff_thresh",
+                    help="Min mörkning (0–255) i någon kanal för att räknas som tillagt bläck")
+    ap.add_argument("--diff-min-area", type=int, default=30, dest="diff_min_area",
+                    help="Min area (px) för en diff-region")
+    ap.add_argument("--diff-pad", type=int, default=6, dest="diff_pad",
+                    help="Marginal (px) runt varje diff-region")
+    ap.add_argument("--diff-fill", choices=["black","utan"], default="utan", dest="diff_fill",
+                    help="utan = fyll regionerna med sidan utan facit (avslöjar inte vilket alternativ som maskats), "
+                         "black = svarta boxar (rutan pekar ut rätt svar)")
+
     # Replikationsparametrar
     ap.add_argument("--rep-box-expand", type=float, default=1.2, dest="rep_box_expand", help="Skala på bockens box (1.0 = samma)")
     ap.add_argument("--rep-x-shift", type=int, default=0, dest="rep_x_shift", help="Flytta boxarna lite i x-led (px) om behövs")
@@ -55,162 +120,569 @@ def parse_args():
     ap.add_argument("--hc-param2", type=int, default=20, dest="hc_param2")
     ap.add_argument("--hc-min-radius", type=int, default=8, dest="hc_min_radius")
     ap.add_argument("--hc-max-radius", type=int, default=18, dest="hc_max_radius")
+    ap.add_argument("--circle-detector", choices=["auto","fast","hough"], default="auto", dest="circle_detector",
+                    help="auto = ringar i band kring bocken, HoughCircles över hela sidan som reserv; fast/hough = bara den ena")
+    ap.add_argument("--circle-band", type=int, default=0, dest="circle_band",
+                    help="Halva bandbredden (px) kring bockens x för snabbdetektorn (0 = auto)")
+    ap.add_argument("--no-layout", action="store_true", dest="no_layout",
+                    help="Lär inte in tentans layout (kolumn, ringradie, radavstånd) – full detektion på varje sida")
     
+    # Vektormaskning direkt i käll-PDF:en
+    ap.add_argument("--vector", action="store_true",
+                    help="Hitta maskerna på en lågupplöst bild och lägg dem som vektorer på originalsidorna "
+                         "(text och grafik behålls, ingen rasterisering av utdata)")
+    ap.add_argument("--analysis-dpi", type=int, default=None, dest="analysis_dpi",
+                    help=f"DPI för detektionen (default: {ANALYSIS_DPI}); maskerna skalas upp och ritas i --dpi. "
+                         "Pixelparametrar anges fortfarande för --dpi och räknas om. >= --dpi = analysera i full upplösning "
+                         "(alltid i --mode diff)")
+    ap.add_argument("--vector-style", choices=["redact","fill"], default="redact", dest="vector_style",
+                    help="redact = ta bort text/grafik under maskerna, fill = bara rita svarta rutor ovanpå")
+
     ap.add_argument("--build-apkg", action="store_true", help="Bygg Anki .apkg efter maskning")
-    return ap.parse_args()
+    ap.add_argument("--apkg", default=None,
+                    help=f"Sökväg för .apkg (default {DEFAULT_APKG}, i batchläge out_dir/{DEFAULT_BATCH_APKG})")
+    ap.add_argument("--delta", action="store_true",
+                    help="Skriv bara nya/ändrade kort och bilder sedan förra bygget (<apkg>_delta.apkg, "
+                         "jämfört med <apkg>.manifest.json)")
+    ap.add_argument("--split-questions", action="store_true", dest="split_questions",
+                    help="Ett kort per fråga i .apkg: sidorna delas på vita mellanrum (se fragedelning.py)")
+    ap.add_argument("--question-gap", type=float, default=QUESTION_GAP_PT, dest="question_gap",
+                    help=f"Minsta vita mellanrum (punkter) mellan två frågor (default: {QUESTION_GAP_PT})")
+    ap.add_argument("--stream", action="store_true",
+                    help="Rasterisera och maska i minnet (ingen PNG-rundtur), koda varje bild en gång")
+    ap.add_argument("--workers", type=int, default=1,
+                    help="Antal processer för rasterisering+maskning (>1 innebär --stream)")
+    ap.add_argument("--max-in-flight", type=int, default=0, dest="max_in_flight",
+                    help="Max antal sidor under bearbetning samtidigt (0 = 2 × workers)")
+    ap.add_argument("--pipeline-depth", type=int, default=2, dest="pipeline_depth",
+                    help="Sidor per kö mellan rasterisering, maskning och kodning, som körs överlappande "
+                         "i trådar (0 = stegen efter varandra)")
+    ap.add_argument("--threads", type=int, default=1,
+                    help="Trådar för maskning respektive kodning i sidflödet (OpenCV och zlib släpper GIL:en)")
+    ap.add_argument("--bench-workers", action="store_true", dest="bench_workers",
+                    help="Mät sidor/s för 1..--workers processer utan att skriva utdata")
+
+    # Mediakodning av sidbilderna (PDF:en i --vector påverkas inte)
+    ap.add_argument("--media-format", choices=FORMATS, default="png", dest="media_format",
+                    help="Bildformat för sidbilder/.apkg-media i alla lägen (webp bäddas in som jpeg i den "
+                         "rasteriserade PDF:en)")
+    ap.add_argument("--media-quality", type=int, default=None, dest="media_quality",
+                    help="Kvalitet 1–100 (jpeg/webp; för png-palette styr den antal färger)")
+    ap.add_argument("--budget-mb", type=float, default=0, dest="budget_mb",
+                    help="Byte-budget för alla sidbilder; kvaliteten justeras per bild")
+    ap.add_argument("--encode-report", default=None, dest="encode_report",
+                    help="Skriv storlek och kodningstid per bild till denna CSV-fil")
+
+    # Renderingscache (gäller --stream/--workers)
+    ap.add_argument("--no-cache", action="store_true", dest="no_cache",
+                    help="Maska om alla sidor utan att läsa eller skriva renderingscachen")
+    ap.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, dest="cache_dir")
+    ap.add_argument("--cache-max-mb", type=float, default=DEFAULT_MAX_MB, dest="cache_max_mb",
+                    help="Rensa äldsta cachade sidor när cachen överstiger detta (0 = ingen gräns)")
+    ap.add_argument("--cache-max-age-days", type=float, default=DEFAULT_MAX_AGE_DAYS, dest="cache_max_age_days",
+                    help="Rensa cachade sidor som inte använts på N dagar (0 = ingen gräns)")
+
+    # Körrapport (se korrapport.py)
+    ap.add_argument("--report", default=None,
+                    help="Skriv tid, CPU-tid och minne per steg och sida samt utfall per sida till "
+                         "denna fil (.json eller .csv)")
+    ap.add_argument("--report-memory", action="store_true", dest="report_memory",
+                    help="Mät även allokerat toppminne per steg (tracemalloc, kostar tid)")
+    ap.add_argument("--profile", default=None,
+                    help="Kör huvudprocessen under cProfile och spara statistiken till denna fil")
+    args = ap.parse_args(argv)
+    if args.mode == "diff" and not args.utan and not is_batch_input(args.pdf_path):
+        ap.error("--mode diff kräver --utan <pdf utan facit> (i batchläget paras de på filnamnet)")
+    return args
+
+# Pixelparametrar (anges för --dpi) som skalas om när analysen görs i annan upplösning
+_PIXEL_LENGTH_ARGS = ("line_thickness", "col_width", "hc_min_dist", "hc_min_radius", "hc_max_radius",
+                      "circle_band", "diff_pad", "rep_x_shift", "rep_y_shift")
+_PIXEL_AREA_ARGS = ("min_area", "diff_min_area")
+
+def scale_pixel_args(args, factor):
+    """Kopia av args med pixelparametrarna omräknade med factor (t.ex. analys-DPI / --dpi)."""
+    scaled = argparse.Namespace(**vars(args))
+    for name, f in [(n, factor) for n in _PIXEL_LENGTH_ARGS] + [(n, factor * factor) for n in _PIXEL_AREA_ARGS]:
+        value = getattr(args, name)
+        setattr(scaled, name, max(1, round(value * f)) if value > 0 else round(value * f))
+    scaled.layout = sidlayout.scale_layout(getattr(args, "layout", None), factor)
+    return scaled
+
+# Höjs när maskningskoden ger andra pixlar för samma parametrar, så att
+# cachade sidor och layoutprofiler från tidigare versioner inte används
+CACHE_VERSION = 1
+
+# Argument som inte påverkar de maskade pixlarna och därför inte ingår i cachenyckeln.
+# skip_pages ingår: layouten lärs in från sidorna efter försättssidorna.
+_NON_MASK_ARGS = {
+    "pdf_path", "out_dir", "build_apkg", "stream", "workers", "max_in_flight",
+    "bench_workers", "no_cache", "cache_dir", "cache_max_mb", "cache_max_age_days",
+    "encode_report", "utan", "vector", "vector_style", "split_questions", "question_gap",
+    "report", "report_memory", "profile", "pipeline_depth", "threads", "delta", "apkg",
+    "layout",  # härleds ur PDF:en och övriga argument
+}
+
+def mask_params(args):
+    """Alla parametrar som påverkar en maskad sida (DPI, mode, HSV, Hough ...) och CACHE_VERSION."""
+    params = {k: v for k, v in sorted(vars(args).items()) if k not in _NON_MASK_ARGS}
+    params["cache_version"] = CACHE_VERSION
+    return params
+
+def is_mask_param(name):
+    """Påverkar argumentet name den maskade sidan (ingår i mask_params)?"""
+    return name not in _NON_MASK_ARGS
 
-def pdf_to_images(pdf_path, dpi, out_dir_img, skip_pages):
-    os.makedirs(out_dir_img, exist_ok=True)
+# Format som MuPDF kan bädda in i PDF:en direkt (webp kodas om till jpeg för PDF:en)
+ANALYSIS_DPI = 110  # räcker för att hitta bockar och radioknappar
+
+PDF_EMBEDDABLE = {"png", "png-gray", "png-palette", "jpeg"}
+
+# Sidbuffertar som återanvänds mellan sidorna i den här processen (sidbuffertar.py)
+PAGE_BUFFERS = sidbuffertar.BufferPool()
+
+def pixmap_to_bgr(pix, buffers=None):
+    """Gör om en fitz.Pixmap (RGB, utan alfa) till en BGR-array utan PNG-rundtur.
+
+    Samples läses som en vy via pix.samples_mv (ingen kopia); enda passet över
+    pixlarna är kanalbytet RGB -> BGR, vilket ersätter imread-avkodningen.
+    Med buffers (en BufferPool) skrivs resultatet i en återanvänd buffert.
+    """
+    rgb = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.h, pix.w, pix.n)
+    out = buffers.take((pix.h, pix.w, 3)) if buffers is not None else None
+    return cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR, dst=out)
+
+def iter_pdf_pages(pdf_path, dpi, skip_pages):
+    """Rasterisera sidor direkt till minnet. Ger (sidnummer, bgr) en sida i taget."""
     doc = fitz.open(pdf_path)
-    images = []
-    for i, page in enumerate(doc):
-        if i < skip_pages:
-            continue
+    try:
         mat = fitz.Matrix(dpi/72, dpi/72)
-        pix = page.get_pixmap(matrix=mat, alpha=False)
-        img_path = os.path.join(out_dir_img, f"page_{i+1:03d}.png")
-        pix.save(img_path)
-        images.append(img_path)
-    doc.close()
-    return images
-
-def mask_green(img_bgr, h1, h2, s1, v1, min_area, th_low, th_high, line_thickness):
-    img = img_bgr.copy()
-    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-    lower = np.array([h1, s1, v1], dtype=np.uint8)
-    upper = np.array([h2, 255, 255], dtype=np.uint8)
-    mask = cv2.inRange(hsv, lower, upper)
-    kernel = np.ones((3,3), np.uint8)
-    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel, iterations=1)
-    mask = cv2.morphologyEx(mask, cv2.MORPH_DILATE, kernel, iterations=1)
-    cnts, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    for c in cnts:
-        x, y, w, h = cv2.boundingRect(c)
-        if w*h >= min_area:
-            cv2.rectangle(img, (x, y), (x + w, y + h), (0, 0, 0), thickness=-1)
-    edges = cv2.Canny(mask, th_low, th_high)
-    lines = cv2.HoughLinesP(edges, 1, np.pi/180, threshold=30, minLineLength=20, maxLineGap=3)
-    if lines is not None:
-        for l in lines:
-            x1, y1, x2, y2 = l[0]
-            cv2.line(img, (x1, y1), (x2, y2), (0, 0, 0), thickness=line_thickness)
+        for i in range(skip_pages, doc.page_count):
+            pix = doc[i].get_pixmap(matrix=mat, alpha=False)
+            yield i + 1, pixmap_to_bgr(pix)
+    finally:
+        doc.close()
+
+def write_bytes(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+def read_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def png_image_xref(pdf_doc, png_bytes):
+    """Bädda in en PNG i pdf_doc utan att avkoda den; returnerar xref eller 0.
+
+    PNG:ens IDAT-data är redan en FlateDecode-ström med PNG-prediktorer, så den
+    kan läggas in som bildobjekt direkt. Gäller 8-bitars grå/RGB utan interlace
+    (det cv2 skriver); andra varianter (palett, alfa) returnerar 0.
+    """
+    if png_bytes[:8] != b"\x89PNG\r\n\x1a\n":
+        return 0
+    pos, idat, header = 8, [], None
+    while pos + 8 <= len(png_bytes):
+        length, kind = struct.unpack(">I4s", png_bytes[pos:pos + 8])
+        body = png_bytes[pos + 8:pos + 8 + length]
+        pos += 12 + length
+        if kind == b"IHDR":
+            header = struct.unpack(">IIBBBBB", body)
+        elif kind == b"IDAT":
+            idat.append(body)
+        elif kind == b"IEND":
+            break
+    if header is None or not idat:
+        return 0
+    width, height, depth, color_type, _, _, interlace = header
+    if depth != 8 or interlace or color_type not in (0, 2):
+        return 0
+    colors = 3 if color_type == 2 else 1
+    xref = pdf_doc.get_new_xref()
+    pdf_doc.update_object(xref, "<<>>")
+    pdf_doc.update_stream(xref, b"".join(idat), compress=False)
+    # Nycklarna sätts efter strömmen; update_stream skriver om Filter/DecodeParms
+    for key, value in (("Type", "/XObject"), ("Subtype", "/Image"),
+                       ("Width", str(width)), ("Height", str(height)), ("BitsPerComponent", "8"),
+                       ("ColorSpace", "/DeviceRGB" if colors == 3 else "/DeviceGray"),
+                       ("Filter", "/FlateDecode"),
+                       ("DecodeParms", f"<</Predictor 15/Colors {colors}/BitsPerComponent 8/Columns {width}>>")):
+        pdf_doc.xref_set_key(xref, key, value)
+    return xref
+
+def append_image_page(pdf_doc, png_bytes, width_px, height_px, dpi):
+    """Lägg till en sida i pdf_doc med bilden i originalsidans storlek (punkter).
+
+    Vanliga PNG:er bäddas in som de är (png_image_xref). Övriga bilder läggs in
+    via MuPDF; okomprimerade bildströmmar deflateras direkt så att dokumentet
+    inte håller råa pixlar för alla sidor fram till save().
+    """
+    page = pdf_doc.new_page(width=width_px * 72 / dpi, height=height_px * 72 / dpi)
+    xref = png_image_xref(pdf_doc, png_bytes)
+    if xref:
+        page.insert_image(page.rect, xref=xref)
+        return page
+    xref = page.insert_image(page.rect, stream=png_bytes)
+    if pdf_doc.xref_get_key(xref, "Filter")[0] == "null":
+        pdf_doc.update_stream(xref, pdf_doc.xref_stream_raw(xref), compress=True)
+    return page
+
+class PageAnalysis:
+    """Delad analys av en sida: grön mask och gråskala räknas ut en gång per sida.
+
+    Grönt letas först i en nedskalad kopia (roi_scale) med något lösare trösklar;
+    bara kandidatregionerna konverteras till HSV, tröskas och morfologibehandlas
+    i full upplösning. En A4-sida är mest vitt papper, så det mesta av bilden
+    behöver aldrig HSV-konverteras. Streck tunnare än ungefär 1/roi_scale px kan
+    missas i grovsökningen; roi_scale >= 1 ger den gamla helsidesanalysen.
+    """
+
+    def __init__(self, img_bgr, h1=35, h2=85, s1=40, v1=40, roi_scale=0.25, roi_pad=12, gray=None):
+        self.img = img_bgr
+        self.lower = np.array([h1, s1, v1], dtype=np.uint8)
+        self.upper = np.array([h2, 255, 255], dtype=np.uint8)
+        self.roi_scale = roi_scale
+        self.roi_pad = roi_pad
+        self._gray = gray  # kan delas mellan analyser av samma bild med olika HSV-intervall
+        self._rois = None
+        self._green_boxes = None
+
+    @property
+    def gray(self):
+        if self._gray is None:
+            self._gray = cv2.cvtColor(self.img, cv2.COLOR_BGR2GRAY)
+        return self._gray
+
+    def _candidate_rects(self):
+        H, W = self.img.shape[:2]
+        if self.roi_scale >= 1:
+            return [(0, 0, W, H)]
+        s = self.roi_scale
+        small = cv2.resize(self.img, None, fx=s, fy=s, interpolation=cv2.INTER_LINEAR)
+        # Tunna streck blandas med vitt vid nedskalning – halvera mättnads-/ljuströsklarna
+        lower = self.lower.copy()
+        lower[1:] //= 2
+        cand = cv2.inRange(cv2.cvtColor(small, cv2.COLOR_BGR2HSV), lower, self.upper)
+        n, _, stats, _ = cv2.connectedComponentsWithStats(cand, connectivity=8)
+        pad = self.roi_pad + int(np.ceil(1 / s))
+        rects = [(max(0, int(x / s) - pad), max(0, int(y / s) - pad),
+                  min(W, int((x + w) / s) + pad), min(H, int((y + h) / s) + pad))
+                 for x, y, w, h, _ in stats[1:n]]
+        return _merge_rects(rects)
+
+    @property
+    def rois(self):
+        """Lista av (x1, y1, x2, y2, råmask, morfmask) för varje kandidatregion.
+
+        råmask = inRange i full upplösning, morfmask = efter öppning + dilatering
+        (som green_shapes/find_green_tick_bbox alltid gjort). Regionerna överlappar inte.
+        """
+        if self._rois is None:
+            kernel = np.ones((3,3), np.uint8)
+            self._rois = []
+            for x1, y1, x2, y2 in self._candidate_rects():
+                hsv = cv2.cvtColor(self.img[y1:y2, x1:x2], cv2.COLOR_BGR2HSV)
+                raw = cv2.inRange(hsv, self.lower, self.upper)
+                if not raw.any():
+                    continue
+                morph = cv2.morphologyEx(raw, cv2.MORPH_OPEN, kernel, iterations=1)
+                morph = cv2.morphologyEx(morph, cv2.MORPH_DILATE, kernel, iterations=1)
+                self._rois.append((x1, y1, x2, y2, raw, morph))
+        return self._rois
+
+    def _full(self, idx):
+        mask = np.zeros(self.img.shape[:2], dtype=np.uint8)
+        for roi in self.rois:
+            x1, y1, x2, y2 = roi[:4]
+            mask[y1:y2, x1:x2] = roi[idx]
+        return mask
+
+    @property
+    def green_raw(self):
+        """inRange-masken i full sidstorlek (noll utanför kandidatregionerna)."""
+        return self._full(4)
+
+    @property
+    def green_mask(self):
+        """Morfologibehandlad grön mask i full sidstorlek."""
+        return self._full(5)
+
+    def green_contours(self, raw=False):
+        """Konturer av gröna blobbar, i sidkoordinater."""
+        cnts = []
+        for x1, y1, x2, y2, raw_mask, morph in self.rois:
+            found, _ = cv2.findContours(raw_mask if raw else morph, cv2.RETR_EXTERNAL,
+                                        cv2.CHAIN_APPROX_SIMPLE, offset=(x1, y1))
+            cnts.extend(found)
+        return cnts
+
+    @property
+    def green_boxes(self):
+        """Bounding boxes (x,y,w,h) för alla gröna blobbar i den morfologibehandlade masken."""
+        if self._green_boxes is None:
+            self._green_boxes = [cv2.boundingRect(c) for c in self.green_contours()]
+        return self._green_boxes
+
+def _merge_rects(rects):
+    """Slå ihop överlappande rektanglar (x1,y1,x2,y2) tills inga överlappar."""
+    rects = list(rects)
+    merged = True
+    while merged:
+        merged = False
+        out = []
+        for r in rects:
+            for i, o in enumerate(out):
+                if r[0] < o[2] and o[0] < r[2] and r[1] < o[3] and o[1] < r[3]:
+                    out[i] = (min(r[0], o[0]), min(r[1], o[1]), max(r[2], o[2]), max(r[3], o[3]))
+                    merged = True
+                    break
+            else:
+                out.append(r)
+        rects = out
+    return rects
+
+def analyze_page(img_bgr, args, gray=None):
+    return PageAnalysis(img_bgr, args.h1, args.h2, args.s1, args.v1, roi_scale=args.roi_scale, gray=gray)
+
+# En maskform i pixelkoordinater. kind: "rect" (fylld, hörn inklusive som
+# cv2.rectangle), "line" (linje med tjocklek width) eller "utan" (fyll med
+# sidan utan facit, x2/y2 exklusive). Formerna ritas i pixlar (draw_shapes)
+# eller som vektorer på PDF-sidan (apply_shapes_to_page).
+Shape = namedtuple("Shape", "kind x1 y1 x2 y2 width")
+
+def rect_shape(x1, y1, x2, y2):
+    return Shape("rect", int(x1), int(y1), int(x2), int(y2), 0)
+
+def draw_shapes(img, shapes, fill_bgr=None):
+    """Rita maskformerna i img (in-place). fill_bgr används för "utan"-former."""
+    for kind, x1, y1, x2, y2, width in shapes:
+        if kind == "rect":
+            cv2.rectangle(img, (x1, y1), (x2, y2), (0, 0, 0), thickness=-1)
+        elif kind == "line":
+            cv2.line(img, (x1, y1), (x2, y2), (0, 0, 0), thickness=width)
+        elif kind == "utan" and fill_bgr is not None:
+            img[y1:y2, x1:x2] = fill_bgr[y1:y2, x1:x2]
     return img
 
-def find_green_tick_bbox(img_bgr, h1, h2, s1, v1, min_area):
+def green_shapes(analysis, min_area, th_low, th_high, line_thickness):
+    """Maskformer för mode=green: gröna boxar + Hough-linjer längs markeringarna."""
+    shapes = []
+    for x, y, w, h in analysis.green_boxes:
+        if w*h >= min_area:
+            shapes.append(rect_shape(x, y, x + w, y + h))
+    # Kanter och linjer bara inom de gröna regionerna (resten av masken är noll)
+    for rx, ry, _, _, _, mask in analysis.rois:
+        edges = cv2.Canny(mask, th_low, th_high)
+        lines = cv2.HoughLinesP(edges, 1, np.pi/180, threshold=30, minLineLength=20, maxLineGap=3)
+        if lines is not None:
+            for x1, y1, x2, y2 in lines.reshape(-1, 4):  # (N,1,4) i OpenCV 4, (N,4) i OpenCV 5
+                shapes.append(Shape("line", int(x1 + rx), int(y1 + ry), int(x2 + rx), int(y2 + ry), line_thickness))
+    return shapes
+
+def find_green_tick_bbox(img_bgr, h1, h2, s1, v1, min_area, analysis=None):
     """Returnera (x,y,w,h) för största gröna blobben (bocken/markeringen)."""
-    hsv = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2HSV)
-    lower = np.array([h1, s1, v1], dtype=np.uint8)
-    upper = np.array([h2, 255, 255], dtype=np.uint8)
-    mask = cv2.inRange(hsv, lower, upper)
-    kernel = np.ones((3,3), np.uint8)
-    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel, iterations=1)
-    mask = cv2.morphologyEx(mask, cv2.MORPH_DILATE, kernel, iterations=1)
-    cnts, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if analysis is None:
+        analysis = PageAnalysis(img_bgr, h1, h2, s1, v1)
     best = None; best_area = 0
-    for c in cnts:
-        x,y,w,h = cv2.boundingRect(c)
+    for x,y,w,h in analysis.green_boxes:
         area = w*h
         if area >= min_area and area > best_area:
             best = (x,y,w,h); best_area = area
     return best  # eller None
 
-def detect_option_circles(img_bgr, dp, min_dist, p1, p2, rmin, rmax):
-    """Hitta radioknappar (små cirklar) som markerar svarsalternativens rader."""
-    gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
+def detect_option_circles(img_bgr, dp, min_dist, p1, p2, rmin, rmax, gray=None):
+    """Hitta radioknappar (små cirklar) som markerar svarsalternativens rader.
+
+    Ursprunglig metod: HoughCircles över hela sidan och de första 5 raderna.
+    Används som reserv när find_option_circles inte hittar nog.
+    """
+    if gray is None:
+        gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
     gray = cv2.medianBlur(gray, 5)
     circles = cv2.HoughCircles(gray, cv2.HOUGH_GRADIENT, dp=dp,
                                minDist=min_dist, param1=p1, param2=p2,
                                minRadius=rmin, maxRadius=rmax)
     if circles is None:
         return []
-    circles = np.uint16(np.around(circles[0]))  # (x,y,r)
+    circles = np.around(circles[0]).astype(int)  # (x,y,r)
     
     if len(circles) == 0:
         return []
     
     # Sortera top-down på y (en rad per alternativ)
-    circles = sorted(circles, key=lambda c: c[1])
+    circles = circles[np.argsort(circles[:, 1], kind="stable")]
     
-    # Filtrera för att få exakt 5 cirklar (vanligast antal svarsalternativ)
-    # Ta de första 5 cirklarna som är tillräckligt långt ifrån varandra
+    # Ta de första 5 cirklarna (vanligast antal svarsalternativ) som är tillräckligt
+    # långt ifrån varandra i Y-led. Listan är sorterad, så det räcker att jämföra
+    # med senast valda cirkel.
     filtered_circles = []
     for circle in circles:
-        x, y, r = circle
-        # Kolla om denna cirkel är för nära en redan vald cirkel i Y-led
-        too_close = False
-        for existing in filtered_circles:
-            if abs(y - existing[1]) < min_dist:  # Använd hela min_dist för Y-gruppering
-                too_close = True
-                break
-        if not too_close:
-            filtered_circles.append(circle)
-            # Stoppa vid 5 cirklar (vanligast antal svarsalternativ)
-            if len(filtered_circles) >= 5:
-                break
+        if filtered_circles and circle[1] - filtered_circles[-1][1] < min_dist:
+            continue
+        filtered_circles.append(tuple(int(v) for v in circle))
+        if len(filtered_circles) >= 5:
+            break
     
     return filtered_circles
 
-def mask_replicate(img_bgr, args):
-    """Hitta grön bock → rita svarta boxar på alla alternativs y-positions."""
-    img = img_bgr.copy()
+def cluster_rows(circles, min_dist):
+    """Slå ihop cirklar (x,y,r) vars y ligger närmare än min_dist till en rad var.
+
+    Vektoriserat: sortera på y och bryt där glappet är >= min_dist. Returnerar
+    en (x,y,r)-tupel per rad (medelvärden), utan tak på antal rader.
+    """
+    if len(circles) == 0:
+        return []
+    arr = np.asarray(circles, dtype=np.float64)
+    arr = arr[np.argsort(arr[:, 1], kind="stable")]
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(arr[:, 1]) >= min_dist) + 1))
+    counts = np.diff(np.append(starts, len(arr)))
+    means = np.add.reduceat(arr, starts, axis=0) / counts[:, None]
+    return [tuple(int(round(v)) for v in row) for row in means]
+
+def find_option_circles(gray, tick_bbox, min_dist, rmin, rmax, band=0, green_mask=None):
+    """Snabb radioknappsdetektor: sammanhängande ringar i ett band kring bockens x.
+
+    Bara en vertikal remsa (±band px kring bockens mitt) tröskas. Konturer med
+    hål, rätt storlek (2·rmin–2·rmax), nära kvadratisk bbox och centrerat hål
+    räknas som ringar; kandidater långt från median-x (lösa bokstäver) tas bort.
+    Raderna klustras vektoriserat utan tak på antal alternativ.
+    """
+    H, W = gray.shape[:2]
+    x, y, w, h = tick_bbox
+    cx = x + w // 2
+    half = band or max(w // 2 + rmax, 3 * rmax)
+    x1, x2 = max(0, cx - half), min(W, cx + half)
+    binary = np.where(gray[:, x1:x2] < 160, 255, 0).astype(np.uint8)
+    if green_mask is not None:
+        binary[green_mask[:, x1:x2] > 0] = 0  # bocken får inte smälta ihop med ringen
+    cnts, hier = cv2.findContours(binary, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+    if hier is None:
+        return []
+    hier = hier[0]
+    lo, hi = 2 * rmin, 2 * rmax + 2
+    found = []
+    for i, c in enumerate(cnts):
+        child = hier[i][2]
+        if hier[i][3] != -1 or child < 0:  # bara yttre konturer som har ett hål
+            continue
+        bx, by, bw, bh = cv2.boundingRect(c)
+        if not (lo <= bw <= hi and lo <= bh <= hi and 0.8 <= bw / bh <= 1.25):
+            continue
+        hx, hy, hw, hh = cv2.boundingRect(cnts[child])
+        if hw * hh < 0.3 * bw * bh:
+            continue
+        if abs(hx + hw / 2 - (bx + bw / 2)) > 0.2 * bw or abs(hy + hh / 2 - (by + bh / 2)) > 0.2 * bh:
+            continue
+        found.append((x1 + bx + bw / 2, by + bh / 2, (bw + bh) / 4))
+    if not found:
+        return []
+    arr = np.array(found)
+    arr = arr[np.abs(arr[:, 0] - np.median(arr[:, 0])) <= rmax]
+    return cluster_rows(arr, min_dist)
+
+def replicate_shapes(img_bgr, args, analysis=None):
+    """Hitta grön bock → en box per alternativs y-position, i bockens x-led."""
+    if analysis is None:
+        analysis = analyze_page(img_bgr, args)
 
     # 1) hitta bockens bbox
-    bbox = find_green_tick_bbox(img_bgr, args.h1, args.h2, args.s1, args.v1, args.min_area)
+    with korrapport.stage("green"):
+        bbox = find_green_tick_bbox(img_bgr, args.h1, args.h2, args.s1, args.v1, args.min_area, analysis)
     if bbox is None:
         print("  ⚠️ Ingen grön bock hittad - hoppar över denna sida")
-        return img  # Returnera originalbilden om ingen bock hittas
+        korrapport.event("no_tick")
+        return []  # Ingen maskning om ingen bock hittas
 
     x,y,w,h = bbox
     print(f"  ✅ Grön bock hittad vid ({x},{y}) storlek {w}x{h}")
-    
-    # expandera/justera storlek lite så boxen garanterat täcker markören
     cx = x + w//2
     cy = y + h//2
-    w2 = int(w * args.rep_box_expand)
-    h2 = int(h * args.rep_box_expand)
-    w2 = max(w2, 16); h2 = max(h2, 16)  # minstorlek
 
-    # 2) hitta alternativens cirklar (y-positions)
-    circles = detect_option_circles(img_bgr, args.hc_dp, args.hc_min_dist,
-                                    args.hc_param1, args.hc_param2,
-                                    args.hc_min_radius, args.hc_max_radius)
+    # 2) hitta alternativens cirklar (y-positions): först i den inlärda layoutens band,
+    #    annars snabb banddetektor med Hough som reserv
+    circles = []
+    layout = getattr(args, "layout", None)
+    if layout is not None and layout.pitch:
+        with korrapport.stage("circles", detector="layout"):
+            circles = layout_rows(analysis, bbox, layout, args)
+        korrapport.event("layout_hit" if circles else "layout_miss")
+    if not circles and args.circle_detector != "hough":
+        with korrapport.stage("circles", detector="fast"):
+            circles = find_option_circles(analysis.gray, bbox, args.hc_min_dist,
+                                          args.hc_min_radius, args.hc_max_radius,
+                                          band=args.circle_band, green_mask=analysis.green_mask)
+        if circles and all(abs(c[1] - cy) >= args.hc_min_dist for c in circles):
+            # Bocken kan täcka sin egen ring helt – dess rad ska alltid maskas
+            circles = cluster_rows(circles + [(cx, cy, args.hc_max_radius)], args.hc_min_dist)
+    if len(circles) < args.rep_min_circles and args.circle_detector != "fast":
+        with korrapport.stage("circles", detector="hough"):
+            circles = detect_option_circles(img_bgr, args.hc_dp, args.hc_min_dist,
+                                            args.hc_param1, args.hc_param2,
+                                            args.hc_min_radius, args.hc_max_radius, gray=analysis.gray)
 
     print(f"  🔍 Hittade {len(circles)} radioknappar")
     
     if len(circles) < args.rep_min_circles:
         print(f"  ⚠️ För få radioknappar ({len(circles)} < {args.rep_min_circles}) - hoppar över")
-        return img  # Returnera originalbilden om för få cirklar
+        korrapport.event("few_circles", found=len(circles), required=args.rep_min_circles)
+        return []  # Ingen maskning om för få cirklar
+
+    # 3) svarta boxar på alla y, samma x som bocken
+    return replicate_boxes(bbox, circles, args, img_bgr.shape[0])
+
+def layout_rows(analysis, bbox, layout, args):
+    """Alternativraderna sökta bara i layoutens smala band, eller [] om de inte stämmer med layouten."""
+    if not sidlayout.tick_in_column(bbox, layout):
+        return []
+    x, half, rmin, rmax = sidlayout.search_band(layout)
+    rows = find_option_circles(analysis.gray, (x, 0, 0, 0), args.hc_min_dist, rmin, rmax,
+                               band=half, green_mask=analysis.green_mask)
+    bx, by, bw, bh = bbox
+    cy = by + bh // 2
+    if rows and all(abs(r[1] - cy) >= args.hc_min_dist for r in rows):
+        rows = cluster_rows(rows + [(bx + bw // 2, cy, args.hc_max_radius)], args.hc_min_dist)
+    return rows if sidlayout.verify_rows(rows, layout, args.rep_min_circles) else []
+
+def replicate_boxes(bbox, circles, args, height):
+    """En box i bockens storlek (× rep_box_expand) och x-led per alternativrad."""
+    x,y,w,h = bbox
+    # expandera/justera storlek lite så boxen garanterat täcker markören
+    cx = x + w//2
+    w2 = int(w * args.rep_box_expand)
+    h2 = int(h * args.rep_box_expand)
+    w2 = max(w2, 16); h2 = max(h2, 16)  # minstorlek
 
-    # 3) rita svarta boxar på alla y, samma x som bocken
     x1 = cx - w2//2 + args.rep_x_shift
     x2 = cx + (w2 - w2//2) + args.rep_x_shift
     
     print(f"  📦 Ritar {len(circles)} boxar vid x={x1}-{x2}")
     
+    shapes = []
     for i, (cx_c, cy_c, r) in enumerate(circles):
         yy1 = max(0, int(cy_c - h2//2 + args.rep_y_shift))
-        yy2 = min(img.shape[0], int(cy_c + (h2 - h2//2) + args.rep_y_shift))
-        cv2.rectangle(img, (x1, yy1), (x2, yy2), (0,0,0), thickness=-1)
+        yy2 = min(height, int(cy_c + (h2 - h2//2) + args.rep_y_shift))
+        shapes.append(rect_shape(x1, yy1, x2, yy2))
         print(f"    Box {i+1}: y={yy1}-{yy2}")
 
-    return img
+    return shapes
+
+def column_shapes(img_bgr, x_perc, width_px, top_perc, bot_perc, analysis=None, layout_x=None):
+    """Maskform för mode=column: en vertikal stapel vid den gröna bocken.
 
-def mask_column(img_bgr, x_perc, width_px, top_perc, bot_perc):
-    img = img_bgr.copy()
-    H, W = img.shape[:2]
+    Utan bock används layout_x (inlärd svarskolumn) eller x_perc.
+    """
+    H, W = img_bgr.shape[:2]
     
     # Först hitta den gröna bocken för att bestämma X-position
-    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-    
-    # HSV-intervall för grönt (samma som i mask_green)
-    lower_green = np.array([35, 40, 40], dtype=np.uint8)
-    upper_green = np.array([85, 255, 255], dtype=np.uint8)
-    green_mask = cv2.inRange(hsv, lower_green, upper_green)
+    # (HSV-intervall för grönt: samma som i green_shapes)
+    if analysis is None:
+        analysis = PageAnalysis(img_bgr)
     
-    # Hitta konturer av gröna områden
-    cnts, _ = cv2.findContours(green_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    # Hitta konturer av gröna områden (omorfologisk mask, som tidigare)
+    with korrapport.stage("green"):
+        cnts = analysis.green_contours(raw=True)
     
-    x_center = int(W * (x_perc / 100.0))  # Fallback position
+    x_center = int(W * (x_perc / 100.0)) if layout_x is None else int(round(layout_x))  # Fallback position
     
     # Om vi hittar gröna områden, använd deras X-position
     if cnts:
@@ -218,93 +690,1079 @@ def mask_column(img_bgr, x_perc, width_px, top_perc, bot_perc):
         largest_contour = max(cnts, key=cv2.contourArea)
         x, y, w, h = cv2.boundingRect(largest_contour)
         x_center = x + w // 2  # Centrum av den gröna bocken
+    else:
+        korrapport.event("no_tick")
     
-    # Skapa vertikal stapel som börjar vid den gröna bocken
+    return [column_rect(x_center, W, H, width_px, top_perc, bot_perc)]
+
+def column_rect(x_center, W, H, width_px, top_perc, bot_perc):
+    """Vertikal stapel centrerad på x_center, top_perc–bot_perc av höjden."""
     x1 = max(0, x_center - width_px // 2)
     x2 = min(W, x_center + (width_px - width_px // 2))
     y1 = int(H * (top_perc / 100.0))
     y2 = int(H * (bot_perc / 100.0))
-    cv2.rectangle(img, (x1, y1), (x2, y2), (0,0,0), thickness=-1)
-    return img
+    return rect_shape(x1, y1, x2, y2)
 
-def images_to_pdf(image_paths, out_pdf):
-    imgs = [Image.open(p).convert("RGB") for p in image_paths]
-    if not imgs:
-        return
-    first, rest = imgs[0], imgs[1:]
-    first.save(out_pdf, save_all=True, append_images=rest)
-
-def build_apkg_from_images(img_dir, output="bv3_maskad.apkg"):
-    import re, glob, genanki
-    DECK_NAME = "BV3 – Maskad tenta (auto)"
-    DECK_ID   = 2025102301
-    masked = sorted(glob.glob(os.path.join(img_dir, "page_*_masked.png")))
-    if not masked:
-        print("Inga _masked.png hittades – hoppar över .apkg")
+def align_to(ref_gray, img_bgr, scale=0.25):
+    """Flytta img_bgr så att den linjerar med ref_gray (fascorrelation på nedskalad bild).
+
+    Sidorna i ett tentapar har samma layout, så en ren translation räcker.
+    """
+    small_ref = cv2.resize(ref_gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    small_img = cv2.resize(cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY), None, fx=scale, fy=scale,
+                           interpolation=cv2.INTER_AREA)
+    (dx, dy), _ = cv2.phaseCorrelate(np.float32(small_img), np.float32(small_ref))
+    dx, dy = dx / scale, dy / scale
+    if abs(dx) < 0.5 and abs(dy) < 0.5:
+        return img_bgr
+    M = np.float32([[1, 0, dx], [0, 1, dy]])
+    H, W = ref_gray.shape[:2]
+    return cv2.warpAffine(img_bgr, M, (W, H), borderValue=(255, 255, 255))
+
+def align_pair(facit_bgr, utan_bgr):
+    """Skala och flytta utan-sidan så att den ligger exakt över facit-sidan."""
+    if utan_bgr.shape != facit_bgr.shape:
+        utan_bgr = cv2.resize(utan_bgr, (facit_bgr.shape[1], facit_bgr.shape[0]), interpolation=cv2.INTER_AREA)
+    return align_to(cv2.cvtColor(facit_bgr, cv2.COLOR_BGR2GRAY), utan_bgr)
+
+def find_added_ink_boxes(facit_bgr, utan_bgr, thresh, min_area, pad):
+    """Returnera boxar (x,y,w,h) där facit-sidan har bläck som utan-sidan saknar.
+
+    utan_bgr ska vara linjerad med align_pair. Beräknas vektoriserat: mättad
+    subtraktion utan − facit per kanal och max över kanalerna, dvs. alla
+    pixlar som blivit mörkare eller färgats.
+    """
+    added = cv2.subtract(utan_bgr, facit_bgr).max(axis=2)
+    mask = (added >= thresh).astype(np.uint8) * 255
+    kernel = np.ones((3,3), np.uint8)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel, iterations=1)  # kantbrus från linjeringen
+    mask = cv2.dilate(mask, kernel, iterations=2)                         # slå ihop streck i samma märke
+    cnts, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    H, W = mask.shape
+    boxes = []
+    for c in cnts:
+        x, y, w, h = cv2.boundingRect(c)
+        if w*h < min_area:
+            continue
+        x1, y1 = max(0, x - pad), max(0, y - pad)
+        x2, y2 = min(W, x + w + pad), min(H, y + h + pad)
+        boxes.append((x1, y1, x2 - x1, y2 - y1))
+    return boxes
+
+def diff_shapes(facit_bgr, utan_bgr, args):
+    """Maskformer för mode=diff. Returnerar (former, linjerad utan-sida eller None)."""
+    if utan_bgr is None:
+        print("  ⚠️ Ingen motsvarande sida utan facit - hoppar över denna sida")
+        korrapport.event("no_utan_page")
+        return [], None
+    with korrapport.stage("diff"):
+        utan_bgr = align_pair(facit_bgr, utan_bgr)
+        boxes = find_added_ink_boxes(facit_bgr, utan_bgr, args.diff_thresh, args.diff_min_area, args.diff_pad)
+    print(f"  🔍 Hittade {len(boxes)} diff-regioner")
+    if args.diff_fill == "utan":
+        shapes = [Shape("utan", x, y, x + w, y + h, 0) for x, y, w, h in boxes]
+    else:
+        shapes = [rect_shape(x, y, x + w, y + h) for x, y, w, h in boxes]
+    return shapes, utan_bgr
+
+def render_bgr(doc, page_index, dpi, buffers=None):
+    """Rasterisera en sida ur ett öppet dokument till BGR, eller None om sidan saknas."""
+    if page_index >= doc.page_count:
+        return None
+    mat = fitz.Matrix(dpi/72, dpi/72)
+    return pixmap_to_bgr(doc[page_index].get_pixmap(matrix=mat, alpha=False), buffers)
+
+def scale_shapes(shapes, factor):
+    """Skala maskformer till en annan upplösning; rutor avrundas utåt så inget tappas."""
+    out = []
+    for kind, x1, y1, x2, y2, width in shapes:
+        if kind == "line":
+            out.append(Shape(kind, round(x1 * factor), round(y1 * factor), round(x2 * factor),
+                             round(y2 * factor), max(1, round(width * factor))))
+        else:
+            end = 1 if kind == "rect" else 0  # rect-hörnen är inklusive
+            out.append(Shape(kind, math.floor(x1 * factor), math.floor(y1 * factor),
+                             math.ceil((x2 + end) * factor) - end, math.ceil((y2 + end) * factor) - end, 0))
+    return out
+
+def downscale(img, k, buffers=None):
+    """Skala ner med heltalsfaktor k. Kanten beskärs till en multipel av k så att
+    OpenCV använder sin snabba blockmedelvärdering (udda bredd ger långsam väg)."""
+    h, w = img.shape[:2]
+    img = img[:h - h % k, :w - w % k]
+    size = (img.shape[1] // k, img.shape[0] // k)
+    out = buffers.take((size[1], size[0], *img.shape[2:]), img.dtype) if buffers is not None else None
+    return cv2.resize(img, size, dst=out, interpolation=cv2.INTER_AREA)
+
+def resolve_analysis_dpi(args):
+    """DPI som detektionen körs i för rasterlägena: --dpi / k för ett heltal k.
+
+    Med heltalsfaktor blir INTER_AREA-nedskalningen en ren blockmedelvärdering
+    (~10 gånger snabbare än en godtycklig faktor). 220 → 110 (k=2), 300 → 100 (k=3).
+    --mode diff analyserar alltid i --dpi: bläckets svaga kanter (tunna, kantutjämnade
+    streck) når inte --diff-thresh efter nedskalningen och rutan blir för liten.
+    """
+    if args.mode == "diff":
+        return args.dpi
+    k = max(1, round(args.dpi / (args.analysis_dpi or ANALYSIS_DPI)))
+    return args.dpi / k
+
+def find_mask_shapes(img_bgr, args, utan_bgr=None, analysis=None):
+    """Maskformer för en sida enligt args.mode (pixelkoordinater i img_bgr).
+
+    Returnerar (former, linjerad utan-sida eller None); utan-sidan behövs bara
+    för att rita "utan"-former i pixlar. analysis kan ges färdig (parametersvep
+    återanvänder samma analys för alla kombinationer med samma HSV-intervall).
+    """
+    if args.mode == "diff":
+        return diff_shapes(img_bgr, utan_bgr, args)
+    if analysis is None:
+        analysis = analyze_page(img_bgr, args)  # delas av alla lägen nedan
+    if args.mode == "green":
+        with korrapport.stage("green"):
+            return green_shapes(analysis, args.min_area, args.th_low, args.th_high, args.line_thickness), None
+    if args.mode == "column":
+        layout = getattr(args, "layout", None)
+        return column_shapes(
+            img_bgr, args.col_x_perc, args.col_width, args.col_top_perc, args.col_bot_perc, analysis,
+            layout.x if layout is not None else None
+        ), None
+    return replicate_shapes(img_bgr, args, analysis), None
+
+def pdf_mask_shapes(page, args, scale):
+    """Maskformer (pixlar, scale = pixlar per punkt) ur sidans PDF-struktur.
+
+    Samma logik som pixellägena, men bocken och knapparna läses med
+    find_pdf_marks i stället för HSV/Hough. Pixelparametrarna i args gäller
+    för scale. Returnerar None när strukturen inte räcker (skannad sida, ingen
+    grön markering eller för få knappar) så att pixelanalysen kan ta över.
+    """
+    with korrapport.stage("pdf_marks"):
+        marks = find_pdf_marks(page, args.h1, args.h2, args.s1, args.v1,
+                               args.hc_min_radius / scale, args.hc_max_radius / scale)
+    if not marks.has_content or not marks.green:
+        korrapport.event("pdf_no_marks", scanned=not marks.has_content)
+        return None
+    # Bocken kan bestå av flera banor/spann – slå ihop det som ligger kant i kant
+    green = _merge_rects((math.floor(r.x0 * scale) - 1, math.floor(r.y0 * scale) - 1,
+                          math.ceil(r.x1 * scale) + 1, math.ceil(r.y1 * scale) + 1) for r in marks.green)
+    boxes = [(x1, y1, x2 - x1, y2 - y1) for x1, y1, x2, y2 in green]
+    print(f"  🧾 PDF-struktur: {len(boxes)} gröna markeringar, {len(marks.bullets)} knappar")
+    H, W = round(page.rect.height * scale), round(page.rect.width * scale)
+    if args.mode == "green":
+        return [rect_shape(x, y, x + w, y + h) for x, y, w, h in boxes if w*h >= args.min_area]
+    bbox = max(boxes, key=lambda b: b[2] * b[3])
+    x, y, w, h = bbox
+    cx, cy = x + w//2, y + h//2
+    if args.mode == "column":
+        return [column_rect(cx, W, H, args.col_width, args.col_top_perc, args.col_bot_perc)]
+    if w*h < args.min_area:
+        korrapport.event("pdf_no_marks", scanned=False)
+        return None
+    half = args.circle_band or max(w // 2 + args.hc_max_radius, 3 * args.hc_max_radius)
+    rows = [(bx * scale, by * scale, br * scale) for bx, by, br in marks.bullets if abs(bx * scale - cx) <= half]
+    if all(abs(r[1] - cy) >= args.hc_min_dist for r in rows):
+        rows.append((cx, cy, args.hc_max_radius))  # bockens egen rad ska alltid maskas
+    rows = cluster_rows(rows, args.hc_min_dist)
+    if len(rows) < args.rep_min_circles:
+        korrapport.event("pdf_few_bullets", found=len(rows), required=args.rep_min_circles)
+        return None
+    print(f"  ✅ Grön bock vid ({x},{y}) storlek {w}x{h}, {len(rows)} alternativrader")
+    return replicate_boxes(bbox, rows, args, H)
+
+def structure_shapes(page, args, scale):
+    """Maskformer ur PDF-strukturen enligt --detect, eller None om pixlarna ska analyseras.
+
+    [] betyder att sidan lämnas omaskerad (--detect pdf utan användbara markeringar).
+    """
+    if page is None or args.detect == "pixel" or args.mode == "diff":
+        return None
+    shapes = pdf_mask_shapes(page, args, scale)
+    if shapes is not None:
+        korrapport.event("pdf_detected", shapes=len(shapes))
+        return shapes
+    if args.detect == "pdf":
+        print("  ⚠️ Inga användbara markeringar i PDF-strukturen - hoppar över denna sida")
+        return []
+    return None
+
+def mask_canvas(img_bgr, inplace=False):
+    """Bilden som maskerna ritas i: img_bgr själv, eller en kopia ur PAGE_BUFFERS."""
+    return img_bgr if inplace else PAGE_BUFFERS.copy(img_bgr)
+
+def mask_page(img_bgr, args, utan_bgr=None, page=None, pdf_shapes=None, inplace=False):
+    """Maska en sida enligt args.mode (diff kräver motsvarande sida utan facit).
+
+    Med page (fitz-sidan som img_bgr renderats från) läses markeringarna i
+    första hand ur PDF-strukturen (--detect); pdf_shapes är samma sak redan
+    beräknat (structure_shapes). Annars körs detektionen på en nedskalad kopia
+    i --analysis-dpi (kostnaden faller med kvadraten på skalan); formerna
+    skalas upp och ritas i full upplösning.
+
+    Maskerna ritas i en kopia ur PAGE_BUFFERS, eller med inplace direkt i
+    img_bgr när originalet inte behövs efteråt.
+    """
+    if pdf_shapes is None:
+        pdf_shapes = structure_shapes(page, args, args.dpi / 72)
+    if pdf_shapes is not None:
+        return draw_shapes(mask_canvas(img_bgr, inplace), pdf_shapes)
+    analysis_dpi = resolve_analysis_dpi(args)
+    if analysis_dpi >= args.dpi:
+        shapes, fill_bgr = find_mask_shapes(img_bgr, args, utan_bgr)
+        return draw_shapes(mask_canvas(img_bgr, inplace), shapes, fill_bgr)
+    k = round(args.dpi / analysis_dpi)
+    small = downscale(img_bgr, k, PAGE_BUFFERS)
+    small_utan = None
+    if utan_bgr is not None:
+        small_utan = downscale(utan_bgr, k, PAGE_BUFFERS)
+        if small_utan.shape != small.shape:
+            small_utan = cv2.resize(small_utan, (small.shape[1], small.shape[0]), interpolation=cv2.INTER_AREA)
+    f = 1 / k
+    shapes, _ = find_mask_shapes(small, scale_pixel_args(args, f), small_utan)
+    PAGE_BUFFERS.give(small, small_utan)
+    shapes = scale_shapes(shapes, 1 / f)
+    fill_bgr = None
+    if utan_bgr is not None and any(s.kind == "utan" for s in shapes):
+        fill_bgr = align_pair(img_bgr, utan_bgr)
+    return draw_shapes(mask_canvas(img_bgr, inplace), shapes, fill_bgr)
+
+def shape_rects(shapes, scale):
+    """Maskformer (pixlar) → (kind, fitz.Rect i punkter). Linjer blir sin tjocka bbox."""
+    out = []
+    for kind, x1, y1, x2, y2, width in shapes:
+        if kind == "rect":  # cv2.rectangle täcker slutpixeln också
+            rect = fitz.Rect(x1, y1, x2 + 1, y2 + 1)
+        elif kind == "line":
+            half = width / 2
+            rect = fitz.Rect(min(x1, x2) - half, min(y1, y2) - half, max(x1, x2) + half, max(y1, y2) + half)
+        else:
+            rect = fitz.Rect(x1, y1, x2, y2)
+        out.append((kind, rect * scale))
+    return out
+
+def apply_shapes_to_page(page, shapes, scale, style="redact", utan_doc=None):
+    """Lägg maskformerna (pixlar, scale = punkter per pixel) direkt på PDF-sidan.
+
+    style="redact" tar bort text, bildpixlar och helt täckt grafik under
+    maskerna; "fill" ritar bara fyllda rutor/linjer ovanpå. "utan"-former
+    fylls med motsvarande del av sidan utan facit (utan_doc).
+    """
+    if not shapes:
         return
-    model = genanki.Model(
+    derot = page.derotation_matrix  # pixmapen är i den roterade vyn
+    items = [(kind, (rect & page.rect) * derot) for kind, rect in shape_rects(shapes, scale)]
+    items = [(kind, rect) for kind, rect in items if not rect.is_empty]
+    if style == "redact":
+        for kind, rect in items:
+            page.add_redact_annot(rect, fill=(1, 1, 1) if kind == "utan" else (0, 0, 0))
+        page.apply_redactions()
+    else:
+        shape = page.new_shape()
+        for kind, x1, y1, x2, y2, width in shapes:
+            if kind == "line":
+                shape.draw_line(fitz.Point(x1, y1) * scale * derot, fitz.Point(x2, y2) * scale * derot)
+                shape.finish(color=(0, 0, 0), width=width * scale)
+        for kind, rect in items:
+            if kind != "line":
+                shape.draw_rect(rect)
+                shape.finish(fill=(1, 1, 1) if kind == "utan" else (0, 0, 0), color=None)
+        shape.commit()
+    if utan_doc is not None and page.number < utan_doc.page_count:
+        utan_page = utan_doc[page.number]
+        k = utan_page.rect.width / page.rect.width
+        for kind, rect in items:
+            if kind == "utan":
+                with utan_region(utan_doc, page.number, rect * k) as region:
+                    page.show_pdf_page(rect, region, 0, clip=rect * k)
+
+def utan_region(utan_doc, page_number, clip):
+    """Sidan utan facit som eget dokument, med allt utanför clip bortredigerat.
+
+    show_pdf_page klipper bara det synliga: hela sidans innehåll (all text)
+    följer annars med in i varje "utan"-ruta och finns då flera gånger i
+    utdata-PDF:en. Tecken som skär kanten på clip tas bort.
+    """
+    region = fitz.open()
+    region.insert_pdf(utan_doc, from_page=page_number, to_page=page_number)
+    page = region[0]
+    r = page.rect
+    for outside in (fitz.Rect(r.x0, r.y0, r.x1, clip.y0), fitz.Rect(r.x0, clip.y1, r.x1, r.y1),
+                    fitz.Rect(r.x0, clip.y0, clip.x0, clip.y1), fitz.Rect(clip.x1, clip.y0, r.x1, clip.y1)):
+        if not outside.is_empty:
+            page.add_redact_annot(outside, fill=False)
+    page.apply_redactions()
+    return region
+
+def split_page_images(orig_path, masked_path, out_dir, dpi, gap_pt=QUESTION_GAP_PT):
+    """Klipp ut en bild per fråga ur en original- och en maskad sidbild.
+
+    Frågegränserna hittas på originalet och används för båda. Utsnitten
+    skrivs till out_dir (samma format som sidbilderna). Returnerar en lista
+    av (maskad, original) per fråga.
+    """
+    orig = cv2.imread(orig_path, cv2.IMREAD_COLOR)
+    masked = cv2.imread(masked_path, cv2.IMREAD_COLOR)
+    bands = find_question_bands(orig, dpi, min_gap_pt=gap_pt)
+    if len(bands) < 2:
+        return [(masked_path, orig_path)]
+    base, ext = os.path.splitext(os.path.basename(orig_path))
+    pairs = []
+    for j, (y1, y2) in enumerate(bands):
+        m = os.path.join(out_dir, f"{base}_q{j+1}_masked{ext}")
+        o = os.path.join(out_dir, f"{base}_q{j+1}{ext}")
+        cv2.imwrite(m, masked[y1:y2])
+        cv2.imwrite(o, orig[y1:y2])
+        pairs.append((m, o))
+    return pairs
+
+APKG_DECK_NAME = "BV3 – Maskad tenta (auto)"
+APKG_DECK_ID   = 2025102301
+BATCH_DECK_NAME = "Maskade tentor"  # föräldradeck i batchläget, en underlek per tenta
+
+def _apkg_model():
+    import genanki
+    return genanki.Model(
         1607392319,
         'Basic (Image Front/Back)',
         fields=[{'name':'Front'},{'name':'Back'}],
         templates=[{'name':'Card 1','qfmt':'{{Front}}','afmt':'{{Front}}<hr id=answer>{{Back}}'}],
         css=".card{font-family:-apple-system,Segoe UI,Arial; font-size:18px} img{max-width:100%}"
     )
-    deck = genanki.Deck(DECK_ID, DECK_NAME)
+
+def deck_id_for(name):
+    """Stabilt deck-id ur decknamnet (samma tenta får samma underlek vid varje bygge)."""
+    return int.from_bytes(hashlib.sha256(name.encode("utf-8")).digest()[:6], "big")
+
+def add_image_notes(deck, model, img_dir, media_dir, exam, split_questions=False, dpi=220,
+                    question_gap=QUESTION_GAP_PT, writer=None):
+    """Ett kort per maskad sida (eller fråga) i img_dir. Returnerar mediasökvägarna.
+
+    Korten får GUID ur (modell, tenta, sida, fråga), så en ny körning uppdaterar
+    samma kort i Anki. Bilderna länkas in i media_dir under sitt innehållsnamn:
+    sidnamnen (page_003_masked.png) är desamma i alla tentor, och oförändrade
+    bilder behåller namnet mellan byggen. Med writer (apkgskrivare.ApkgWriter)
+    strömmas varje bild in i paketet direkt.
+    """
+    import genanki
+    masked = sorted(glob.glob(os.path.join(img_dir, "page_*_masked.*")))
     media = []
+    split_dir = os.path.join(img_dir, "fragor")  # egen mapp så att globben ovan inte hittar utsnitten
+    if split_questions and masked:
+        os.makedirs(split_dir, exist_ok=True)
     for m in masked:
         base = os.path.basename(m)
         num = base.split("_")[1]  # 001
-        orig = os.path.join(img_dir, f"page_{num}.png")
+        ext = os.path.splitext(base)[1]
+        orig = os.path.join(img_dir, f"page_{num}{ext}")
         if not os.path.exists(orig):
             continue
-        front = f'<img src="{base}">'
-        back  = f'<img src="page_{num}.png">'
-        note = genanki.Note(model=model, fields=[front, back])
-        deck.add_note(note)
-        media += [m, orig]
-    pkg = genanki.Package(deck)
-    pkg.media_files = media
-    pkg.write_to_file(output)
-    print(f"Klar ✅ skapade {output}")
+        pairs = [(m, orig)]
+        if split_questions:
+            pairs = split_page_images(orig, m, split_dir, dpi, question_gap)
+        for j, (front_path, back_path) in enumerate(pairs):
+            question = j + 1 if len(pairs) > 1 else 0  # 0 = hela sidan
+            guid = genanki.guid_for(model.model_id, exam, int(num), question)
+            front_path = store_media(front_path, media_dir)
+            back_path = store_media(back_path, media_dir)
+            front = f'<img src="{os.path.basename(front_path)}">'
+            back  = f'<img src="{os.path.basename(back_path)}">'
+            note = genanki.Note(model=model, fields=[front, back], guid=guid)
+            deck.add_note(note)
+            media += [front_path, back_path]
+            if writer is not None:
+                writer.add_media(front_path)
+                writer.add_media(back_path)
+    return media
+
+def store_media(path, media_dir):
+    """Kopiera bilden till media_dir under namnet <innehållshash><ext> (en gång per unik bild).
+
+    Kopia, inte hårdlänk: sidbilderna skrivs över på plats i nästa körning,
+    och en delad inod skulle då ändra innehållet bakom hashnamnet. Filer som
+    äldre byggen hårdlänkade hit (fler än en länk) ersätts med en kopia.
+    """
+    data = read_bytes(path)
+    digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+    dst = os.path.join(media_dir, digest + os.path.splitext(path)[1])
+    if not os.path.exists(dst) or os.stat(dst).st_nlink > 1:
+        tmp = f"{dst}.{os.getpid()}.tmp"
+        write_bytes(tmp, data)
+        os.replace(tmp, dst)
+    return dst
+
+def write_apkg(writer, decks, media, output, delta=False):
+    """Avsluta paketet (eller med delta bara ändringarna sedan förra bygget) och uppdatera manifestet.
+
+    writer är byggmanifest.open_writer(output, delta) med bilderna redan
+    inströmmade. Returnerar sökvägen som skrevs, eller None om inget ändrats.
+    """
+    decks, media, path, manifest = byggmanifest.plan(decks, list(dict.fromkeys(media)), output, delta)
+    if decks:
+        with korrapport.stage("apkg", media=len(media)):
+            writer.finish(decks)
+    else:
+        print("✅ Inga ändrade kort sedan förra bygget – inget deltapaket skrivs")
+        path = None
+    byggmanifest.save(byggmanifest.manifest_path(output), manifest)
+    return path
+
+def build_apkg_from_images(img_dir, output=DEFAULT_APKG, split_questions=False, dpi=220,
+                           question_gap=QUESTION_GAP_PT, exam=None, delta=False):
+    import genanki
+    deck = genanki.Deck(APKG_DECK_ID, APKG_DECK_NAME)
+    media_dir = os.path.join(img_dir, "apkg_media")
+    os.makedirs(media_dir, exist_ok=True)
+    with byggmanifest.open_writer(output, delta) as writer:
+        media = add_image_notes(deck, _apkg_model(), img_dir, media_dir, exam or APKG_DECK_NAME,
+                                split_questions, dpi, question_gap, writer)
+        if not media:
+            print("Inga _masked-bilder hittades – hoppar över .apkg")
+            return
+        path = write_apkg(writer, [deck], media, output, delta)
+    if path:
+        print(f"Klar ✅ skapade {path}")
+
+def build_batch_apkg(exams, output, split_questions=False, dpi=220, question_gap=QUESTION_GAP_PT,
+                     delta=False):
+    """Ett samlat .apkg för batchläget: en underlek per tenta, exams = [(namn, bildmapp)]."""
+    import genanki
+    model = _apkg_model()
+    media_dir = os.path.join(os.path.dirname(output) or ".", "apkg_media")
+    os.makedirs(media_dir, exist_ok=True)
+    decks, media = [], []
+    with byggmanifest.open_writer(output, delta) as writer:
+        for name, img_dir in exams:
+            deck_name = f"{BATCH_DECK_NAME}::{name}"
+            deck = genanki.Deck(deck_id_for(deck_name), deck_name)
+            media += add_image_notes(deck, model, img_dir, media_dir, name, split_questions, dpi,
+                                     question_gap, writer)
+            if deck.notes:
+                decks.append(deck)
+        if not decks:
+            print("Inga _masked-bilder hittades – hoppar över .apkg")
+            return
+        path = write_apkg(writer, decks, media, output, delta)
+    if path:
+        print(f"Klar ✅ skapade {path} ({len(decks)} tentor, {sum(len(d.notes) for d in decks)} kort)")
+
+# Resultat för en sida i minnespipelinen. orig är None om .apkg inte byggs,
+# pdf är None om den maskade bilden kan bäddas in i PDF:en som den är.
+# report är sidans körrapportrader (korrapport.capture), även från arbetsprocesser.
+PageResult = namedtuple("PageResult", "num width height orig masked pdf stats report")
+
+def image_max_bytes(args, n_pages):
+    """Byte-budget per bild: --budget-mb fördelat på alla bilder som skrivs."""
+    if not args.budget_mb or not n_pages:
+        return 0
+    per_page = 2 if args.build_apkg else 1
+    return int(args.budget_mb * 1024 * 1024 / (n_pages * per_page))
+
+# En rasteriserad sida på väg genom stegen. pdf_shapes: former ur PDF-strukturen
+# (None = analysera pixlarna), report: sidans delrapport (korrapport).
+RasterPage = namedtuple("RasterPage", "num bgr utan_bgr pdf_shapes report")
+
+# PyMuPDF är inte trådsäkert: alla fitz-anrop medan sidflödet körs tas under låset
+FITZ_LOCK = threading.RLock()
+
+def rasterize_page(page, args, utan_doc=None, orig_path=None):
+    """Steg 1: rendera sidan (och sidan utan facit) och läs PDF-strukturen.
+
+    Med orig_path sparas originalsidan som PNG direkt från pixmappen.
+    """
+    report = korrapport.active().child(page.number + 1)
+    with korrapport.use(report), FITZ_LOCK:
+        with korrapport.stage("rasterize"):
+            pix = page.get_pixmap(matrix=fitz.Matrix(args.dpi/72, args.dpi/72), alpha=False)
+            bgr = pixmap_to_bgr(pix, PAGE_BUFFERS)
+            utan_bgr = render_bgr(utan_doc, page.number, args.dpi, PAGE_BUFFERS) if utan_doc is not None else None
+        if orig_path:
+            with korrapport.stage("encode", image="orig"):
+                pix.save(orig_path)
+        pdf_shapes = structure_shapes(page, args, args.dpi / 72)
+    return RasterPage(page.number + 1, bgr, utan_bgr, pdf_shapes, report)
+
+def mask_raster(rp, args, inplace=False):
+    """Steg 2: maska en RasterPage (inga fitz-anrop); inplace om originalet inte ska kodas."""
+    with korrapport.use(rp.report), korrapport.stage("mask"):
+        return mask_page(rp.bgr, args, rp.utan_bgr, pdf_shapes=rp.pdf_shapes, inplace=inplace)
+
+def encode_masked(rp, masked, args, max_bytes=0, fmt=None, encode_orig=None):
+    """Steg 3: koda originalet (för .apkg) och den maskade sidan till en PageResult.
+
+    Sidans bildbuffertar lämnas sedan tillbaka till PAGE_BUFFERS.
+    """
+    num = rp.num
+    fmt = fmt or args.media_format
+    ext = extension(fmt)
+    quality = args.media_quality if fmt == args.media_format else None
+    encode_orig = args.build_apkg if encode_orig is None else encode_orig
+    stats = EncodeStats()
+    orig = None
+    with korrapport.use(rp.report), korrapport.stage("encode"):
+        if encode_orig:
+            orig = stats.timed_encode(f"page_{num:03d}{ext}", rp.bgr, fmt, quality, max_bytes)
+        data = stats.timed_encode(f"page_{num:03d}_masked{ext}", masked, fmt, quality, max_bytes)
+        pdf_data = None
+        if fmt not in PDF_EMBEDDABLE:
+            pdf_data = encode_image(masked, "jpeg", stats.rows[-1]["quality"])
+    height, width = masked.shape[:2]
+    PAGE_BUFFERS.give(rp.bgr, rp.utan_bgr, masked)
+    return PageResult(num, width, height, orig, data, pdf_data, stats.rows, rp.report.rows())
+
+def process_page(page, args, max_bytes=0, utan_doc=None):
+    """Rasterisera, maska och koda en fitz-sida till en PageResult."""
+    rp = rasterize_page(page, args, utan_doc)
+    return encode_masked(rp, mask_raster(rp, args, inplace=not args.build_apkg), args, max_bytes)
+
+def page_pipeline(args, doc, utan_doc, indices, max_bytes=0, orig_dir=None, fmt=None):
+    """Rasterisera → maska → koda sidorna överlappande i trådar; PageResult i sidordning.
+
+    Stegen kopplas med köer om --pipeline-depth sidor (sidflode.pipeline), så
+    maskning och kodning av en sida sker medan nästa rasteriseras. Med
+    orig_dir sparas originalsidorna där som PNG (och kodas inte i steg 3).
+    --pipeline-depth 0 kör stegen efter varandra i den här tråden.
+    """
+    def raster(i):
+        orig_path = os.path.join(orig_dir, f"page_{i + 1:03d}.png") if orig_dir else None
+        with FITZ_LOCK:
+            return rasterize_page(doc[i], args, utan_doc, orig_path)
+
+    # Originalet behövs bara om det ska kodas i steg 3; annars maskas sidan på plats
+    inplace = bool(orig_dir) or not args.build_apkg
+
+    def mask(rp):
+        return rp, mask_raster(rp, args, inplace)
+
+    def encode(item):
+        return encode_masked(*item, args, max_bytes, fmt, False if orig_dir else None)
+
+    if args.pipeline_depth <= 0:
+        for i in indices:
+            yield encode(mask(raster(i)))
+        return
+    threads = max(1, args.threads)
+    yield from pipeline(indices, [(raster, 1), (mask, threads), (encode, threads)], args.pipeline_depth)
+
+# Varje arbetsprocess öppnar egna fitz-dokument (handtag kan inte delas mellan processer).
+# Poolen kan delas mellan flera PDF:er (batch), så dokumenten öppnas per sökväg.
+_worker_docs = {}
+_worker_args = None
+WORKER_OPEN_DOCS = 4  # max öppna dokument per arbetsprocess (äldsta stängs först)
+
+def run_vector(args, out_img, out_pdf):
+    """Maska käll-PDF:en som vektor: analys på låg DPI, maskerna läggs på originalsidorna.
+
+    Pixelparametrarna (angivna för --dpi) skalas om till analys-DPI:n och de
+    hittade formerna räknas om till punkter. Sidor före --skip-pages tas bort
+    som i de rasteriserade lägena. Med --build-apkg renderas sidorna i --dpi.
+    """
+    analysis_dpi = args.dpi if args.mode == "diff" else args.analysis_dpi or ANALYSIS_DPI
+    analysis_args = scale_pixel_args(args, analysis_dpi / args.dpi)
+    doc = fitz.open(args.pdf_path)
+    utan_doc = open_utan_doc(args)
+    src = fitz.open(args.pdf_path) if args.build_apkg else None
+    ext = extension(args.media_format)
+    encode_stats = EncodeStats()
+    max_bytes = image_max_bytes(args, max(0, doc.page_count - args.skip_pages))
+    if src is not None:
+        os.makedirs(out_img, exist_ok=True)
+    try:
+        for i in range(args.skip_pages, doc.page_count):
+            with korrapport.capture(i + 1) as report:
+                shapes = structure_shapes(doc[i], analysis_args, analysis_dpi / 72)
+                if shapes is None:  # rasterisera bara när PDF-strukturen inte räcker
+                    with korrapport.stage("rasterize", dpi=analysis_dpi):
+                        img = render_bgr(doc, i, analysis_dpi)
+                        utan_bgr = render_bgr(utan_doc, i, analysis_dpi) if utan_doc is not None else None
+                    with korrapport.stage("mask"):
+                        shapes, _ = find_mask_shapes(img, analysis_args, utan_bgr)
+                with korrapport.stage("pdf"):
+                    apply_shapes_to_page(doc[i], shapes, 72 / analysis_dpi, args.vector_style,
+                                         utan_doc if args.diff_fill == "utan" else None)
+                if src is not None:
+                    for page_doc, suffix in ((src, ""), (doc, "_masked")):
+                        with korrapport.stage("rasterize", dpi=args.dpi):
+                            bgr = render_bgr(page_doc, i, args.dpi)
+                        name = f"page_{i + 1:03d}{suffix}{ext}"
+                        with korrapport.stage("encode"):
+                            data = encode_stats.timed_encode(name, bgr, args.media_format, args.media_quality, max_bytes)
+                        write_bytes(os.path.join(out_img, name), data)
+            korrapport.active().extend(report.rows())
+        if args.skip_pages:
+            doc.select(range(args.skip_pages, doc.page_count))
+        with korrapport.stage("pdf_save"):
+            doc.save(out_pdf, garbage=3, deflate=True)
+        report_encoding(encode_stats, args)
+    finally:
+        doc.close()
+        for d in (utan_doc, src):
+            if d is not None:
+                d.close()
+
+def open_utan_doc(args):
+    return fitz.open(args.utan) if args.mode == "diff" else None
+
+def _init_worker(args):
+    global _worker_args
+    cv2.setNumThreads(1)  # en process per kärna – undvik överprenumeration
+    korrapport.activate(korrapport.RunReport(enabled=bool(args.report or args.profile),
+                                             trace_memory=args.report_memory))
+    _worker_args = args
+
+def _worker_open(path):
+    # Nyckeln tar med storlek och mtime: en fil som ersatts (bevakning.py) öppnas på nytt
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime_ns)
+    doc = _worker_docs.pop(key, None) or fitz.open(path)
+    _worker_docs[key] = doc  # sist = senast använd
+    while len(_worker_docs) > WORKER_OPEN_DOCS:
+        _worker_docs.pop(next(iter(_worker_docs))).close()
+    return doc
+
+def _process_page_task(pdf_path, utan_path, page_index, max_bytes, layout=None):
+    utan_doc = _worker_open(utan_path) if utan_path else None
+    args = _worker_args
+    if layout is not None:  # poolen delas mellan PDF:er – layouten följer med varje sida
+        args = argparse.Namespace(**{**vars(args), "layout": layout})
+    return process_page(_worker_open(pdf_path)[page_index], args, max_bytes, utan_doc)
+
+def make_pool(args):
+    """Processpool för --workers > 1; kan delas mellan flera PDF:er med samma maskningsargument."""
+    return ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker, initargs=(args,))
+
+def page_indices(args):
+    """0-indexerade sidor som ska bearbetas (efter --skip-pages)."""
+    with fitz.open(args.pdf_path) as doc:
+        return list(range(args.skip_pages, doc.page_count))
+
+def iter_processed_pages(args, indices, workers=1, max_in_flight=0, max_bytes=0, pool=None):
+    """Ge process_page-resultat för indices i ordning, seriellt eller via en processpool.
+
+    Med workers > 1 (eller en befintlig pool) hålls högst max_in_flight sidor
+    (default 2 × workers) under bearbetning samtidigt, så minnet är konstant
+    oavsett antal sidor.
+    """
+    if not indices:
+        return
+    if pool is None and workers <= 1:
+        doc = fitz.open(args.pdf_path)
+        utan_doc = open_utan_doc(args)
+        try:
+            yield from page_pipeline(args, doc, utan_doc, indices, max_bytes)
+        finally:
+            doc.close()
+            if utan_doc is not None:
+                utan_doc.close()
+        return
+
+    if pool is None:
+        with make_pool(argparse.Namespace(**{**vars(args), "workers": workers})) as pool:
+            yield from iter_processed_pages(args, indices, workers, max_in_flight, max_bytes, pool)
+        return
+
+    indices = iter(indices)
+    max_in_flight = max_in_flight or 2 * max(1, workers)
+    utan_path = args.utan if args.mode == "diff" else None
+    layout = getattr(args, "layout", None)
+    pending = deque()
+    for i in indices:
+        pending.append(pool.submit(_process_page_task, args.pdf_path, utan_path, i, max_bytes, layout))
+        if len(pending) >= max_in_flight:
+            break
+    while pending:
+        result = pending.popleft().result()  # äldst först = sidordning
+        nxt = next(indices, None)
+        if nxt is not None:
+            pending.append(pool.submit(_process_page_task, args.pdf_path, utan_path, nxt, max_bytes, layout))
+        yield result
+
+def iter_pages(args, cache, pool=None):
+    """Som iter_processed_pages över alla sidor, men med renderingscache.
+
+    Nyckeln är PDF:ens innehållshash + sidindex + mask_params(args) (med
+    CACHE_VERSION och --skip-pages). Träffar läses från cachen; bara missar
+    rasteriseras och maskas (i poolen).
+    """
+    indices = page_indices(args)
+    max_bytes = image_max_bytes(args, len(indices))
+    if not cache.enabled:
+        yield from iter_processed_pages(args, indices, args.workers, args.max_in_flight, max_bytes, pool)
+        return
+
+    ext = extension(args.media_format)
+    file_hash = cache.file_hash(args.pdf_path)
+    params = mask_params(args)
+    if args.mode == "diff":
+        params["utan_hash"] = cache.file_hash(args.utan)
+    embeddable = args.media_format in PDF_EMBEDDABLE
+    keys = {}
+    cached = {}
+    misses = []
+    for i in indices:
+        masked_key = cache.key(file_hash, i, kind="masked", **params)
+        orig_key = cache.key(file_hash, i, kind="orig", dpi=args.dpi, format=args.media_format,
+                             quality=args.media_quality, budget_mb=args.budget_mb)
+        pdf_key = cache.key(file_hash, i, kind="pdf", **params)
+        keys[i] = (masked_key, orig_key, pdf_key)
+        masked_path = cache.get(masked_key, ext)
+        orig_path = cache.get(orig_key, ext) if args.build_apkg else None
+        pdf_path = None if embeddable else cache.get(pdf_key, ".jpg")
+        if masked_path and (orig_path or not args.build_apkg) and (pdf_path or embeddable):
+            cached[i] = (masked_path, orig_path, pdf_path)
+        else:
+            misses.append(i)
+    if cached:
+        print(f"  ♻️ {len(cached)} av {len(indices)} sidor från cache")
+
+    processed = iter_processed_pages(args, misses, args.workers, args.max_in_flight, max_bytes, pool)
+    for i in indices:
+        if i in cached:
+            masked_path, orig_path, pdf_path = cached[i]
+            data = read_bytes(masked_path)
+            w, h = image_size(data)
+            korrapport.event("cache_hit", page=i + 1)
+            yield PageResult(i + 1, w, h, read_bytes(orig_path) if orig_path else None,
+                             data, read_bytes(pdf_path) if pdf_path else None, [], None)
+        else:
+            result = next(processed)
+            masked_key, orig_key, pdf_key = keys[i]
+            cache.put_bytes(masked_key, result.masked, ext)
+            if result.orig is not None:
+                cache.put_bytes(orig_key, result.orig, ext)
+            if result.pdf is not None:
+                cache.put_bytes(pdf_key, result.pdf, ".jpg")
+            yield result
+
+def bench_workers(args):
+    """Skriv ut sidor/s för 1..args.workers processer (ingen utdata skrivs)."""
+    print(f"⏱️ Mäter genomströmning för 1..{args.workers} processer")
+    for n in range(1, args.workers + 1):
+        t0 = time.perf_counter()
+        indices = page_indices(args)
+        pages = sum(1 for _ in iter_processed_pages(args, indices, n, args.max_in_flight,
+                                                    image_max_bytes(args, len(indices))))
+        dt = time.perf_counter() - t0
+        print(f"  {n:2d} processer: {pages} sidor på {dt:.2f} s = {pages / dt:.2f} sidor/s")
+
+def run_stream(args, out_img, out_pdf, pool=None):
+    """Rasterisera → maska → koda en sida i taget, helt i minnet.
+
+    Varje bild kodas exakt en gång i --media-format: den maskade bilden skrivs
+    till disk och samma bytes bäddas in i PDF:en (webp kodas även som jpeg,
+    eftersom PDF inte kan innehålla webp). Originalsidan kodas bara om .apkg
+    ska byggas.
+    """
+    os.makedirs(out_img, exist_ok=True)
+    cache = RenderCache(args.cache_dir, enabled=not args.no_cache,
+                        max_mb=args.cache_max_mb, max_age_days=args.cache_max_age_days)
+    ext = extension(args.media_format)
+    encode_stats = EncodeStats()
+    report = korrapport.active()
+    pdf = fitz.open()
+    for result in iter_pages(args, cache, pool):
+        num = result.num
+        report.extend(result.report)
+        with korrapport.stage("write", page=num):
+            if result.orig is not None:
+                write_bytes(os.path.join(out_img, f"page_{num:03d}{ext}"), result.orig)
+            write_bytes(os.path.join(out_img, f"page_{num:03d}_masked{ext}"), result.masked)
+        with FITZ_LOCK, korrapport.stage("pdf", page=num):
+            append_image_page(pdf, result.pdf or result.masked, result.width, result.height, args.dpi)
+        encode_stats.extend(result.stats)
+    if pdf.page_count:
+        with korrapport.stage("pdf_save"):
+            pdf.save(out_pdf, deflate=True)
+    pdf.close()
+    cache.evict()
+    report_encoding(encode_stats, args)
+
+def report_encoding(encode_stats, args):
+    """Sammanfattning av bildkodningen, och --encode-report om den angetts."""
+    encode_stats.print_summary()
+    if args.encode_report:
+        encode_stats.write_csv(args.encode_report)
+        print(f"📝 Kodningsrapport: {args.encode_report}")
 
 def main():
     args = parse_args()
+    report, profiler = korrapport.start(args.report, args.profile, args.report_memory,
+                                        script="maska_ratt_svar", args=vars(args))
+    try:
+        run(args)
+    finally:
+        korrapport.finish(report, args.report, profiler, args.profile)
+
+def run(args):
+    if is_batch_input(args.pdf_path):
+        run_batch(args)
+        return
+    args.skip_pages = resolve_skip_pages(args)
+
+    if args.bench_workers:
+        bench_workers(args)
+        return
+
+    out_img = mask_file(args)
+    if args.build_apkg:
+        print("4) Bygger .apkg…")
+        build_apkg_from_images(out_img, args.apkg or DEFAULT_APKG, split_questions=args.split_questions,
+                               dpi=args.dpi, question_gap=args.question_gap,
+                               exam=exam_label(args.pdf_path), delta=args.delta)
+
+def mask_file(args, pool=None):
+    """Maska args.pdf_path till args.out_dir (tenta_maskad.pdf + masked_images). Returnerar bildmappen."""
     out_dir = args.out_dir
     out_img = os.path.join(out_dir, "masked_images")
     os.makedirs(out_dir, exist_ok=True)
-
-    print("1) Rasteriserar PDF…")
-    pages = pdf_to_images(args.pdf_path, args.dpi, out_img, skip_pages=args.skip_pages)
-
-    print(f"2) Maskar sidor (mode={args.mode})…")
-    masked_paths = []
-    for p in pages:
-        bgr = cv2.imread(p)
-        if args.mode == "green":
-            masked = mask_green(
-                bgr, args.h1, args.h2, args.s1, args.v1,
-                args.min_area, args.th_low, args.th_high, args.line_thickness
-            )
-        elif args.mode == "column":
-            masked = mask_column(
-                bgr, args.col_x_perc, args.col_width, args.col_top_perc, args.col_bot_perc
-            )
-        else:  # replicate
-            masked = mask_replicate(bgr, args)
-
-        outp = p.replace(".png", "_masked.png")
-        cv2.imwrite(outp, masked)
-        masked_paths.append(outp)
-
-    print("3) Bygger ny PDF…")
     out_pdf = os.path.join(out_dir, "tenta_maskad.pdf")
-    images_to_pdf(masked_paths, out_pdf)
+    args.layout = resolve_layout(args)
+
+    if args.vector:
+        print(f"1-3) Maskar käll-PDF:en som vektor (mode={args.mode}, {args.vector_style})…")
+        run_vector(args, out_img, out_pdf)
+        print(f"✅ Ny PDF klar: {out_pdf}")
+        if args.build_apkg:
+            print(f"📁 Bilder: {out_img}")
+        return out_img
+
+    if args.stream or args.workers > 1 or pool is not None:
+        print(f"1-3) Rasteriserar, maskar (mode={args.mode}) och bygger PDF i minnet…")
+        run_stream(args, out_img, out_pdf, pool)
+        print(f"✅ Ny PDF klar: {out_pdf}")
+        print(f"📁 Bilder: {out_img}")
+        return out_img
+
+    print(f"1-3) Rasteriserar, maskar (mode={args.mode}) och bygger ny PDF…")
+    os.makedirs(out_img, exist_ok=True)
+    doc = fitz.open(args.pdf_path)
+    utan_doc = open_utan_doc(args)
+    report = korrapport.active()
+    encode_stats = EncodeStats()
+    pdf = fitz.open()
+    indices = page_indices(args)
+    ext = extension(args.media_format)
+    # PNG-original utan budget sparas direkt från pixmappen i rasteriseringen, övriga
+    # kodas (för .apkg) i --media-format. Den maskade sidan kodas en gång och samma
+    # bytes skrivs till disk och läggs som sida i PDF:en (webp även som jpeg)
+    orig_dir = out_img if args.media_format == "png" and not args.budget_mb else None
+    pages = page_pipeline(args, doc, utan_doc, indices, image_max_bytes(args, len(indices)), orig_dir)
+    try:
+        for result in pages:
+            report.extend(result.report)
+            if result.orig is not None:
+                write_bytes(os.path.join(out_img, f"page_{result.num:03d}{ext}"), result.orig)
+            write_bytes(os.path.join(out_img, f"page_{result.num:03d}_masked{ext}"), result.masked)
+            with FITZ_LOCK, korrapport.stage("pdf", page=result.num):
+                append_image_page(pdf, result.pdf or result.masked, result.width, result.height, args.dpi)
+            encode_stats.extend(result.stats)
+    finally:
+        pages.close()  # stoppa sidflödets trådar innan dokumenten stängs
+        for d in (doc, utan_doc):
+            if d is not None:
+                d.close()
+    if pdf.page_count:
+        with korrapport.stage("pdf_save"):
+            pdf.save(out_pdf, deflate=True)
+    pdf.close()
+    report_encoding(encode_stats, args)
     print(f"✅ Ny PDF klar: {out_pdf}")
     print(f"📁 Bilder: {out_img}")
+    return out_img
 
-    if args.build_apkg:
-        print("4) Bygger .apkg…")
-        build_apkg_from_images(out_img)
+def learn_layout(args):
+    """Lär in tentans layout ur de första sidorna med bock (i analys-DPI:n, snabbdetektorn).
+
+    Returnerar en sidlayout.Layout i pixlar för --dpi, eller None.
+    """
+    analysis_dpi = resolve_analysis_dpi(args)
+    k = round(args.dpi / analysis_dpi)
+    sargs = scale_pixel_args(args, 1 / k)
+    samples = []
+    with fitz.open(args.pdf_path) as doc:
+        for i in range(args.skip_pages, min(doc.page_count, args.skip_pages + sidlayout.LEARN_MAX_PAGES)):
+            img = render_bgr(doc, i, analysis_dpi)
+            analysis = analyze_page(img, sargs)
+            bbox = find_green_tick_bbox(img, sargs.h1, sargs.h2, sargs.s1, sargs.v1, sargs.min_area, analysis)
+            if bbox is None:
+                continue
+            rows = []
+            if args.mode == "replicate":
+                rows = find_option_circles(analysis.gray, bbox, sargs.hc_min_dist, sargs.hc_min_radius,
+                                           sargs.hc_max_radius, band=sargs.circle_band,
+                                           green_mask=analysis.green_mask)
+            samples.append((bbox, rows))
+            if sum(args.mode == "column" or len(r) >= sargs.rep_min_circles
+                   for _, r in samples) >= sidlayout.LEARN_PAGES:
+                break
+    return sidlayout.scale_layout(sidlayout.from_samples(samples, sargs.rep_min_circles), k)
+
+def resolve_layout(args):
+    """Layouten för args.pdf_path: ur profilen i renderingscachen, annars inlärd (och sparad).
+
+    Bara replicate- och column-läget använder den, och inte med --no-layout.
+    """
+    if args.no_layout or args.mode not in ("replicate", "column") or args.detect == "pdf":
+        return None
+    cache = RenderCache(args.cache_dir, enabled=not args.no_cache,
+                        max_mb=args.cache_max_mb, max_age_days=args.cache_max_age_days)
+    key = None
+    if cache.enabled:
+        key = cache.key(cache.file_hash(args.pdf_path), args.skip_pages, kind="layout", **mask_params(args))
+        meta = cache.get_meta(key)
+        if meta is not None:
+            layout = sidlayout.from_meta(meta)
+            source = "profil"
+    if key is None or meta is None:
+        with korrapport.stage("layout"):
+            layout = learn_layout(args)
+        source = "inlärd"
+        if key is not None:
+            cache.put_meta(key, sidlayout.to_meta(layout))
+    if layout is None:
+        print("📐 Ingen gemensam layout hittad – full detektion på varje sida")
+    elif layout.pitch:
+        print(f"📐 Layout ({source}): kolumn x={layout.x:.0f}, ringradie {layout.radius:.1f}, "
+              f"radavstånd {layout.pitch:.0f} px")
+    else:
+        print(f"📐 Layout ({source}): kolumn x={layout.x:.0f} px")
+    return layout
+
+# ====== Batchläge ======
+def is_batch_input(path):
+    """En mapp eller ett globmönster i stället för en enskild PDF."""
+    return os.path.isdir(path) or glob.has_magic(path)
+
+def batch_inputs(pattern):
+    """(PDF:er att maska, övriga PDF:er) för en mapp (rekursivt) eller ett globmönster.
+
+    Finns det filer med facit i namnet maskas bara de; de övriga används som
+    sidor utan facit i diff-läget. Annars maskas alla.
+    """
+    if os.path.isdir(pattern):
+        paths = find_exam_pdfs(pattern)
+    else:
+        paths = sorted(p for p in glob.glob(pattern, recursive=True) if p.lower().endswith(".pdf"))
+    facit = [p for p in paths if is_facit(p)]
+    if not facit:
+        return paths, []
+    return facit, [p for p in paths if not is_facit(p)]
+
+def clean_name(name):
+    """Rensa ett tentanamn för användning som mapp- eller filnamn."""
+    return re.sub(r'[^A-Za-z0-9_-]+', '_', name).strip("_")
+
+def exam_label(pdf_path):
+    """Tentans namn i batchläget: filnamnet utan ändelse och 'facit'."""
+    base = os.path.splitext(os.path.basename(pdf_path))[0]
+    return re.sub(r'[\s_-]*facit[\s_-]*', ' ', base, flags=re.IGNORECASE).strip(" -_") or base
+
+def detect_skip_pages(pdf_path, args, utan_path=None, max_skip=MAX_AUTO_SKIP):
+    """Antal försättssidor: sidor före den första som har en facitmarkering.
+
+    Gröna markeringar letas först i PDF-strukturen; sidor utan sådana
+    (skannade sidor med textlager, bocken som bild) renderas i låg upplösning
+    och letas igenom efter grönt i samma HSV-intervall som maskningen. Med
+    --detect pdf räcker strukturen på sidor som har innehåll. I diff-läget räknas första sidan som
+    skiljer sig från tentan utan facit. Hittas ingen räknas inga sidor bort.
+    """
+    dpi = 36
+    min_px = max(1, args.min_area * (dpi / args.dpi) ** 2)
+    with fitz.open(pdf_path) as doc:
+        utan_doc = fitz.open(utan_path) if utan_path else None
+        try:
+            for i in range(min(doc.page_count, max_skip + 1)):
+                if utan_doc is not None:
+                    a, b = render_bgr(doc, i, dpi), render_bgr(utan_doc, i, dpi)
+                    if b is None or a.shape != b.shape or (cv2.absdiff(a, b).max(axis=2) > args.diff_thresh).sum() >= min_px:
+                        return i
+                    continue
+                if args.detect != "pixel":
+                    marks = find_pdf_marks(doc[i], args.h1, args.h2, args.s1, args.v1)
+                    if marks.green:
+                        return i
+                    if marks.has_content and args.detect == "pdf":
+                        continue
+                hsv = cv2.cvtColor(render_bgr(doc, i, dpi), cv2.COLOR_BGR2HSV)
+                if cv2.countNonZero(cv2.inRange(hsv, (args.h1, args.s1, args.v1), (args.h2, 255, 255))) >= min_px:
+                    return i
+        finally:
+            if utan_doc is not None:
+                utan_doc.close()
+    return 0
+
+def resolve_skip_pages(args):
+    """--skip-pages som heltal: 0 om inget angetts, detect_skip_pages för 'auto'."""
+    if args.skip_pages is None:
+        return 0
+    if args.skip_pages == "auto":
+        utan = args.utan if args.mode == "diff" else None
+        return detect_skip_pages(args.pdf_path, args, utan)
+    return args.skip_pages
+
+def exam_names(pdfs):
+    """Tentanamn per PDF (exam_label); samma namn i flera mappar får mappnamnet framför."""
+    names, out = set(), {}
+    for pdf in pdfs:
+        name = exam_label(pdf)
+        if name in names:
+            name = f"{os.path.basename(os.path.dirname(pdf))} {name}"
+        names.add(name)
+        out[pdf] = name
+    return out
+
+def pair_utan(args, facit, others):
+    """facit -> tenta utan facit i diff-läget (parade på filnamnet), annars tomt."""
+    if args.mode != "diff":
+        return {}
+    return {med: utan for utan, med, _ in match_pairs(others, facit)}
+
+def mask_exam(args, pdf, utan, name, pool=None):
+    """Maska en tenta i batchläget till out_dir/<namn>. Returnerar bildmappen, eller None."""
+    file_args = argparse.Namespace(**{**vars(args), "pdf_path": pdf, "utan": utan,
+                                      "out_dir": os.path.join(args.out_dir, clean_name(name))})
+    if args.mode == "diff" and not utan:
+        print(f"⚠️ Ingen tenta utan facit hittad för {pdf} - hoppar över")
+        korrapport.event("unmatched", file=pdf)
+        return None
+    if file_args.skip_pages is None:
+        file_args.skip_pages = "auto"  # försättssidorna varierar mellan tentor
+    file_args.skip_pages = resolve_skip_pages(file_args)
+    print(f"\n📄 {name}: {pdf} (hoppar över {file_args.skip_pages} sidor)")
+    korrapport.event("batch_file", file=pdf, skip_pages=file_args.skip_pages)
+    return mask_file(file_args, pool)
+
+def batch_apkg_path(args):
+    return args.apkg or os.path.join(args.out_dir, DEFAULT_BATCH_APKG)
+
+def run_batch(args):
+    """Maska alla tentor i en mapp/glob i en process och bygg ett samlat .apkg.
+
+    Processpoolen (--workers) skapas en gång och delas av alla filer, så
+    uppstart av Python/OpenCV/fitz betalas bara en gång. I diff-läget paras
+    varje facit med sin tenta utan facit på filnamnet (parning.py).
+    """
+    facit, others = batch_inputs(args.pdf_path)
+    if not facit:
+        print(f"❌ Inga PDF:er hittades i {args.pdf_path}")
+        return
+    utan_for = pair_utan(args, facit, others)
+    print(f"📚 Batch: {len(facit)} tentor")
+
+    exams = []
+    pool = make_pool(args) if args.workers > 1 and not args.vector else None
+    try:
+        for pdf, name in exam_names(facit).items():
+            img_dir = mask_exam(args, pdf, utan_for.get(pdf), name, pool)
+            if img_dir is not None:
+                exams.append((name, img_dir))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    if args.build_apkg and exams:
+        print("\n4) Bygger samlat .apkg…")
+        build_batch_apkg(exams, batch_apkg_path(args), split_questions=args.split_questions, dpi=args.dpi,
+                         question_gap=args.question_gap, delta=args.delta)
 
 if __name__ == "__main__":
     # Snabbstart: om inga argument → försök köra på defaultfil med rimliga parametrar
@@ -0,0 +1,131 @@
+import io
+import csv
+import time
+import cv2
+import numpy as np
+from PIL import Image
+
+"""
+Kodning av sidbilder för .apkg/PDF med valbart format och kvalitet.
+
+Format:
+  - png          -> förlustfri färg-PNG (som tidigare)
+  - png-gray     -> förlustfri gråskale-PNG (en kanal i stället för tre)
+  - png-palette  -> palett-PNG; kvalitet 1–100 styr antal färger (2–256)
+  - jpeg / webp  -> förstörande; kvalitet 1–100
+
+Med en byte-budget (max_bytes) binärsöks kvaliteten fram till den högsta som
+håller sig under budgeten. Förlustfria format kan inte justeras.
+"""
+
+FORMATS = ("png", "png-gray", "png-palette", "jpeg", "webp")
+EXTENSIONS = {"png": ".png", "png-gray": ".png", "png-palette": ".png", "jpeg": ".jpg", "webp": ".webp"}
+DEFAULT_QUALITY = {"png-palette": 25, "jpeg": 80, "webp": 80}  # 25 % av 256 = 64 färger
+MIN_QUALITY = 10
+
+def extension(fmt):
+    return EXTENSIONS[fmt]
+
+def is_tunable(fmt):
+    return fmt in DEFAULT_QUALITY
+
+def encode_image(img, fmt="png", quality=None, rgb=False):
+    """Koda en bild (BGR, eller RGB om rgb=True) till bytes i valt format."""
+    if quality is None:
+        quality = DEFAULT_QUALITY.get(fmt, 100)
+    quality = int(max(1, min(100, quality)))
+    if fmt == "png-palette":
+        pil = Image.fromarray(img if rgb else cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+        colors = max(2, min(256, round(256 * quality / 100)))
+        pal = pil.quantize(colors=colors, method=Image.Quantize.FASTOCTREE)
+        buf = io.BytesIO()
+        pal.save(buf, format="PNG", optimize=True)
+        return buf.getvalue()
+
+    if fmt == "png-gray":
+        img = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY if rgb else cv2.COLOR_BGR2GRAY)
+    elif rgb:
+        img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+    if fmt == "jpeg":
+        ext, params = ".jpg", [cv2.IMWRITE_JPEG_QUALITY, quality, cv2.IMWRITE_JPEG_OPTIMIZE, 1]
+    elif fmt == "webp":
+        ext, params = ".webp", [cv2.IMWRITE_WEBP_QUALITY, quality]
+    else:
+        ext, params = ".png", []
+    ok, buf = cv2.imencode(ext, img, params)
+    if not ok:
+        raise RuntimeError(f"Kunde inte koda {fmt}")
+    return buf.tobytes()
+
+def encode_to_budget(img, fmt="png", quality=None, max_bytes=0, rgb=False):
+    """Koda med högsta kvalitet ≤ quality som ger högst max_bytes.
+
+    Returnerar (bytes, använd kvalitet). Utan budget, eller för förlustfria
+    format, kodas bilden en gång med quality.
+    """
+    if quality is None:
+        quality = DEFAULT_QUALITY.get(fmt, 100)
+    data = encode_image(img, fmt, quality, rgb)
+    if not max_bytes or len(data) <= max_bytes or not is_tunable(fmt):
+        return data, quality
+
+    lo, hi = MIN_QUALITY, quality - 1
+    best, best_q = None, lo
+    while lo <= hi:
+        q = (lo + hi) // 2
+        candidate = encode_image(img, fmt, q, rgb)
+        if len(candidate) <= max_bytes:
+            best, best_q = candidate, q
+            lo = q + 1
+        else:
+            hi = q - 1
+    if best is None:  # budgeten går inte att nå – ta lägsta kvaliteten
+        best, best_q = encode_image(img, fmt, MIN_QUALITY, rgb), MIN_QUALITY
+    return best, best_q
+
+def image_size(data):
+    """(bredd, höjd) ur en kodad bild; läser bara huvudet."""
+    with Image.open(io.BytesIO(data)) as im:
+        return im.size
+
+class EncodeStats:
+    """Samlar storlek och kodningstid per bild för avvägningsrapporten."""
+
+    def __init__(self):
+        self.rows = []
+
+    def add(self, name, fmt, quality, width, height, nbytes, seconds):
+        self.rows.append({
+            "name": name, "format": fmt, "quality": quality,
+            "width": width, "height": height, "bytes": nbytes,
+            "raw_bytes": width * height * 3, "encode_ms": round(seconds * 1000, 2),
+        })
+
+    def timed_encode(self, name, img, fmt, quality=None, max_bytes=0, rgb=False):
+        t0 = time.perf_counter()
+        data, used_q = encode_to_budget(img, fmt, quality, max_bytes, rgb)
+        h, w = img.shape[:2]
+        self.add(name, fmt, used_q, w, h, len(data), time.perf_counter() - t0)
+        return data
+
+    def extend(self, rows):
+        self.rows.extend(rows)
+
+    def print_summary(self):
+        if not self.rows:
+            return
+        total = sum(r["bytes"] for r in self.rows)
+        raw = sum(r["raw_bytes"] for r in self.rows)
+        ms = [r["encode_ms"] for r in self.rows]
+        fmts = sorted({r["format"] for r in self.rows})
+        print(f"🗜️ Media: {len(self.rows)} bilder, {total / 1e6:.1f} MB "
+              f"({100 * total / raw:.1f} % av rått), {', '.join(fmts)}, "
+              f"kodning {np.mean(ms):.0f} ms/bild (max {max(ms):.0f} ms)")
+
+    def write_csv(self, path):
+        if not self.rows:
+            return
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=list(self.rows[0]))
+            writer.writeheader()
+            writer.writerows(self.rows)
@@ -0,0 +1,247 @@
+import os
+import csv
+import sys
+import time
+import argparse
+import itertools
+import threading
+from collections import namedtuple
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+import fitz  # PyMuPDF
+import maska_ratt_svar as maska
+
+"""
+Parametersvep: prova många maskningsparametrar mot en tenta i en process.
+
+Sidorna rasteriseras och skalas ner till analysupplösningen en gång och
+hålls i minnet; varje kombination kör bara detektionen (samma kod som
+maska_ratt_svar i pixelläget) på de färdiga bilderna. Gråskalan delas av
+alla kombinationer och grönanalysen av alla med samma HSV-intervall, så
+att svepa --col-* eller --hc-* kostar bara själva cirkel-/stapelsteget.
+Kombinationerna körs i trådar (OpenCV släpper GIL:en). Helsidorna vid
+inläsningen och maskytorna i poängsättningen tas ur maska.PAGE_BUFFERS,
+så ett svep allokerar inte nya sidstora arrayer per kombination och sida.
+
+Poäng per kombination, mot de gröna markeringarna enligt grundinställningarna:
+  täckning   andel gröna pixlar som hamnar under en mask (alla sidor)
+  hela       sidor där minst FULL_COVERAGE av det gröna är maskat
+  hoppade    sidor med grön markering som lämnades helt omaskade
+  yta        maskad andel av sidorna (mindre är bättre vid lika täckning)
+Rangordningen är täckning, sedan färre hoppade sidor, sedan mindre yta.
+"""
+
+FULL_COVERAGE = 0.99
+# Kan inte svepas: sidorna rasteriseras och skalas en gång med dessa
+FIXED_ARGS = {"dpi", "analysis_dpi", "skip_pages", "detect", "utan", "pdf_path", "out_dir"}
+
+# En förberedd sida: num (1-indexerad), small/utan (BGR i analys-DPI), gray,
+# green = referensens gröna pixlar (bool) och n_green = antal
+SweepPage = namedtuple("SweepPage", "num small utan gray green n_green")
+
+def _grid_values(spec, default):
+    """"10:30:5" (inklusive slut) eller "10,15,20", tolkat som grundvärdets typ."""
+    kind = type(default) if default is not None else str
+    if ":" in spec and kind in (int, float):
+        start, stop, step = (kind(v) for v in spec.split(":"))
+        n = int(round((stop - start) / step)) + 1
+        return [kind(round(start + i * step, 6)) for i in range(max(0, n))]
+    return [kind(v) for v in spec.split(",")]
+
+def parse_grid(specs, base):
+    """["col_top_perc=10:30:5", "h1=30,35"] -> {"col_top_perc": [...], "h1": [...]}.
+
+    Namnen är argumentens dest (bindestreck går också bra).
+    """
+    grid = {}
+    for spec in specs:
+        name, _, values = spec.partition("=")
+        name = name.strip().lstrip("-").replace("-", "_")
+        if not hasattr(base, name) or not values:
+            raise ValueError(f"okänd parameter eller inga värden: {spec}")
+        if name in FIXED_ARGS or not maska.is_mask_param(name):
+            raise ValueError(f"{name} kan inte svepas (sidorna rasteriseras en gång)")
+        grid[name] = _grid_values(values, getattr(base, name))
+    if "diff" in grid.get("mode", []) and not base.utan:
+        raise ValueError("mode=diff kräver --utan")
+    return grid
+
+def combinations(grid):
+    """Alla kombinationer som dictar, HSV-parametrarna ytterst så att grönanalysen återanvänds."""
+    names = sorted(grid, key=lambda n: (n not in ("h1", "h2", "s1", "v1", "roi_scale"), n))
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[n] for n in names))]
+
+def load_pages(args):
+    """Rasterisera sidorna (efter --skip-pages) en gång och skala ner till analys-DPI:n."""
+    analysis_dpi = maska.resolve_analysis_dpi(args)
+    k = max(1, round(args.dpi / analysis_dpi))
+    sargs = maska.scale_pixel_args(args, 1 / k)
+    pages = []
+    with fitz.open(args.pdf_path) as doc:
+        utan_doc = fitz.open(args.utan) if args.utan else None
+        try:
+            buffers = maska.PAGE_BUFFERS
+            for i in range(args.skip_pages, doc.page_count):
+                full = maska.render_bgr(doc, i, args.dpi, buffers)
+                small = maska.downscale(full, k)
+                buffers.give(full)
+                utan = None
+                if utan_doc is not None:
+                    full = maska.render_bgr(utan_doc, i, args.dpi, buffers)
+                    utan = maska.downscale(full, k) if full is not None else None
+                    buffers.give(full)
+                    if utan is not None and utan.shape != small.shape:
+                        utan = cv2.resize(utan, (small.shape[1], small.shape[0]), interpolation=cv2.INTER_AREA)
+                gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+                green = maska.analyze_page(small, sargs, gray).green_raw > 0
+                n_green = int(np.count_nonzero(green))
+                if n_green < sargs.min_area:
+                    green, n_green = None, 0  # ingen markering att täcka på sidan
+                pages.append(SweepPage(i + 1, small, utan, gray, green, n_green))
+        finally:
+            if utan_doc is not None:
+                utan_doc.close()
+    return pages, k
+
+def shape_mask(shapes, shape):
+    """Bool-mask över det som formerna täcker ("utan"-former räknas som rutor).
+
+    Masken tas ur maska.PAGE_BUFFERS; lämna tillbaka den med give() efteråt.
+    """
+    buffers = maska.PAGE_BUFFERS
+    img = buffers.take(shape[:2])
+    img.fill(255)
+    rects = [maska.rect_shape(s.x1, s.y1, s.x2 - 1, s.y2 - 1) if s.kind == "utan" else s for s in shapes]
+    mask = np.equal(maska.draw_shapes(img, rects), 0, out=buffers.take(shape[:2], bool))
+    buffers.give(img)
+    return mask
+
+class Sweep:
+    """Förberedda sidor + delade grönanalyser; score() kan anropas från flera trådar."""
+
+    def __init__(self, base, pages, k):
+        self.base = base
+        self.pages = pages
+        self.k = k
+        self._analyses = {}
+        self._lock = threading.Lock()
+
+    def args_for(self, params):
+        """Kombinationens args, omräknade till analys-DPI:n."""
+        args = argparse.Namespace(**{**vars(self.base), **params, "detect": "pixel"})
+        return maska.scale_pixel_args(args, 1 / self.k)
+
+    def analysis(self, page, args):
+        key = (page.num, args.h1, args.h2, args.s1, args.v1, args.roi_scale)
+        with self._lock:
+            found = self._analyses.get(key)
+            if found is None:
+                found = self._analyses[key] = maska.analyze_page(page.small, args, page.gray)
+        return found
+
+    def shapes(self, page, args):
+        analysis = None if args.mode == "diff" else self.analysis(page, args)
+        return maska.find_mask_shapes(page.small, args, page.utan, analysis)[0]
+
+    def score(self, params):
+        args = self.args_for(params)
+        t0 = time.perf_counter()
+        buffers = maska.PAGE_BUFFERS
+        covered = total = full = skipped = 0
+        area = 0.0
+        for page in self.pages:
+            shapes = self.shapes(page, args)
+            mask = shape_mask(shapes, page.small.shape) if shapes else None
+            if mask is not None:
+                area += np.count_nonzero(mask) / mask.size
+            if page.green is None:
+                buffers.give(mask)
+                continue
+            total += page.n_green
+            if mask is None:
+                skipped += 1
+                continue
+            hit = int(np.count_nonzero(np.logical_and(mask, page.green, out=mask)))
+            buffers.give(mask)
+            covered += hit
+            full += hit >= FULL_COVERAGE * page.n_green
+        return {
+            **params,
+            "coverage": round(covered / total, 4) if total else 0.0,
+            "full_pages": full,
+            "skipped": skipped,
+            "area": round(area / max(1, len(self.pages)), 4),
+            "ms": round((time.perf_counter() - t0) * 1000, 1),
+        }
+
+def rank(results):
+    return sorted(results, key=lambda r: (-round(r["coverage"], 3), r["skipped"], r["area"]))
+
+def run_sweep(base, grid, threads=0, progress=True):
+    """Rasterisera en gång, poängsätt alla kombinationer i grid. Returnerar (Sweep, rangordnade resultat)."""
+    t0 = time.perf_counter()
+    pages, k = load_pages(base)
+    sweep = Sweep(base, pages, k)
+    combos = combinations(grid)
+    n_green = sum(p.green is not None for p in pages)
+    print(f"🖼️ {len(pages)} sidor ({n_green} med grön markering) i {base.dpi / k:.0f} dpi "
+          f"på {time.perf_counter() - t0:.1f} s; {len(combos)} kombinationer…")
+    results = []
+    t1 = time.perf_counter()
+    # Detektionen skriver ut per sida – tyst under svepet, framsteg till stderr
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        with ThreadPoolExecutor(max_workers=threads or os.cpu_count() or 1) as pool:
+            for n, result in enumerate(pool.map(sweep.score, combos), 1):
+                results.append(result)
+                if progress and (n % 25 == 0 or n == len(combos)):
+                    print(f"  {n}/{len(combos)} ({time.perf_counter() - t1:.1f} s)", file=sys.stderr)
+    return sweep, rank(results)
+
+def print_table(results, names, top=15):
+    header = [*names, "täckning", "hela", "hoppade", "yta", "ms"]
+    rows = [[str(r[n]) for n in names] + [f"{r['coverage'] * 100:.1f} %", str(r["full_pages"]),
+                                          str(r["skipped"]), f"{r['area'] * 100:.1f} %", f"{r['ms']:.0f}"]
+            for r in results[:top]]
+    widths = [max(len(h), *(len(row[i]) for row in rows)) for i, h in enumerate(header)] if rows else []
+    print("  #  " + "  ".join(h.rjust(w) for h, w in zip(header, widths)))
+    for i, row in enumerate(rows, 1):
+        print(f"{i:3d}  " + "  ".join(c.rjust(w) for c, w in zip(row, widths)))
+
+def write_csv(results, names, path):
+    fields = [*names, "coverage", "full_pages", "skipped", "area", "ms"]
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=["rank", *fields])
+        writer.writeheader()
+        for i, r in enumerate(results, 1):
+            writer.writerow({"rank": i, **{k: r[k] for k in fields}})
+
+def contact_sheet(sweep, params, path, title="", max_pages=8, thumb_width=320, columns=4):
+    """Miniatyrer av de första sidorna med grön markering, maskade med params."""
+    args = sweep.args_for(params)
+    pages = [p for p in sweep.pages if p.green is not None][:max_pages] or sweep.pages[:max_pages]
+    thumbs = []
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        for page in pages:
+            shapes = sweep.shapes(page, args)
+            masked = maska.draw_shapes(maska.PAGE_BUFFERS.copy(page.small), shapes, page.utan)
+            scale = thumb_width / masked.shape[1]
+            img = cv2.resize(masked, (thumb_width, round(masked.shape[0] * scale)), interpolation=cv2.INTER_AREA)
+            maska.PAGE_BUFFERS.give(masked)
+            cv2.putText(img, f"s. {page.num}", (6, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 2)
+            thumbs.append(img)
+    if not thumbs:
+        return None
+    h = max(t.shape[0] for t in thumbs)
+    rows = []
+    for i in range(0, len(thumbs), columns):
+        row = [cv2.copyMakeBorder(t, 0, h - t.shape[0], 0, 0, cv2.BORDER_CONSTANT, value=(255, 255, 255))
+               for t in thumbs[i:i + columns]]
+        row += [np.full_like(row[0], 255)] * (columns - len(row))
+        rows.append(np.hstack(row))
+    sheet = np.vstack(rows)
+    banner = np.full((32, sheet.shape[1], 3), 255, dtype=np.uint8)
+    cv2.putText(banner, title, (8, 22), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 0), 1)
+    cv2.imwrite(path, np.vstack([banner, sheet]))
+    return path
@@ -0,0 +1,185 @@
+import os
+import re
+from collections import namedtuple
+
+"""
+Para ihop tentor utan facit med sina facit utifrån filnamnen.
+
+Varje filnamn tolkas en gång (termin, typ, år och övriga ord). Facitfilerna
+indexeras på (termin, typ, år) så att bara kompatibla kandidater jämförs –
+ett fält som saknas i namnet matchar allt. Paren väljs sedan med
+ungerska metoden per sammanhängande grupp av kandidater: varje facit används
+högst en gång och den sammanlagda likheten blir så hög som möjligt.
+"""
+
+MIN_SIMILARITY = 0.3   # lägre likhet räknas inte som en match
+SAME_DIR_BONUS = 0.5   # vid lika namn vinner facit i samma mapp (flera kurser i ett arkiv)
+SKIP_DIRS = {"anki_build", "__pycache__", "node_modules", "cache"}  # arbets-/cachemappar
+
+# path: sökvägen, termin/typ/year: None om de saknas, words: övriga ord i namnet
+NameKey = namedtuple("NameKey", "path termin typ year words")
+
+_UTAN_RE = re.compile(r'\s*utan[\s_-]+(svar|facit)\s*', re.IGNORECASE)
+_FACIT_RE = re.compile(r'\s*facit\s*', re.IGNORECASE)
+_TERMIN_RE = re.compile(r'(ht|vt)(\d{2,4})')
+_YEAR_RE = re.compile(r'(20\d{2})')
+
+def is_facit(name):
+    """Filen har facit: "facit" i namnet, men inte som i "utan facit"."""
+    return "facit" in _UTAN_RE.sub(" ", os.path.basename(name)).lower()
+
+def find_exam_pdfs(root=".", skip_dirs=SKIP_DIRS):
+    """Alla PDF:er under root (rekursivt, sorterat), utom i dolda mappar och arbetsmappar."""
+    found = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith((".", "_")) and d not in skip_dirs)
+        for name in filenames:
+            if name.lower().endswith(".pdf") and not name.lower().endswith("_maskad.pdf"):
+                found.append(os.path.normpath(os.path.join(dirpath, name)))
+    return sorted(found)
+
+def name_key(path):
+    """Tolka filnamnet en gång: termin (ht22), typ (ordinarie/rest), år och övriga ord."""
+    name = os.path.basename(path)
+    name = _FACIT_RE.sub("", name) if is_facit(name) else _UTAN_RE.sub("", name)
+    lower = name.lower()
+
+    termin = _TERMIN_RE.search(lower)
+    typ = "ordinarie" if "ordinarie" in lower else "rest" if "rest" in lower else None
+    year = _YEAR_RE.search(lower)
+
+    # Orden jämförs utan termin, typ och år
+    cleaned = re.sub(r'(ht|vt)\d{2,4}', '', lower)
+    cleaned = re.sub(r'(ordinarie|rest)', '', cleaned)
+    cleaned = re.sub(r'20\d{2}', '', cleaned)
+    cleaned = re.sub(r'[^a-z0-9\s]', ' ', cleaned)
+    return NameKey(path, termin.group(0) if termin else None, typ,
+                   year.group(1) if year else None, frozenset(cleaned.split()))
+
+def _compatible(a, b):
+    return a is None or b is None or a == b
+
+def similarity(k1, k2):
+    """Likhet 0–1 mellan två tolkade namn; 0 om termin, typ eller år skiljer sig."""
+    return min(1.0, _raw_similarity(k1, k2))
+
+def _raw_similarity(k1, k2):
+    """Som similarity men utan taket 1.0, så att lika termin/typ/år inte ger oavgjort."""
+    if not (_compatible(k1.termin, k2.termin) and _compatible(k1.typ, k2.typ)
+            and _compatible(k1.year, k2.year)):
+        return 0
+    if not k1.words or not k2.words:
+        return 0.5  # Om vi inte kan jämföra ord, men termin/typ/år matchar
+
+    base_similarity = len(k1.words & k2.words) / len(k1.words | k2.words)
+
+    # Höj likheten om termin/typ/år matchar perfekt
+    bonus = 0
+    if k1.termin and k1.termin == k2.termin:
+        bonus += 0.3
+    if k1.typ and k1.typ == k2.typ:
+        bonus += 0.3
+    if k1.year and k1.year == k2.year:
+        bonus += 0.2
+    return base_similarity + bonus
+
+def build_index(keys):
+    """Index (termin, typ, år) -> nycklar."""
+    index = {}
+    for k in keys:
+        index.setdefault((k.termin, k.typ, k.year), []).append(k)
+    return index
+
+def candidates(key, index):
+    """Nycklar i index vars termin, typ och år är förenliga med key."""
+    for (termin, typ, year), keys in index.items():
+        if _compatible(key.termin, termin) and _compatible(key.typ, typ) and _compatible(key.year, year):
+            yield from keys
+
+def _hungarian(weights):
+    """Maximal viktsumma för en kvadratisk viktmatris. Returnerar kolumn per rad.
+
+    Klassisk O(n³) med potentialer (kostnad = -vikt).
+    """
+    n = len(weights)
+    INF = float("inf")
+    u, v = [0.0] * (n + 1), [0.0] * (n + 1)
+    p, way = [0] * (n + 1), [0] * (n + 1)  # p[j] = rad som tilldelats kolumn j (1-indexerat)
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = [INF] * (n + 1)
+        used = [False] * (n + 1)
+        while True:
+            used[j0] = True
+            i0, delta, j1 = p[j0], INF, 0
+            for j in range(1, n + 1):
+                if not used[j]:
+                    cur = -weights[i0 - 1][j - 1] - u[i0] - v[j]
+                    if cur < minv[j]:
+                        minv[j], way[j] = cur, j0
+                    if minv[j] < delta:
+                        delta, j1 = minv[j], j
+            for j in range(n + 1):
+                if used[j]:
+                    u[p[j]] += delta
+                    v[j] -= delta
+                else:
+                    minv[j] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+    assignment = [0] * n
+    for j in range(1, n + 1):
+        assignment[p[j] - 1] = j - 1
+    return assignment
+
+def _components(edges):
+    """Dela kanterna {(u, f): vikt} i sammanhängande grupper (union-find)."""
+    parent = {}
+    def find(x):
+        while parent.setdefault(x, x) != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+    for u, f in edges:
+        parent[find(("u", u))] = find(("f", f))
+    groups = {}
+    for (u, f), w in edges.items():
+        groups.setdefault(find(("u", u)), {})[(u, f)] = w
+    return groups.values()
+
+def match_pairs(utan_paths, facit_paths, min_similarity=MIN_SIMILARITY):
+    """Optimal en-till-en-matchning. Returnerar [(utan, facit, likhet)] i utan-ordning."""
+    facit_keys = [name_key(p) for p in facit_paths]
+    index = build_index(facit_keys)
+    position = {k.path: j for j, k in enumerate(facit_keys)}
+
+    scores, edges = {}, {}
+    for i, path in enumerate(utan_paths):
+        key = name_key(path)
+        for fk in candidates(key, index):
+            raw = _raw_similarity(key, fk)
+            if raw > min_similarity:
+                j = position[fk.path]
+                scores[(i, j)] = min(1.0, raw)
+                same_dir = os.path.dirname(path) == os.path.dirname(fk.path)
+                edges[(i, j)] = raw + (SAME_DIR_BONUS if same_dir else 0)
+
+    matched = {}
+    for group in _components(edges):
+        rows = sorted({u for u, _ in group})
+        cols = sorted({f for _, f in group})
+        n = max(len(rows), len(cols))
+        weights = [[group.get((u, f), 0) for f in cols] + [0] * (n - len(cols)) for u in rows]
+        weights += [[0] * n for _ in range(n - len(rows))]
+        for r, c in enumerate(_hungarian(weights)[:len(rows)]):
+            if c < len(cols) and (rows[r], cols[c]) in group:
+                matched[rows[r]] = cols[c]
+
+    return [(utan_paths[i], facit_paths[matched[i]], scores[(i, matched[i])])
+            for i in range(len(utan_paths)) if i in matched]
@@ -0,0 +1,93 @@
+from collections import namedtuple
+import cv2
+import numpy as np
+import fitz  # PyMuPDF
+
+"""
+Hitta facitmarkeringar och svarsalternativ direkt ur PDF-strukturen.
+
+Digitalt skapade tentor har bocken som vektorgrafik, färgad text eller en
+annotation, och radioknapparna som ritade cirklar, symboltecken eller
+formulärfält. Allt det går att läsa med PyMuPDF utan att rasterisera sidan:
+  - page.get_drawings()   -> gröna streck/ytor och cirkelformade banor
+  - page.get_text("rawdict") -> grön text och tecken som ○ ◯ ☐
+  - page.annots()         -> gröna annotationer (bläck, former, stämplar)
+  - page.widgets()        -> radioknappar/kryssrutor i formulär
+
+Alla rektanglar returneras i punkter i sidans roterade vy (samma koordinater
+som en pixmap av sidan, delat med DPI/72). Skannade sidor saknar allt detta
+och ska analyseras i pixlar (has_content=False).
+"""
+
+# Tecken som används som svarsalternativens "knappar" i tentor
+BULLET_CHARS = set("○◯❍◌⭘●◉⚪⚫□☐▢■◻◽❏❑")
+
+# green: gröna markeringar (fitz.Rect), bullets: (cx, cy, r) i punkter,
+# has_content: sidan har text eller vektorgrafik (annars skannad)
+PdfMarks = namedtuple("PdfMarks", "green bullets has_content")
+
+def _rgb_is_green(rgb, h1, h2, s1, v1):
+    """Samma HSV-intervall som pixelanalysen (OpenCV-skala: H 0–179, S/V 0–255)."""
+    if rgb is None or len(rgb) != 3:
+        return False
+    px = np.uint8([[[round(c * 255) for c in rgb]]])
+    h, s, v = cv2.cvtColor(px, cv2.COLOR_RGB2HSV)[0, 0]
+    return h1 <= h <= h2 and s >= s1 and v >= v1
+
+def _srgb_int_to_rgb(color):
+    return ((color >> 16) & 255) / 255, ((color >> 8) & 255) / 255, (color & 255) / 255
+
+def _is_round_path(drawing, rmin_pt, rmax_pt):
+    """Sluten bana av bara kurvor med nära kvadratisk bbox i rätt storlek (en ritad cirkel)."""
+    items = drawing.get("items") or []
+    if len(items) < 2 or any(item[0] != "c" for item in items):
+        return False
+    r = drawing["rect"]
+    if not r.width or not r.height or not 0.8 <= r.width / r.height <= 1.25:
+        return False
+    return 2 * rmin_pt <= (r.width + r.height) / 2 <= 2 * rmax_pt
+
+def find_pdf_marks(page, h1=35, h2=85, s1=40, v1=40, rmin_pt=2.0, rmax_pt=8.0):
+    """Gröna markeringar och svarsknappar på en fitz-sida, utan rasterisering."""
+    rot = page.rotation_matrix  # get_drawings/get_text ger oroterade koordinater
+    green, bullets = [], []
+
+    drawings = page.get_drawings()
+    for d in drawings:
+        if _rgb_is_green(d.get("color"), h1, h2, s1, v1) or _rgb_is_green(d.get("fill"), h1, h2, s1, v1):
+            # Streckbredden ingår inte i rect – bredda så att hela strecket täcks
+            w = (d.get("width") or 0) / 2
+            green.append((d["rect"] + (-w, -w, w, w)) * rot)
+        elif _is_round_path(d, rmin_pt, rmax_pt):
+            r = d["rect"] * rot
+            bullets.append(((r.x0 + r.x1) / 2, (r.y0 + r.y1) / 2, (r.width + r.height) / 4))
+
+    has_text = False
+    for block in page.get_text("rawdict")["blocks"]:
+        for line in block.get("lines", []):
+            for span in line["spans"]:
+                chars = [ch for ch in span["chars"] if not ch["c"].isspace()]
+                if not chars:
+                    continue
+                has_text = True
+                if _rgb_is_green(_srgb_int_to_rgb(span["color"]), h1, h2, s1, v1):
+                    green.append(fitz.Rect(span["bbox"]) * rot)
+                    continue
+                for ch in chars:
+                    if ch["c"] in BULLET_CHARS:
+                        # Teckenrutan har radens höjd; knappen är kvadratisk runt teckenmitten
+                        b = fitz.Rect(ch["bbox"])
+                        c = fitz.Point((b.x0 + b.x1) / 2, (b.y0 + b.y1) / 2) * rot
+                        bullets.append((c.x, c.y, min(b.width, b.height) / 2))
+
+    for annot in page.annots() or []:
+        colors = annot.colors or {}
+        if _rgb_is_green(colors.get("stroke"), h1, h2, s1, v1) or _rgb_is_green(colors.get("fill"), h1, h2, s1, v1):
+            green.append(annot.rect * rot)
+
+    for widget in page.widgets() or []:
+        if widget.field_type in (fitz.PDF_WIDGET_TYPE_RADIOBUTTON, fitz.PDF_WIDGET_TYPE_CHECKBOX):
+            r = widget.rect * rot
+            bullets.append(((r.x0 + r.x1) / 2, (r.y0 + r.y1) / 2, (r.width + r.height) / 4))
+
+    return PdfMarks(green, bullets, bool(drawings) or has_text)
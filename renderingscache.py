@@ -0,0 +1,143 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+
+"""
+Persistent renderingscache för sidbilder.
+
+Nyckeln byggs av PDF-filens innehållshash, sidindex och alla parametrar som
+påverkar bilden (DPI, maskningsparametrar ...). Oförändrade sidor återanvänds
+mellan körningar; bara nya eller ändrade sidor renderas om.
+
+Cachen ligger default i ~/.cache/anki-occlude-batch (kan ändras med
+miljövariabeln ANKI_OCCLUDE_CACHE) och rensas på ålder och total storlek.
+"""
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    "ANKI_OCCLUDE_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "anki-occlude-batch"),
+)
+DEFAULT_MAX_MB = 2000       # total storlek innan äldsta filer rensas
+DEFAULT_MAX_AGE_DAYS = 60   # filer som inte använts på så länge rensas
+
+class RenderCache:
+    def __init__(self, root=DEFAULT_CACHE_DIR, enabled=True,
+                 max_mb=DEFAULT_MAX_MB, max_age_days=DEFAULT_MAX_AGE_DAYS):
+        self.root = root
+        self.enabled = enabled
+        self.max_bytes = int(max_mb * 1024 * 1024) if max_mb else 0
+        self.max_age = max_age_days * 86400 if max_age_days else 0
+        self._hashes = {}
+        if enabled:
+            os.makedirs(root, exist_ok=True)
+
+    def file_hash(self, path):
+        """SHA-256 av filens innehåll (memoiserad på sökväg, storlek och mtime)."""
+        st = os.stat(path)
+        memo_key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+        digest = self._hashes.get(memo_key)
+        if digest is None:
+            h = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    h.update(chunk)
+            digest = self._hashes[memo_key] = h.hexdigest()
+        return digest
+
+    def key(self, file_hash, page_index, **params):
+        """Cachenyckel för en sida: innehållshash + sidindex + renderingsparametrar."""
+        raw = json.dumps([file_hash, page_index, params], sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def path_for(self, key, suffix=".png"):
+        return os.path.join(self.root, key[:2], key + suffix)
+
+    def get(self, key, suffix=".png"):
+        """Sökväg till cachad fil, eller None. En träff räknas som användning (LRU)."""
+        if not self.enabled:
+            return None
+        path = self.path_for(key, suffix)
+        if not os.path.exists(path):
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return path
+
+    def fetch(self, key, dst_path, suffix=".png"):
+        """Länka/kopiera en cachad fil till dst_path. Returnerar True vid träff."""
+        path = self.get(key, suffix)
+        if path is None:
+            return False
+        _link_or_copy(path, dst_path)
+        return True
+
+    def put(self, key, src_path, suffix=".png"):
+        """Lägg en renderad fil i cachen (hårdlänk om möjligt, annars kopia)."""
+        if not self.enabled:
+            return
+        dst = self.path_for(key, suffix)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        _link_or_copy(src_path, dst)
+
+    def put_bytes(self, key, data, suffix=".png"):
+        if not self.enabled:
+            return
+        dst = self.path_for(key, suffix)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmp = f"{dst}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, dst)
+
+    def get_meta(self, key):
+        """Metadata (dict) som sparats med put_meta, eller None."""
+        path = self.get(key, ".json")
+        if path is None:
+            return None
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def put_meta(self, key, meta):
+        self.put_bytes(key, json.dumps(meta, sort_keys=True).encode("utf-8"), ".json")
+
+    def evict(self):
+        """Rensa filer äldre än max_age, sedan äldsta först tills under max_bytes."""
+        if not self.enabled or not os.path.isdir(self.root):
+            return 0
+        entries = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        now = time.time()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for mtime, size, path in entries:
+            too_old = self.max_age and now - mtime > self.max_age
+            too_big = self.max_bytes and total > self.max_bytes
+            if not (too_old or too_big):
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+def _link_or_copy(src, dst):
+    tmp = f"{dst}.{os.getpid()}.tmp"
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
@@ -0,0 +1,72 @@
+import threading
+import weakref
+import numpy as np
+
+"""
+Återanvända sidbuffertar.
+
+En sida i 300 dpi är ~25 MB som BGR. Utan pool allokeras en ny array för
+varje sida och steg (rasterisering, kopian som maskas, nedskalningen);
+med den lämnas arrayerna tillbaka när sidan är kodad och nästa sida i
+samma storlek skrivs i samma minne (cv2 dst=/numpy out=).
+
+Poolen är per process och trådsäker (sidflödets steg körs i trådar). Mellan
+processerna skickas redan kodade bilder, inte arrayer, så något delat minne
+behövs inte där. Bara arrayer som poolen själv delat ut tas emot av give();
+allt annat (vyer, arrayer från cv2) ignoreras, så det är alltid säkert att
+lämna tillbaka en sidas alla bilder.
+"""
+
+MAX_FREE = 8  # lediga buffertar per form som sparas (fler släpps till skräpsamlingen)
+
+class BufferPool:
+    """Lediga sidbuffertar per form och dtype; take()/give() går att anropa från flera trådar."""
+
+    def __init__(self, max_free=MAX_FREE):
+        self.max_free = max_free
+        self.allocated = 0
+        self.reused = 0
+        self._free = {}    # (form, dtype) -> [arrayer]
+        self._owned = {}   # id -> weakref till arrayer som poolen delat ut
+        self._lock = threading.RLock()  # weakref-återanropet kan komma medan låset hålls
+
+    def take(self, shape, dtype=np.uint8):
+        """En array med given form (innehållet är odefinierat)."""
+        key = (tuple(shape), np.dtype(dtype).str)
+        with self._lock:
+            free = self._free.get(key)
+            if free:
+                self.reused += 1
+                return free.pop()
+            self.allocated += 1
+        arr = np.empty(shape, dtype=dtype)
+        with self._lock:
+            self._owned[id(arr)] = weakref.ref(arr, self._forget(id(arr)))
+        return arr
+
+    def copy(self, arr):
+        """Som arr.copy(), men i en buffert ur poolen."""
+        out = self.take(arr.shape, arr.dtype)
+        np.copyto(out, arr)
+        return out
+
+    def give(self, *arrays):
+        """Lämna tillbaka arrayer som inte används längre (None och främmande arrayer ignoreras)."""
+        seen = set()
+        with self._lock:
+            for arr in arrays:
+                if arr is None or id(arr) in seen:
+                    continue
+                seen.add(id(arr))
+                ref = self._owned.get(id(arr))
+                if ref is None or ref() is not arr:
+                    continue
+                free = self._free.setdefault((arr.shape, arr.dtype.str), [])
+                if len(free) < self.max_free and not any(a is arr for a in free):
+                    free.append(arr)
+
+    def _forget(self, key):
+        def forget(_):
+            with self._lock:
+                self._owned.pop(key, None)
+        return forget
@@ -0,0 +1,112 @@
+import queue
+import threading
+
+"""
+Överlappande sidflöde: steg i egna trådar med begränsade köer emellan.
+
+pipeline(items, [(rasterisera, 1), (maska, 2), (koda, 2)]) kör varje steg i
+sina trådar och ger resultaten i samma ordning som items. Köerna rymmer högst
+depth sidor, så minnet är begränsat och första sidan kommer ut direkt; den
+totala tiden närmar sig det långsammaste steget i stället för summan.
+
+Trådar räcker eftersom det tunga arbetet (OpenCV, zlib/PNG-kodning, fil-I/O)
+släpper GIL:en. PyMuPDF är inte trådsäkert – fitz-anrop i olika steg måste
+skyddas med ett gemensamt lås (se maska_ratt_svar.FITZ_LOCK).
+
+Ett undantag i ett steg följer med sidan och kastas av pipeline() när sidan
+står på tur; avbryts konsumenten stoppas alla trådar.
+"""
+
+_DONE = object()
+
+class _Failure:
+    def __init__(self, exc):
+        self.exc = exc
+
+def _put(q, item, stop):
+    """Lägg i kön men ge upp om pipelinen stoppats (konsumenten läser inte längre)."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def pipeline(items, stages, depth=2):
+    """Kör stages = [(func, trådar), ...] över items; ge resultaten i items-ordning.
+
+    Varje func tar föregående stegs resultat. depth = max antal sidor per kö.
+    """
+    depth = max(1, depth)
+    stop = threading.Event()
+    queues = [queue.Queue(maxsize=depth) for _ in range(len(stages) + 1)]
+    threads = []
+
+    def feed():
+        seq = 0
+        try:
+            for item in items:
+                if not _put(queues[0], (seq, item), stop):
+                    return
+                seq += 1
+        except BaseException as exc:  # fel i items själv (t.ex. en generator)
+            _put(queues[0], (seq, _Failure(exc)), stop)
+        finally:
+            for _ in range(stages[0][1]):
+                _put(queues[0], _DONE, stop)
+
+    def work(func, src, dst, remaining, n_next):
+        while not stop.is_set():
+            try:
+                item = src.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                break
+            seq, value = item
+            if not isinstance(value, _Failure):
+                try:
+                    value = func(value)
+                except BaseException as exc:
+                    value = _Failure(exc)
+            if not _put(dst, (seq, value), stop):
+                return
+        with remaining[1]:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:  # sista tråden i steget stänger nästa kö
+            for _ in range(n_next):
+                _put(dst, _DONE, stop)
+
+    threads.append(threading.Thread(target=feed, daemon=True, name="sidflode-feed"))
+    for k, (func, n) in enumerate(stages):
+        n_next = stages[k + 1][1] if k + 1 < len(stages) else 1
+        remaining = [n, threading.Lock()]
+        for t in range(n):
+            threads.append(threading.Thread(target=work, daemon=True, name=f"sidflode-{k}-{t}",
+                                            args=(func, queues[k], queues[k + 1], remaining, n_next)))
+    for t in threads:
+        t.start()
+
+    # Steg med flera trådar blir klara i oordning – sortera tillbaka innan de lämnas ut
+    pending = {}
+    expected = 0
+    out = queues[-1]
+    try:
+        while True:
+            item = out.get()
+            if item is _DONE:
+                break
+            seq, value = item
+            pending[seq] = value
+            while expected in pending:
+                value = pending.pop(expected)
+                if isinstance(value, _Failure):
+                    raise value.exc
+                yield value
+                expected += 1
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
@@ -0,0 +1,88 @@
+from collections import namedtuple
+import numpy as np
+
+"""
+Tentans layout: svarskolumnens x, radioknapparnas radie och radavståndet.
+
+Inom en tenta är de nästan identiska på varje sida. Layouten lärs in en gång
+ur de första sidorna med bock (eller läses ur en sparad profil), och
+replicate-läget letar sedan bara ringar i ett smalt band kring den kända
+kolumnen med känd radie. Stämmer inte resultatet med layouten (för få rader,
+fel radavstånd, bocken i en annan kolumn) görs full detektion för sidan.
+
+Layouten lärs in i huvudprocessen innan sidorna bearbetas och följer med
+args till arbetsprocesserna, så resultatet beror inte på i vilken ordning
+sidorna blir klara. Allt är i pixlar för --dpi (scale_layout räknar om).
+"""
+
+LEARN_PAGES = 3         # sidor med hittade alternativ som layouten bygger på
+LEARN_MAX_PAGES = 8     # så långt in i tentan letar inlärningen
+PITCH_TOLERANCE = 0.3   # tillåten avvikelse från radavståndet vid verifieringen
+RADIUS_TOLERANCE = 0.25
+
+# radius/pitch är None om bara kolumnen är känd (column-läget, eller inga ringar hittade)
+Layout = namedtuple("Layout", "x radius pitch")
+
+def scale_layout(layout, factor):
+    if layout is None:
+        return None
+    return Layout(layout.x * factor,
+                  layout.radius * factor if layout.radius else None,
+                  layout.pitch * factor if layout.pitch else None)
+
+def row_pitch(rows):
+    """Radavstånd inom en fråga: medianen av glappen nära det minsta (större glapp = ny fråga)."""
+    ys = np.sort([r[1] for r in rows])
+    gaps = np.diff(ys)
+    gaps = gaps[gaps > 0]
+    if not len(gaps):
+        return None
+    return float(np.median(gaps[gaps <= 1.5 * gaps.min()]))
+
+def from_samples(samples, min_rows):
+    """Layout ur [(bockens bbox, rader)] från inlärningssidorna, eller None om de spretar.
+
+    Kolumnen tas från ringarnas x där sådana finns, annars bockens mitt.
+    """
+    if not samples:
+        return None
+    with_rows = [rows for _, rows in samples if len(rows) >= min_rows]
+    if with_rows:
+        xs = [float(np.median([r[0] for r in rows])) for rows in with_rows]
+        radius = float(np.median([r[2] for rows in with_rows for r in rows]))
+        pitches = [p for p in (row_pitch(rows) for rows in with_rows) if p]
+        pitch = float(np.median(pitches)) if pitches else None
+        spread = 4 * radius
+    else:
+        xs = [x + w / 2 for (x, y, w, h), _ in samples]
+        radius = pitch = None
+        spread = max(w for (x, y, w, h), _ in samples) * 2
+    if max(xs) - min(xs) > spread:
+        return None  # bockarna står i olika kolumner – ingen gemensam layout
+    return Layout(float(np.median(xs)), radius, pitch)
+
+def search_band(layout):
+    """(x, halv bandbredd, rmin, rmax) för ringsökningen kring den kända kolumnen."""
+    rmin = max(1, int(layout.radius * (1 - RADIUS_TOLERANCE)))
+    rmax = int(np.ceil(layout.radius * (1 + RADIUS_TOLERANCE))) + 1
+    return int(round(layout.x)), 2 * rmax, rmin, rmax
+
+def tick_in_column(bbox, layout):
+    x, y, w, h = bbox
+    return abs(x + w / 2 - layout.x) <= max(w, 4 * (layout.radius or 0))
+
+def verify_rows(rows, layout, min_rows):
+    """Raderna stämmer med layouten: tillräckligt många och radavstånd som förväntat."""
+    if len(rows) < min_rows:
+        return False
+    gaps = np.diff(np.sort([r[1] for r in rows]))
+    if not len(gaps):
+        return True
+    lo, hi = (1 - PITCH_TOLERANCE) * layout.pitch, (1 + PITCH_TOLERANCE) * layout.pitch
+    return gaps.min() >= lo and bool(((gaps >= lo) & (gaps <= hi)).any())
+
+def to_meta(layout):
+    return {"layout": list(layout) if layout else None}
+
+def from_meta(meta):
+    return Layout(*meta["layout"]) if meta and meta.get("layout") else None
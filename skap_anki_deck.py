@@ -1,15 +1,36 @@
 import os
 import re
-import glob
+import time
 import shutil
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 import fitz  # PyMuPDF
 import genanki
+import numpy as np
+from mediakodning import FORMATS, EncodeStats, extension
+from renderingscache import RenderCache, DEFAULT_CACHE_DIR, DEFAULT_MAX_MB, DEFAULT_MAX_AGE_DAYS
+from fragedelning import QUESTION_GAP_PT, find_question_bands
+from parning import find_exam_pdfs, is_facit, match_pairs
+import korrapport
+import byggmanifest
 
 # ====== Konfig ======
 DECK_NAME = "BV – Tentor (samlat)"
 DECK_ID   = 2025102309  # valfritt stabilt tal
+OUT_APKG  = "tentor_samlat.apkg"
 DPI       = 300         # Högre DPI för bättre läsbarhet
 DEFAULT_SKIP_PAGES = 3  # hoppa över försättssidor
+WORKERS   = 0           # processer för rasterisering (0 = en per kärna)
+CACHE_DIR = DEFAULT_CACHE_DIR  # renderade sidor återanvänds mellan körningar
+MEDIA_FORMAT  = "png"   # png, png-gray, png-palette, jpeg eller webp
+MEDIA_QUALITY = None    # 1–100 (None = formatets default)
+MEDIA_BUDGET_MB = 0     # mål för hela deckets mediastorlek (0 = ingen budget)
+ADAPTIVE_DPI = False    # välj DPI per sida efter textmängd (glesa sidor renderas i lägre DPI)
+MIN_DPI   = 150         # lägsta DPI med ADAPTIVE_DPI
+DENSE_CHARS_PER_SQIN = 30  # tecken per kvadrattum där en sida räknas som tät (full DPI)
+SPLIT_QUESTIONS = False # ett kort per fråga (utklippt) i stället för ett per sida
+SPLIT_ANALYSIS_DPI = 72 # upplösning för att hitta frågegränserna
 
 # Vill du ha olika skip per tenta? Ange här (namndel som matchar filnamnet -> antal sidor att hoppa)
 SKIP_OVERRIDES = {
@@ -18,156 +39,228 @@ SKIP_OVERRIDES = {
 }
 
 # ====== Hjälpfunktioner ======
-def pdf_to_images(pdf_path, out_dir, prefix, dpi=DPI, skip_pages=0):
-    """Konverterar PDF-sidor till PNG-bilder."""
-    os.makedirs(out_dir, exist_ok=True)
-    doc = fitz.open(pdf_path)
-    paths = []
-    for i, page in enumerate(doc):
-        if i < skip_pages:
-            continue
-        mat = fitz.Matrix(dpi/72, dpi/72)
-        pix = page.get_pixmap(matrix=mat, alpha=False)
-        img_path = os.path.join(out_dir, f"{prefix}_{i+1:03d}.png")
-        pix.save(img_path)
-        paths.append(img_path)
-    doc.close()
-    return paths
-
-def find_pairs():
-    """Hitta alla filer utan 'facit' och matcha mot motsvarande filer med 'facit'."""
-    # Hitta alla PDF-filer
-    all_pdfs = glob.glob("*.pdf")
-    
-    # Separera filer med och utan "facit" i namnet
-    utan_facit = []  # Filer utan "facit" i namnet
-    med_facit = []   # Filer med "facit" i namnet
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description="Skapa Anki-deck från tentor med och utan facit.")
+    ap.add_argument("--root", default=".",
+                    help="Mapp att söka tentor i (rekursivt, dolda mappar och arbetsmappar hoppas över)")
+    ap.add_argument("--workers", type=int, default=WORKERS,
+                    help="Antal processer för rasterisering (0 = en per kärna, 1 = seriellt)")
+    ap.add_argument("--no-cache", action="store_true", dest="no_cache",
+                    help="Rendera om alla sidor utan att läsa eller skriva renderingscachen")
+    ap.add_argument("--cache-dir", default=CACHE_DIR, dest="cache_dir")
+    ap.add_argument("--cache-max-mb", type=float, default=DEFAULT_MAX_MB, dest="cache_max_mb",
+                    help="Rensa äldsta cachade sidor när cachen överstiger detta (0 = ingen gräns)")
+    ap.add_argument("--cache-max-age-days", type=float, default=DEFAULT_MAX_AGE_DAYS, dest="cache_max_age_days",
+                    help="Rensa cachade sidor som inte använts på N dagar (0 = ingen gräns)")
+    ap.add_argument("--format", choices=FORMATS, default=MEDIA_FORMAT, dest="media_format",
+                    help="Bildformat för kortens media")
+    ap.add_argument("--quality", type=int, default=MEDIA_QUALITY, dest="media_quality",
+                    help="Kvalitet 1–100 (jpeg/webp; för png-palette styr den antal färger)")
+    ap.add_argument("--budget-mb", type=float, default=MEDIA_BUDGET_MB, dest="budget_mb",
+                    help="Byte-budget för deckets media; kvaliteten justeras per bild mot budget/antal bilder")
+    ap.add_argument("--encode-report", default=None, dest="encode_report",
+                    help="Skriv storlek och kodningstid per bild till denna CSV-fil")
+    ap.add_argument("--adaptive-dpi", action="store_true", default=ADAPTIVE_DPI, dest="adaptive_dpi",
+                    help=f"Välj DPI per sida ({MIN_DPI}–{DPI}) efter textdensitet i stället för alltid {DPI}")
+    ap.add_argument("--min-dpi", type=int, default=MIN_DPI, dest="min_dpi",
+                    help="Lägsta DPI med --adaptive-dpi")
+    ap.add_argument("--split-questions", action="store_true", default=SPLIT_QUESTIONS, dest="split_questions",
+                    help="Ett kort per fråga: sidorna delas på vita mellanrum och varje fråga klipps ut")
+    ap.add_argument("--question-gap", type=float, default=QUESTION_GAP_PT, dest="question_gap",
+                    help=f"Minsta vita mellanrum (punkter) mellan två frågor (default: {QUESTION_GAP_PT})")
+    ap.add_argument("--delta", action="store_true",
+                    help=f"Skriv bara nya/ändrade kort och bilder sedan förra bygget till "
+                         f"{byggmanifest.delta_path(OUT_APKG)} (jämfört med {byggmanifest.manifest_path(OUT_APKG)})")
+    ap.add_argument("--report", default=None,
+                    help="Skriv tid, CPU-tid och minne per steg och sida till denna fil (.json eller .csv)")
+    ap.add_argument("--report-memory", action="store_true", dest="report_memory",
+                    help="Mät även allokerat toppminne per steg (tracemalloc, kostar tid)")
+    ap.add_argument("--profile", default=None,
+                    help="Kör huvudprocessen under cProfile och spara statistiken till denna fil")
+    return ap.parse_args(argv)
+
+# Öppna dokument per process – varje arbetsprocess får egna fitz-handtag
+_open_docs = {}
+
+def _open_doc(pdf_path):
+    # Storlek och mtime i nyckeln: en varm pool (bevakning.py) ska se ersatta filer
+    st = os.stat(pdf_path)
+    stamp = (st.st_size, st.st_mtime_ns)
+    stamped, doc = _open_docs.get(pdf_path, (None, None))
+    if doc is None or stamped != stamp:
+        if doc is not None:
+            doc.close()
+        doc = fitz.open(pdf_path)
+        _open_docs[pdf_path] = (stamp, doc)
+    return doc
+
+def close_docs():
+    for _, doc in _open_docs.values():
+        doc.close()
+    _open_docs.clear()
+
+def pixel_hash(pix):
+    """Innehållshash av de avkodade pixlarna (samma sida ger samma hash i alla PDF:er).
+
+    BLAKE2b läser samples direkt via minnesvyn och är några gånger snabbare än
+    PNG-kodningen av samma sida, så dedupliceringen äter inte upp vinsten.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{pix.w}x{pix.h}x{pix.n}".encode())
+    h.update(pix.samples_mv)
+    return h.hexdigest()
+
+def page_dpi(pdf_path, page_index, max_dpi=DPI, min_dpi=MIN_DPI):
+    """Välj DPI för en sida efter hur tätt texten står.
+
+    Glesa sidor med stor text är läsbara i lägre DPI; tät text behöver full
+    DPI. Sidor med bilder (figurer, skannade sidor) får alltid full DPI.
+    """
+    page = _open_doc(pdf_path)[page_index]
+    if page.get_images():
+        return max_dpi
+    chars = len("".join(page.get_text("text").split()))
+    if not chars:
+        return max_dpi
+    area = page.rect.width * page.rect.height / (72 * 72)  # kvadrattum
+    density = min(1.0, chars / area / DENSE_CHARS_PER_SQIN)
+    return int(round((min_dpi + (max_dpi - min_dpi) * density) / 10) * 10)
+
+def render_page(pdf_path, page_index, out_path, dpi=DPI, fmt="png", quality=None, max_bytes=0):
+    """Rendera en PDF-sida (0-indexerad) till en bild i valt format.
+
+    Returnerar (out_path, kodningsstatistik för bilden, pixelhash, körrapportrader).
+    """
+    with korrapport.capture(page_label(pdf_path, page_index)) as report:
+        with korrapport.stage("rasterize", dpi=dpi):
+            page = _open_doc(pdf_path)[page_index]
+            mat = fitz.Matrix(dpi/72, dpi/72)
+            pix = page.get_pixmap(matrix=mat, alpha=False)
+            digest = pixel_hash(pix)
+        stats = EncodeStats()
+        with korrapport.stage("encode"):
+            _save_pixmap(pix, out_path, fmt, quality, max_bytes, stats)
+    return out_path, stats.rows, digest, report.rows()
+
+def page_label(pdf_path, page_index):
+    """Sidans namn i körrapporten: fil#sidnummer."""
+    return f"{os.path.basename(pdf_path)}#{page_index + 1}"
+
+def _save_pixmap(pix, out_path, fmt, quality, max_bytes, stats):
+    # Via tmp-fil och os.replace: out_path kan vara hårdlänkad till cachen och
+    # media-mappen, och en skrivning på plats skulle ändra dem också
+    name = os.path.basename(out_path)
+    tmp = f"{out_path}.{os.getpid()}.tmp"
+    if fmt == "png" and not max_bytes:
+        t0 = time.perf_counter()
+        pix.save(tmp, output="png")
+        stats.add(name, fmt, None, pix.w, pix.h, os.path.getsize(tmp), time.perf_counter() - t0)
+    else:
+        rgb = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.h, pix.w, pix.n)
+        data = stats.timed_encode(name, rgb, fmt, quality, max_bytes, rgb=True)
+        with open(tmp, "wb") as f:
+            f.write(data)
+    os.replace(tmp, out_path)
+
+def render_question_crops(utan_pdf, med_pdf, page_index, out_dir, dpi=DPI, fmt="png", quality=None,
+                          max_bytes=0, gap_pt=QUESTION_GAP_PT):
+    """Rendera en bild per fråga för en sida ur båda PDF:erna.
+
+    Frågegränserna hittas på en lågupplöst gråskalerendering av sidan utan
+    facit och används för båda, så fram- och baksidan visar samma utsnitt.
+    Varje utsnitt renderas sedan direkt med clip i full DPI (ingen helsida).
+    max_bytes gäller en hel sida och delas mellan utsnitten efter höjd.
+    Returnerar (fram, bak, kodningsstatistik, körrapportrader) där fram/bak
+    är listor av (sökväg, pixelhash) i frågeordning.
+    """
+    with korrapport.capture(page_label(utan_pdf, page_index)) as report:
+        crops, rows = _render_question_crops(utan_pdf, med_pdf, page_index, out_dir, dpi, fmt, quality,
+                                             max_bytes, gap_pt)
+    return crops[0], crops[1], rows, report.rows()
+
+def _render_question_crops(utan_pdf, med_pdf, page_index, out_dir, dpi, fmt, quality, max_bytes, gap_pt):
+    with korrapport.stage("split"):
+        utan_page = _open_doc(utan_pdf)[page_index]
+        gray = utan_page.get_pixmap(matrix=fitz.Matrix(SPLIT_ANALYSIS_DPI/72, SPLIT_ANALYSIS_DPI/72),
+                                    colorspace=fitz.csGRAY, alpha=False)
+        bands = find_question_bands(np.frombuffer(gray.samples_mv, dtype=np.uint8).reshape(gray.h, gray.w),
+                                    SPLIT_ANALYSIS_DPI, min_gap_pt=gap_pt)
+    if not bands:
+        korrapport.event("no_questions")
+    scale = 72 / SPLIT_ANALYSIS_DPI
+    clips = [(y1 * scale, y2 * scale) for y1, y2 in bands] or [(0, utan_page.rect.height)]
+
+    mat = fitz.Matrix(dpi/72, dpi/72)
+    stats = EncodeStats()
+    ext = extension(fmt)
+    crops = ([], [])
+    for side, (pdf, prefix) in enumerate(((utan_pdf, "front"), (med_pdf, "back"))):
+        page = _open_doc(pdf)[page_index]
+        for j, (y1, y2) in enumerate(clips):
+            clip = fitz.Rect(0, y1, page.rect.width, y2) & page.rect
+            with korrapport.stage("rasterize", dpi=dpi):
+                pix = page.get_pixmap(matrix=mat, clip=clip, alpha=False)
+            path = os.path.join(out_dir, f"{prefix}_{page_index+1:03d}_q{j+1}{ext}")
+            budget = int(max_bytes * clip.height / page.rect.height) if max_bytes else 0
+            with korrapport.stage("encode"):
+                _save_pixmap(pix, path, fmt, quality, budget, stats)
+            crops[side].append((path, pixel_hash(pix)))
+    return crops, stats.rows
+
+def make_pool(workers):
+    """Processpool för rendering; arbetsprocesserna får en rapport med huvudprocessens inställningar."""
+    return ProcessPoolExecutor(max_workers=workers, initializer=korrapport.activate,
+                               initargs=(korrapport.active().child(),))
+
+def render_pages(tasks, workers=1, func=render_page, pool=None):
+    """Kör func(*task) för varje uppgift och ger resultaten i samma ordning som tasks.
+
+    Resultaten ges allteftersom de blir klara (en generator), så att
+    anroparen kan använda första sidan medan resten renderas. Alla sidor i
+    alla par läggs i samma pool, så både par och sidor körs parallellt.
+    pool kan vara en befintlig (varm) pool, t.ex. från bevakning.py.
+    """
+    if not tasks:
+        return
+    if pool is None and (workers <= 1 or len(tasks) <= 1):
+        for t in tasks:
+            yield func(*t)
+        close_docs()
+        return
+    chunk = max(1, len(tasks) // (workers * 8))
+    if pool is not None:
+        yield from pool.map(func, *zip(*tasks), chunksize=chunk)
+        return
+    with make_pool(workers) as pool:
+        yield from pool.map(func, *zip(*tasks), chunksize=chunk)
+
+def page_count(pdf_path):
+    with fitz.open(pdf_path) as doc:
+        return doc.page_count
+
+def find_pairs(root="."):
+    """Hitta alla filer utan 'facit' under root och matcha mot motsvarande filer med 'facit'."""
+    # Hitta alla PDF-filer rekursivt (sorterat så att ordningen är densamma mellan körningar)
+    all_pdfs = find_exam_pdfs(root)
     
-    for pdf in all_pdfs:
-        if "facit" in pdf.lower():
-            med_facit.append(pdf)
-        else:
-            utan_facit.append(pdf)
+    # Separera filer med och utan facit ("utan facit" i namnet räknas som utan)
+    med_facit = [pdf for pdf in all_pdfs if is_facit(pdf)]
+    utan_facit = [pdf for pdf in all_pdfs if not is_facit(pdf)]
     
     print(f"📚 Hittade {len(utan_facit)} filer utan facit")
     print(f"📚 Hittade {len(med_facit)} filer med facit")
     
-    pairs = []
-    
-    # Försök matcha filer baserat på liknande namn
+    # Namnen tolkas en gång, bara förenliga par jämförs och varje facit används högst en gång
+    matches = match_pairs(utan_facit, med_facit)
+    matched = {utan for utan, _, _ in matches}
+    for utan, med, score in matches:
+        print(f"✅ Matchade: {utan} ↔ {med} (likhet: {score:.2f})")
     for utan in utan_facit:
-        best_match = None
-        best_score = 0
-        
-        # Ta bort "utan svar" och liknande från namnet för bättre matchning
-        clean_utan = re.sub(r'\s*utan\s+svar\s*', '', utan, flags=re.IGNORECASE)
-        clean_utan = re.sub(r'\s*utan\s+facit\s*', '', clean_utan, flags=re.IGNORECASE)
-        clean_utan = re.sub(r'\s*utan_Facit\s*', '', clean_utan, flags=re.IGNORECASE)
-        
-        for med in med_facit:
-            # Ta bort "facit" från namnet för jämförelse
-            clean_med = re.sub(r'\s*facit\s*', '', med, flags=re.IGNORECASE)
-            
-            # Beräkna likhet mellan namnen
-            score = calculate_similarity(clean_utan, clean_med)
-            
-            if score > best_score and score > 0.3:  # Minst 30% likhet (nu med exakt termin/typ/år-kontroll)
-                best_score = score
-                best_match = med
-        
-        if best_match:
-            pairs.append((utan, best_match))
-            print(f"✅ Matchade: {os.path.basename(utan)} ↔ {os.path.basename(best_match)} (likhet: {best_score:.2f})")
-        else:
-            print(f"⚠️ Ingen match hittad för: {os.path.basename(utan)}")
+        if utan not in matched:
+            print(f"⚠️ Ingen match hittad för: {utan}")
+            korrapport.event("unmatched", file=utan)
     
-    return pairs
-
-def calculate_similarity(name1, name2):
-    """Beräkna exakt likhet mellan två filnamn baserat på termin och typ."""
-    
-    def extract_key_info(name):
-        """Extrahera viktig information från filnamnet."""
-        name_lower = name.lower()
-        
-        # Hitta termin (HT/VT + år)
-        termin_match = re.search(r'(ht|vt)(\d{2,4})', name_lower)
-        termin = termin_match.group(0) if termin_match else None
-        
-        # Hitta typ (ordinarie/rest)
-        typ = None
-        if 'ordinarie' in name_lower:
-            typ = 'ordinarie'
-        elif 'rest' in name_lower:
-            typ = 'rest'
-        
-        # Hitta år separat också
-        year_match = re.search(r'(20\d{2})', name_lower)
-        year = year_match.group(1) if year_match else None
-        
-        return {
-            'termin': termin,
-            'typ': typ,
-            'year': year,
-            'original': name_lower
-        }
-    
-    info1 = extract_key_info(name1)
-    info2 = extract_key_info(name2)
-    
-    # Om båda har termin, måste de matcha exakt
-    if info1['termin'] and info2['termin']:
-        if info1['termin'] != info2['termin']:
-            return 0  # Olika terminer = ingen match
-    
-    # Om båda har typ, måste de matcha exakt
-    if info1['typ'] and info2['typ']:
-        if info1['typ'] != info2['typ']:
-            return 0  # Olika typer = ingen match
-    
-    # Om båda har år, måste de matcha exakt
-    if info1['year'] and info2['year']:
-        if info1['year'] != info2['year']:
-            return 0  # Olika år = ingen match
-    
-    # Om vi kommer hit, är grundläggande info kompatibel
-    # Beräkna likhet baserat på gemensamma ord (exklusive termin/typ/år)
-    def clean_for_comparison(name):
-        # Ta bort termin, typ och år för jämförelse
-        cleaned = re.sub(r'(ht|vt)\d{2,4}', '', name.lower())
-        cleaned = re.sub(r'(ordinarie|rest)', '', cleaned)
-        cleaned = re.sub(r'20\d{2}', '', cleaned)
-        cleaned = re.sub(r'[^a-z0-9\s]', ' ', cleaned)
-        cleaned = re.sub(r'\s+', ' ', cleaned).strip()
-        return cleaned
-    
-    clean1 = clean_for_comparison(name1)
-    clean2 = clean_for_comparison(name2)
-    
-    if not clean1 or not clean2:
-        return 0.5  # Om vi inte kan jämföra ord, men termin/typ/år matchar
-    
-    words1 = set(clean1.split())
-    words2 = set(clean2.split())
-    
-    if not words1 or not words2:
-        return 0.5
-    
-    intersection = words1.intersection(words2)
-    union = words1.union(words2)
-    
-    base_similarity = len(intersection) / len(union) if union else 0
-    
-    # Höj likheten om termin/typ/år matchar perfekt
-    bonus = 0
-    if info1['termin'] and info2['termin'] and info1['termin'] == info2['termin']:
-        bonus += 0.3
-    if info1['typ'] and info2['typ'] and info1['typ'] == info2['typ']:
-        bonus += 0.3
-    if info1['year'] and info2['year'] and info1['year'] == info2['year']:
-        bonus += 0.2
-    
-    return min(1.0, base_similarity + bonus)
+    return [(utan, med) for utan, med, _ in matches]
 
 def guess_skip(name):
     """Gissa hur många sidor som ska hoppas över baserat på filnamnet."""
@@ -176,14 +269,85 @@ def guess_skip(name):
             return val
     return DEFAULT_SKIP_PAGES
 
+def link_media(src_path, media_dir, digest, ext):
+    """Lägg en bild i media-mappen under sitt innehållsnamn (en gång per unik sida)."""
+    media_path = os.path.join(media_dir, digest + ext)
+    if not os.path.exists(media_path):
+        try:
+            os.link(src_path, media_path)
+        except OSError:
+            shutil.copyfile(src_path, media_path)
+    return media_path
+
+def fetch_question_crops(cache, key, meta, out_dir, page_index, ext):
+    """Hämta cachade frågeutsnitt för ett sidpar.
+
+    Returnerar (fram, bak) som listor av (sökväg, pixelhash), eller None om
+    någon fil saknas i cachen.
+    """
+    sides = []
+    for side, tag in (("front", "f"), ("back", "b")):
+        crops = []
+        for j, digest in enumerate(meta.get(side, [])):
+            path = os.path.join(out_dir, f"{side}_{page_index+1:03d}_q{j+1}{ext}")
+            if not cache.fetch(key, path, suffix=f"_{tag}{j+1}{ext}"):
+                return None
+            crops.append((path, digest))
+        sides.append(crops)
+    return sides if sides[0] else None
+
 def clean_filename(name):
     """Rensa filnamn för användning som mappnamn."""
     return re.sub(r'[^A-Za-z0-9_-]+', '_', name)
 
+def exam_name(utan):
+    """Tentans namn utan "utan svar"/"utan facit" och filändelse."""
+    base = re.sub(r"\.pdf$", "", os.path.basename(utan))
+    tenta_name = re.sub(r'\s*utan\s+svar\s*', '', base, flags=re.IGNORECASE)
+    tenta_name = re.sub(r'\s*utan\s+facit\s*', '', tenta_name, flags=re.IGNORECASE)
+    tenta_name = re.sub(r'\s*utan_Facit\s*', '', tenta_name, flags=re.IGNORECASE)
+    return tenta_name.strip(" -_")
+
+def build_timestamp(paths):
+    """Stabil tidsstämpel för paketet: SOURCE_DATE_EPOCH eller nyaste indatafil.
+
+    Samma indata ger då samma not-/kort-id:n och zip-tider.
+    """
+    if os.environ.get("SOURCE_DATE_EPOCH"):
+        return float(os.environ["SOURCE_DATE_EPOCH"])
+    return float(int(max(os.path.getmtime(p) for p in paths)))
+
+def stream_media(writer, order, media_for, start):
+    """Skicka bilderna till writer i kortordning, så långt sidorna är klara.
+
+    order är [(framsida, baksida)] i planens ordning; en sida väntar tills
+    alla före den är renderade, så paketet blir detsamma oavsett vilka sidor
+    som kom från cachen. Returnerar index för nästa sida som inte skickats.
+    """
+    while start < len(order) and all(side in media_for for side in order[start]):
+        front, back = order[start]
+        for f, b in zip(media_for[front], media_for[back]):
+            writer.add_media(f)
+            writer.add_media(b)
+        start += 1
+    return start
+
 # ====== Huvudflöde ======
 def main():
-    print("🔍 Söker efter tentapar...")
-    pairs = find_pairs()
+    args = parse_args()
+    report, profiler = korrapport.start(args.report, args.profile, args.report_memory,
+                                        script="skap_anki_deck", args=vars(args))
+    try:
+        build_deck(args)
+    finally:
+        korrapport.finish(report, args.report, profiler, args.profile)
+
+def build_deck(args, pairs=None, pool=None):
+    """Bygg decket. pairs (redan parade) och pool (varm processpool) används av bevakning.py."""
+    if pairs is None:
+        print("🔍 Söker efter tentapar...")
+        with korrapport.stage("pair"):
+            pairs = find_pairs(args.root)
     
     if not pairs:
         print("❌ Hittade inga par av tentor utan/m med facit i denna mapp.")
@@ -241,65 +405,187 @@ def main():
     )
 
     total_notes = 0
-    
+    media_seen = set()
+    workers = args.workers or os.cpu_count() or 1
+    cache = RenderCache(args.cache_dir, enabled=not args.no_cache,
+                        max_mb=args.cache_max_mb, max_age_days=args.cache_max_age_days)
+
+    fmt, quality = args.media_format, args.media_quality
+    ext = extension(fmt)
+    encode_stats = EncodeStats()
+
+    # 1) Planera alla par och sidor (deterministisk ordning = find_pairs-ordningen)
+    exams = []
+    names = set()
     for utan, med in pairs:
-        base = re.sub(r"\.pdf$", "", os.path.basename(utan))
-        # Ta bort "utan svar" och liknande från namnet
-        tenta_name = re.sub(r'\s*utan\s+svar\s*', '', base, flags=re.IGNORECASE)
-        tenta_name = re.sub(r'\s*utan\s+facit\s*', '', tenta_name, flags=re.IGNORECASE)
-        tenta_name = re.sub(r'\s*utan_Facit\s*', '', tenta_name, flags=re.IGNORECASE)
-        tenta_name = tenta_name.strip(" -_")
+        tenta_name = exam_name(utan)
+        if tenta_name in names:  # samma tentanamn i flera kursmappar
+            tenta_name = f"{os.path.dirname(utan)} {tenta_name}"
+        names.add(tenta_name)
         skip = guess_skip(tenta_name)
+        # Säkerställ lika många sidor – rendera bara sidor som blir kort
+        n = max(0, min(page_count(utan), page_count(med)) - skip)
+        exams.append((utan, med, tenta_name, skip, n))
 
-        print(f"\n📖 Bearbetar: {tenta_name}")
-        print(f"   Skip sidor: {skip}")
+    # Budgeten fördelas lika över alla bilder i decket (fram- och baksidor)
+    total_images = 2 * sum(n for *_, n in exams)
+    max_bytes = int(args.budget_mb * 1024 * 1024 / total_images) if args.budget_mb and total_images else 0
 
-        # Skapa undermapp för denna tenta
+    # Media namnges efter pixelhash: identiska sidor (fram/bak, mellan tentor) lagras en gång
+    media_dir = os.path.join(work_root, "media")
+    os.makedirs(media_dir, exist_ok=True)
+    media_for = {}  # (pdf, sidindex) -> sökvägar i media_dir (hela sidan, eller en per fråga)
+
+    plan = []
+    tasks = []
+    split_tasks = []
+    dpis = []
+    for utan, med, tenta_name, skip, n in exams:
         out_dir = os.path.join(work_root, clean_filename(tenta_name))
-        
-        # Konvertera PDF:er till bilder
-        front_imgs = pdf_to_images(utan, out_dir, "front", dpi=DPI, skip_pages=skip)
-        back_imgs  = pdf_to_images(med,  out_dir, "back",  dpi=DPI, skip_pages=skip)
-
-        # Säkerställ lika många sidor
-        n = min(len(front_imgs), len(back_imgs))
-        
-        if n == 0:
-            print(f"   ⚠️ Inga sidor att bearbeta efter skip={skip}")
-            continue
-            
-        print(f"   📄 Bearbetar {n} sidor")
-
-        for idx in range(n):
-            f, b = front_imgs[idx], back_imgs[idx]
-            meta = f"{tenta_name} – sida {idx+1+skip}"
-            
-            note = genanki.Note(
-                model=model,
-                fields=[
-                    f'<div class="front-img"><img src="{os.path.basename(f)}"></div>',  # utan facit = fråga
-                    f'<div class="back-img"><img src="{os.path.basename(b)}"></div>',   # med facit = svar
-                    meta
-                ]
-            )
-            deck.add_note(note)
-            media.extend([f, b])
-            total_notes += 1
-
-        print(f"   ✅ Lade till {n} kort")
-
-    if total_notes == 0:
-        print("❌ Inga kort skapades. Kontrollera PDF-filerna och skip-inställningar.")
+        os.makedirs(out_dir, exist_ok=True)
+        pages = []
+        for i in range(skip, skip + n):
+            # Fram- och baksida renderas i samma DPI så att korten linjerar
+            dpi = page_dpi(utan, i, DPI, args.min_dpi) if args.adaptive_dpi else DPI
+            dpis.append(dpi)
+            pages.append((i, (utan, i), (med, i)))
+            if args.split_questions:
+                # Frågegränserna tas från sidan utan facit, så nyckeln beror på båda filerna
+                key = None
+                if cache.enabled:
+                    key = cache.key(f"{cache.file_hash(utan)}+{cache.file_hash(med)}", i, dpi=dpi, format=fmt,
+                                    quality=quality, max_bytes=max_bytes, question_gap=args.question_gap)
+                    meta = cache.get_meta(key)
+                    crops = meta and fetch_question_crops(cache, key, meta, out_dir, i, ext)
+                    if crops:
+                        korrapport.event("cache_hit", page=page_label(utan, i))
+                        for pdf, side in zip((utan, med), crops):
+                            media_for[pdf, i] = [link_media(path, media_dir, digest, ext) for path, digest in side]
+                        continue
+                split_tasks.append(((utan, med, i, out_dir, dpi, fmt, quality, max_bytes, args.question_gap), key))
+                continue
+            f = os.path.join(out_dir, f"front_{i+1:03d}{ext}")
+            b = os.path.join(out_dir, f"back_{i+1:03d}{ext}")
+            for pdf, path in ((utan, f), (med, b)):
+                # Sidindex är absolut, så skip påverkar vilka sidor som hämtas men inte nyckeln
+                key = None
+                if cache.enabled:
+                    key = cache.key(cache.file_hash(pdf), i, dpi=dpi, format=fmt,
+                                    quality=quality, max_bytes=max_bytes)
+                    meta = cache.get_meta(key)
+                    if meta and cache.fetch(key, path, suffix=ext):
+                        korrapport.event("cache_hit", page=page_label(pdf, i))
+                        media_for[pdf, i] = [link_media(path, media_dir, meta["pixel_hash"], ext)]
+                        continue
+                tasks.append(((pdf, i, path, dpi, fmt, quality, max_bytes), key))
+        plan.append((tenta_name, skip, pages))
+    close_docs()  # arbetsprocesserna öppnar egna handtag
+
+    if args.adaptive_dpi and dpis:
+        lowered = sum(1 for d in dpis if d < DPI)
+        print(f"📐 Adaptiv DPI: {lowered}/{len(dpis)} sidor under {DPI} (snitt {sum(dpis) / len(dpis):.0f})")
+    # Paketet öppnas före renderingen; bilderna strömmas in i kortordning medan sidorna blir klara
+    timestamp = build_timestamp([p for pair in pairs for p in pair])
+    if args.delta:
+        timestamp = time.time()  # ändrade noter måste vara nyare än de i Anki för att uppdateras
+    order = [(front, back) for _, _, pages in plan for _, front, back in pages]
+    with byggmanifest.open_writer(OUT_APKG, args.delta, timestamp) as writer:
+        streamed = stream_media(writer, order, media_for, 0)
+
+        # 2) Rendera sidor som saknas i cachen, alla par parallellt
+        if cache.enabled:
+            print(f"♻️ {len(media_for)} sidor från cache ({cache.root})")
+        if args.split_questions:
+            print(f"✂️ Renderar och delar {len(split_tasks)} sidpar i frågor med {workers} processer ({fmt})...")
+        else:
+            print(f"🖼️ Renderar {len(tasks)} sidor med {workers} processer ({fmt})...")
+        report = korrapport.active()
+        results = render_pages([task for task, _ in tasks], workers, pool=pool)
+        for (task, key), (path, rows, digest, report_rows) in zip(tasks, results):
+            encode_stats.extend(rows)
+            report.extend(report_rows)
+            media_for[task[0], task[1]] = [link_media(path, media_dir, digest, ext)]
+            streamed = stream_media(writer, order, media_for, streamed)
+            if key is not None:
+                cache.put(key, path, suffix=ext)
+                cache.put_meta(key, {"pixel_hash": digest})
+        results = render_pages([task for task, _ in split_tasks], workers, func=render_question_crops, pool=pool)
+        for (task, key), (front, back, rows, report_rows) in zip(split_tasks, results):
+            encode_stats.extend(rows)
+            report.extend(report_rows)
+            utan, med, i = task[:3]
+            for pdf, side in ((utan, front), (med, back)):
+                media_for[pdf, i] = [link_media(path, media_dir, digest, ext) for path, digest in side]
+            streamed = stream_media(writer, order, media_for, streamed)
+            if key is not None:
+                for tag, side in (("f", front), ("b", back)):
+                    for j, (path, _) in enumerate(side):
+                        cache.put(key, path, suffix=f"_{tag}{j+1}{ext}")
+                cache.put_meta(key, {"front": [d for _, d in front], "back": [d for _, d in back]})
+        cache.evict()
+        encode_stats.print_summary()
+        if args.encode_report:
+            encode_stats.write_csv(args.encode_report)
+            print(f"📝 Kodningsrapport: {args.encode_report}")
+
+        # 3) Lägg till noter i planens ordning, oberoende av vilken process som blev klar först
+        for tenta_name, skip, pages in plan:
+            print(f"\n📖 Bearbetar: {tenta_name}")
+            print(f"   Skip sidor: {skip}")
+
+            n = len(pages)
+            if n == 0:
+                print(f"   ⚠️ Inga sidor att bearbeta efter skip={skip}")
+                korrapport.event("no_pages", exam=tenta_name, skip=skip)
+                continue
+                
+            print(f"   📄 Bearbetar {n} sidor")
+
+            added = 0
+            for i, front, back in pages:
+                crops = list(zip(media_for[front], media_for[back]))
+                for j, (f, b) in enumerate(crops):
+                    meta = f"{tenta_name} – sida {i+1}"
+                    if len(crops) > 1:
+                        meta += f", fråga {j+1}"
+
+                    note = genanki.Note(
+                        model=model,
+                        # Stabilt GUID: samma tenta/sida/fråga uppdaterar samma kort vid ny import
+                        guid=genanki.guid_for(model.model_id, tenta_name, i + 1, j + 1 if len(crops) > 1 else 0),
+                        fields=[
+                            f'<div class="front-img"><img src="{os.path.basename(f)}"></div>',  # utan facit = fråga
+                            f'<div class="back-img"><img src="{os.path.basename(b)}"></div>',   # med facit = svar
+                            meta
+                        ]
+                    )
+                    deck.add_note(note)
+                    for path in (f, b):
+                        if path not in media_seen:
+                            media_seen.add(path)
+                            media.append(path)
+                    added += 1
+            total_notes += added
+
+            print(f"   ✅ Lade till {added} kort")
+
+        if total_notes == 0:
+            print("❌ Inga kort skapades. Kontrollera PDF-filerna och skip-inställningar.")
+            return
+
+        # Skapa Anki-paket: bilderna ligger redan i det, kvar är samlingen
+        print(f"\n🧬 {len(media)} unika bilder för {2 * total_notes} kortsidor")
+        print(f"📦 Skapar Anki-paket med {total_notes} kort...")
+        decks, media, out_apkg, manifest = byggmanifest.plan([deck], media, OUT_APKG, args.delta)
+        if decks:
+            with korrapport.stage("apkg", media=len(media)):
+                writer.finish(decks)
+    byggmanifest.save(byggmanifest.manifest_path(OUT_APKG), manifest)
+    if not decks:
+        print("\n✅ Inga ändrade kort sedan förra bygget – inget deltapaket skrivs")
         return
 
-    # Skapa Anki-paket
-    print(f"\n📦 Skapar Anki-paket med {total_notes} kort...")
-    pkg = genanki.Package(deck)
-    pkg.media_files = media
-    out_apkg = "tentor_samlat.apkg"
-    pkg.write_to_file(out_apkg)
-    
-    print(f"\n✅ KLART: {out_apkg} med {total_notes} kort.")
+    print(f"\n✅ KLART: {out_apkg} med {sum(len(d.notes) for d in decks)} kort.")
     print(f"📁 Arbetsfiler finns i: {work_root}")
     print(f"💡 Importera {out_apkg} i Anki för att använda decket.")
 
@@ -1,63 +1,109 @@
 #!/usr/bin/env python3
 """
-Snabb test-script för att testa olika maskningspositioner
+Snabb test-script för att testa olika maskningspositioner.
+
+Alla kombinationer provas i samma process (parametersvep): PDF:en
+rasteriseras en gång och varje kombination poängsätts mot de gröna
+markeringarna. Resultatet blir en rangordnad tabell, en CSV och
+kontaktark (miniatyrer av maskade sidor) för de bästa kombinationerna.
+
+    python3 test_maskning.py tenta.pdf --mode column --skip-pages 3 \\
+        --grid col_top_perc=10:30:5 --grid col_bot_perc=60:75:5
+    python3 test_maskning.py tenta.pdf --grid h1=30:40:5 --grid hc_param2=15:30:5
+    python3 test_maskning.py 20 65      # maska standard-PDF:en + .apkg, som förut
+
+Övriga flaggor (t.ex. --dpi, --col-x-perc, --utan) går vidare till
+maska_ratt_svar och är grundvärden för parametrar som inte svepas.
 """
 
 import os
 import sys
-import subprocess
-
-def test_maskning(top_perc, bot_perc, skip_pages=3):
-    """Testa maskning med specifika procentvärden"""
-    cmd = [
-        "python3", "maska_ratt_svar.py",
-        "Rest Tentamen - Basvetenskap 3 - VT2022.pdf",
-        "out/",
-        "--skip-pages", str(skip_pages),
-        "--mode", "column",
-        "--col-top-perc", str(top_perc),
-        "--col-bot-perc", str(bot_perc),
-        "--build-apkg"
-    ]
-    
-    print(f"🧪 Testar: top={top_perc}%, bottom={bot_perc}%")
+import argparse
+import maska_ratt_svar as maska
+import parametersvep
+
+DEFAULT_PDF = "Rest Tentamen - Basvetenskap 3 - VT2022.pdf"
+
+def parse_args(argv):
+    ap = argparse.ArgumentParser(description="Svep maskningsparametrar och rangordna kombinationerna.")
+    ap.add_argument("pdf_path", help="PDF med facit")
+    ap.add_argument("--grid", action="append", default=[],
+                    help="parameter=värden, t.ex. col_top_perc=10:30:5 (start:slut:steg) eller h1=30,35,40")
+    ap.add_argument("--out", default="out/svep", help="Mapp för tabell och kontaktark")
+    ap.add_argument("--top", type=int, default=15, help="Antal rader i tabellen")
+    ap.add_argument("--sheets", type=int, default=3, help="Kontaktark för de N bästa kombinationerna")
+    ap.add_argument("--sheet-pages", type=int, default=8, dest="sheet_pages", help="Sidor per kontaktark")
+    ap.add_argument("--threads", type=int, default=0, help="Trådar för svepet (0 = en per kärna)")
+    args, rest = ap.parse_known_args(argv)
+    base = maska.parse_args([args.pdf_path, args.out, *rest])
+    base.skip_pages = maska.resolve_skip_pages(base)
+    return args, base
+
+def test_maskning(argv):
+    args, base = parse_args(argv)
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        if result.returncode == 0:
-            print(f"✅ Klar! PDF: out/tenta_maskad.pdf")
-            print(f"📦 Anki: bv3_maskad.apkg")
-        else:
-            print(f"❌ Fel: {result.stderr}")
+        grid = parametersvep.parse_grid(args.grid, base)
+    except ValueError as e:
+        print(f"❌ {e}")
+        return 2
+    if not grid:
+        print("❌ Ange minst en --grid parameter=värden")
+        return 2
+    os.makedirs(args.out, exist_ok=True)
+
+    sweep, results = parametersvep.run_sweep(base, grid, args.threads)
+    names = list(results[0])[:len(grid)]
+    print(f"\n🏆 Bästa kombinationer (mode={base.mode}):")
+    parametersvep.print_table(results, names, args.top)
+
+    table = os.path.join(args.out, "svep.csv")
+    parametersvep.write_csv(results, names, table)
+    print(f"\n📝 Alla {len(results)} kombinationer: {table}")
+    for i, result in enumerate(results[:args.sheets], 1):
+        params = {n: result[n] for n in names}
+        title = f"#{i} " + " ".join(f"{n}={v}" for n, v in params.items()) + f"  täckning {result['coverage'] * 100:.1f} %"
+        path = parametersvep.contact_sheet(sweep, params, os.path.join(args.out, f"svep_{i:02d}.png"),
+                                           title, args.sheet_pages)
+        if path:
+            print(f"🖼️ {path}")
+    return 0
+
+def legacy_run(top, bot, skip_pages=3):
+    """Gamla anropet "test_maskning.py top bottom": maska standard-PDF:en i kolumnläge
+    till out/ och bygg .apkg, som förut (nu i samma process)."""
+    args = maska.parse_args([DEFAULT_PDF, "out/", "--skip-pages", str(skip_pages), "--mode", "column",
+                             "--col-top-perc", str(top), "--col-bot-perc", str(bot), "--build-apkg"])
+    print(f"🧪 Testar: top={args.col_top_perc:g}%, bottom={args.col_bot_perc:g}%")
+    try:
+        maska.run(args)
     except Exception as e:
         print(f"❌ Fel: {e}")
+        return 1
+    print(f"✅ Klar! PDF: {os.path.join(args.out_dir, 'tenta_maskad.pdf')}")
+    print(f"📦 Anki: {maska.DEFAULT_APKG}")
+    print(f"💡 Flera värden på en gång: python3 test_maskning.py \"{DEFAULT_PDF}\" --mode column "
+          f"--grid col_top_perc=10:30:5 --grid col_bot_perc=60:80:5")
+    return 0
 
 def main():
-    if len(sys.argv) == 3:
-        # Använd kommandoradsargument
-        top = float(sys.argv[1])
-        bot = float(sys.argv[2])
-        test_maskning(top, bot)
-    else:
-        # Interaktivt läge
-        print("🎯 Maskningstest - Ange procentvärden")
-        print("Format: top% bottom% (t.ex. 20 65)")
-        print("Eller kör: python3 test_maskning.py 20 65")
-        
-        try:
-            user_input = input("Ange top% och bottom%: ").strip()
-            if user_input:
-                parts = user_input.split()
-                if len(parts) >= 2:
-                    top = float(parts[0])
-                    bot = float(parts[1])
-                    test_maskning(top, bot)
-                else:
-                    print("❌ Ange både top% och bottom%")
-        except KeyboardInterrupt:
-            print("\n👋 Avbrutet")
-        except Exception as e:
-            print(f"❌ Fel: {e}")
+    argv = sys.argv[1:]
+    if len(argv) == 2 and all(a.replace(".", "", 1).isdigit() for a in argv):
+        return legacy_run(*argv)
+    if argv:
+        return test_maskning(argv)
 
-if __name__ == "__main__":
-    main()
+    # Interaktivt läge
+    print("🎯 Maskningstest - Ange procentvärden")
+    print("Format: top% bottom% (t.ex. 20 65)")
+    print("Eller kör: python3 test_maskning.py tenta.pdf --grid col_top_perc=10:30:5 ...")
+    try:
+        parts = input("Ange top% och bottom%: ").split()
+        if len(parts) >= 2:
+            return legacy_run(parts[0], parts[1])
+        print("❌ Ange både top% och bottom%")
+    except KeyboardInterrupt:
+        print("\n👋 Avbrutet")
+    return 1
 
+if __name__ == "__main__":
+    sys.exit(main())